@@ -0,0 +1,95 @@
+#
+# Copyright 2016 Mozilla
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# SQLite database used by the stores of symsrv-fetch.py (probe cache, journal,
+# symbol lists and symcache index), with its writes committed in batches:
+# a commit per write would be too slow. The task usually ends by being
+# killed, so the writes are also committed after a few seconds, to lose
+# only the last ones.
+#
+# The databases are in WAL mode, so that the readers don't block the writer
+# and the worker processes can share them. A transaction holds the write lock
+# until its commit, so the writes to a database shared by several processes
+# are buffered instead and applied at once when committing: the other
+# processes only wait for the commit, but the buffered writes aren't visible
+# to the reads until then.
+
+import sqlite3
+import time
+
+
+# Max number of writes between two commits
+COMMIT_EVERY = 1000
+# Max seconds between a write and its commit (when there are other writes)
+COMMIT_INTERVAL = 5
+# Seconds to wait for a lock held by another process
+BUSY_TIMEOUT = 60
+
+
+class BatchedDB:
+    def __init__(self, path, buffered=False):
+        self.db = sqlite3.connect(path, timeout=BUSY_TIMEOUT)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.buffer = [] if buffered else None
+        self.pending = 0
+        self.last_commit = time.monotonic()
+
+    def execute(self, query, params=()):
+        """
+        Execute a query which doesn't write or whose write is committed by the caller.
+        """
+        return self.db.execute(query, params)
+
+    def executemany(self, query, params):
+        return self.db.executemany(query, params)
+
+    def executescript(self, script):
+        return self.db.executescript(script)
+
+    def write(self, query, params=()):
+        """
+        Execute a write, committed with the next batch.
+        """
+        if self.buffer is None:
+            self.db.execute(query, params)
+        else:
+            self.buffer.append((query, params))
+        self.pending += 1
+        if (
+            self.pending >= COMMIT_EVERY
+            or time.monotonic() - self.last_commit >= COMMIT_INTERVAL
+        ):
+            self.commit()
+
+    def flush(self):
+        """
+        Commit the pending writes, to be called periodically in case there
+        are no new writes.
+        """
+        if self.pending:
+            self.commit()
+
+    def commit(self):
+        if self.buffer:
+            for query, params in self.buffer:
+                self.db.execute(query, params)
+            self.buffer = []
+        self.db.commit()
+        self.pending = 0
+        self.last_commit = time.monotonic()
+
+    def close(self):
+        self.commit()
+        self.db.close()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 Mozilla
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Stand-in for dump_syms with the command line used by symsrv-fetch.py:
+#   fake_dump_syms.py FILE (--debug-id ID | --code-id ID) [--store DIR]
+#                     --symbol-server 'SRV*CACHE*URL' [--verbose LEVEL]
+# It reads the files downloaded in CACHE, burns some cpu according to their
+# size and writes a synthetic .sym file. It's tuned with environment variables:
+#  - BENCH_DUMP_SYMS_CPU: cpu seconds per MB of input (default: 0.05);
+#  - BENCH_DUMP_SYMS_RATIO: size of the .sym relative to the input (default: 0.2);
+#  - BENCH_DUMP_SYMS_X86_64_RATE: fraction of x86_64 modules (default: 0.3, like
+#    fake_symbol_server.py --x86-64-rate);
+#  - BENCH_DUMP_SYMS_ERROR_RATE: fraction of failures (default: 0).
+
+import argparse
+import hashlib
+import os
+import sys
+import time
+
+from synthetic import get_debug_file, get_debug_id, get_fraction, is_x86_64
+
+
+def get_env(name, default):
+    return float(os.environ.get(name, default))
+
+
+def burn(seconds, data):
+    h = hashlib.sha1()
+    end = time.process_time() + seconds
+    while time.process_time() < end:
+        h.update(data[:65536] or b"\0")
+
+
+def get_sym(debug_file, debug_id, arch, size):
+    lines = [f"MODULE windows {arch} {debug_id} {debug_file}\n"]
+    total = len(lines[0])
+    i = 0
+    while total < size:
+        line = f"FUNC {i * 16:x} 10 0 {debug_file[:-4]}::function_{i}(int, char const*)\n"
+        lines.append(line)
+        total += len(line)
+        i += 1
+    return "".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake dump_syms")
+    parser.add_argument("file", type=str)
+    parser.add_argument("--debug-id", type=str)
+    parser.add_argument("--code-id", type=str)
+    parser.add_argument("--store", type=str)
+    parser.add_argument("--symbol-server", type=str, default="")
+    parser.add_argument("--verbose", type=str)
+    args = parser.parse_args()
+
+    cache = args.symbol_server.split("*")[1] if "*" in args.symbol_server else "."
+    if args.code_id:
+        inputs = [(args.file, args.code_id)]
+        debug_file = get_debug_file(args.file)
+        debug_id = get_debug_id(args.file, args.code_id)
+        inputs.append((debug_file, debug_id))
+    else:
+        debug_file, debug_id = args.file, args.debug_id
+        inputs = [(debug_file, debug_id)]
+
+    size = 0
+    data = b""
+    for name, file_id in inputs:
+        path = os.path.join(cache, name, file_id, name)
+        try:
+            with open(path, "rb") as In:
+                data = In.read()
+        except OSError:
+            sys.stderr.write(f"Error: cannot find {name}/{file_id}\n")
+            return 1
+        size += len(data)
+
+    burn(get_env("BENCH_DUMP_SYMS_CPU", 0.05) * size / 1024 ** 2, data)
+
+    if get_fraction("error", debug_file, debug_id) < get_env(
+        "BENCH_DUMP_SYMS_ERROR_RATE", 0
+    ):
+        sys.stderr.write(f"Error: cannot dump {debug_file}/{debug_id}\n")
+        return 1
+
+    if is_x86_64(debug_file, debug_id, get_env("BENCH_DUMP_SYMS_X86_64_RATE", 0.3)):
+        arch = "x86_64"
+    else:
+        arch = "x86"
+    sym = get_sym(
+        debug_file, debug_id, arch, int(size * get_env("BENCH_DUMP_SYMS_RATIO", 0.2))
+    )
+
+    if args.store:
+        output = os.path.join(args.store, debug_file, debug_id)
+        os.makedirs(output, exist_ok=True)
+        with open(os.path.join(output, debug_file[:-4] + ".sym"), "w") as Out:
+            Out.write(sym)
+    else:
+        sys.stdout.write(sym)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
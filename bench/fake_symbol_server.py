@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 Mozilla
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Local stand-in for the servers used by symsrv-fetch.py, for the benchmarks:
+#  - /microsoft/download/symbols/: Microsoft's symbol server, serving synthetic
+#    pdbs and binaries (only their headers are meaningful, the rest is zeros)
+#    and their compressed variants (MSZIP cabinets foo.pd_, foo.dl_);
+#  - /mozilla/v1/: the Mozilla symbol server, only answering HEAD requests;
+#  - /missingsymbols.csv: the missing symbols CSV given with --missing-symbols.
+#
+# Whether a file exists is derived from a hash of its path, so the answers
+# are the same for HEAD and GET and from a run to another. The latency and
+# the errors (including downloads broken midway) are random. The downloads
+# can be resumed with a Range request (bytes=N-).
+#
+# Point symsrv-fetch.py to it with:
+#   SYMSRV_MICROSOFT_SYMBOL_SERVER=http://127.0.0.1:PORT/microsoft/download/symbols/
+#   SYMSRV_MOZILLA_SYMBOL_SERVER=http://localhost:PORT/mozilla/v1/
+# (two host names so that each server has its own rate limiter).
+
+import argparse
+import asyncio
+import functools
+import random
+import sys
+
+from aiohttp import web
+
+from synthetic import (
+    MACHINE_AMD64,
+    MACHINE_X86,
+    PDB_BLOCK_SIZE,
+    get_debug_file,
+    get_cab,
+    get_debug_id,
+    get_fraction,
+    get_pdb_head,
+    get_pe_head,
+    get_size,
+    is_x86_64,
+)
+
+
+MICROSOFT_PREFIX = "/microsoft/download/symbols/"
+MOZILLA_PREFIX = "/mozilla/v1/"
+# Microsoft's symbol server redirects the downloads to a blob storage.
+REDIRECT_PREFIX = "/blob/"
+CHUNK_SIZE = 64 * 1024
+
+PDB_V2 = b"Microsoft C/C++ program database 2.00\r\n\x1aJG\x00\x00"
+UNKNOWN = b"<!DOCTYPE html><html><body>Error</body></html>"
+
+
+class FakeSymbolServer:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+
+    async def delay(self):
+        if self.args.latency:
+            await asyncio.sleep(self.rng.uniform(0, 2 * self.args.latency))
+
+    def get_failure(self, request):
+        """
+        Get a response for a random failure or None.
+        """
+        x = self.rng.random()
+        if x < self.args.reset_rate:
+            request.transport.close()
+            return web.Response(status=500)
+        x -= self.args.reset_rate
+        if x < self.args.throttle_rate:
+            return web.Response(status=429, headers={"Retry-After": "1"})
+        x -= self.args.throttle_rate
+        if x < self.args.error_rate:
+            return web.Response(status=503)
+        return None
+
+    def get_machine(self, debug_file, debug_id):
+        if is_x86_64(debug_file, debug_id, self.args.x86_64_rate):
+            return MACHINE_AMD64
+        return MACHINE_X86
+
+    def get_content(self, path):
+        """
+        Get (head, size) of the file at path on Microsoft's server or None if it doesn't exist.
+        """
+        name, file_id = path.split("/")[:2]
+        if path.endswith("_"):
+            return self.get_cab_content(path[:-1] + name[-1], name)
+        is_pdb = name.lower().endswith(".pdb")
+        rate = self.args.pdb_rate if is_pdb else self.args.code_rate
+        if get_fraction("exists", path) >= rate:
+            return None
+
+        x = get_fraction("content", path)
+        if x < self.args.bad_content_rate:
+            return UNKNOWN, len(UNKNOWN)
+        if is_pdb:
+            size = get_size(self.args.pdb_size, path)
+            if x < self.args.bad_content_rate + self.args.pdb_v2_rate:
+                return PDB_V2, size
+            # a pdb is made of whole blocks
+            size = max(size // PDB_BLOCK_SIZE, 8) * PDB_BLOCK_SIZE
+            machine = self.get_machine(name, file_id)
+            return get_pdb_head(file_id, machine, size), size
+        debug_file = get_debug_file(name)
+        debug_id = get_debug_id(name, file_id)
+        machine = self.get_machine(debug_file, debug_id)
+        head = get_pe_head(file_id, machine, debug_file, debug_id)
+        return head, max(get_size(self.args.code_size, path), len(head))
+
+    # Building a cab is slow: keep the last ones for the HEAD and GET requests.
+    @functools.lru_cache(maxsize=64)
+    def get_cab_content(self, path, name):
+        """
+        Get (cab, size) of the compressed variant of the file at path.
+        """
+        if get_fraction("cab", path) >= self.args.cab_rate:
+            return None
+        content = self.get_content(path)
+        if content is None:
+            return None
+        head, size = content
+        cab = get_cab(name, head + bytes(size - len(head)))
+        return cab, len(cab)
+
+    def get_range_start(self, request, size):
+        """
+        Get the first byte asked with a Range header (0 if there's none).
+        """
+        value = request.headers.get("Range", "")
+        if self.args.ignore_ranges or not value.startswith("bytes="):
+            return 0
+        start, _, end = value[len("bytes=") :].partition("-")
+        if not start.isdigit() or end:
+            return 0
+        start = int(start)
+        if start >= size:
+            raise web.HTTPRequestRangeNotSatisfiable(
+                headers={"Content-Range": f"bytes */{size}"}
+            )
+        return start
+
+    async def send_file(self, request, head, size):
+        headers = {
+            "Content-Type": "application/octet-stream",
+            "Content-Length": str(size),
+            "Accept-Ranges": "none" if self.args.ignore_ranges else "bytes",
+        }
+        if request.method == "HEAD":
+            return web.Response(headers=headers)
+
+        start = self.get_range_start(request, size)
+        status = 200
+        if start:
+            status = 206
+            headers["Content-Length"] = str(size - start)
+            headers["Content-Range"] = f"bytes {start}-{size - 1}/{size}"
+        # Break the download midway
+        end = size
+        if self.rng.random() < self.args.break_rate:
+            end = self.rng.randint(start, size - 1)
+
+        resp = web.StreamResponse(status=status, headers=headers)
+        await resp.prepare(request)
+        data = head[start:min(size, end)]
+        await resp.write(data)
+        written = start + len(data)
+        zeros = bytes(CHUNK_SIZE)
+        bandwidth = self.args.bandwidth * 1024 ** 2
+        while written < end:
+            n = min(CHUNK_SIZE, end - written)
+            await resp.write(zeros[:n])
+            written += n
+            if bandwidth:
+                await asyncio.sleep(n / bandwidth)
+        if end < size:
+            request.transport.close()
+            return resp
+        await resp.write_eof()
+        return resp
+
+    async def microsoft(self, request):
+        path = request.match_info["path"]
+        content = self.get_content(path)
+        if content is None:
+            return web.Response(status=404)
+        if self.args.redirect and not request.path.startswith(REDIRECT_PREFIX):
+            raise web.HTTPFound(REDIRECT_PREFIX + path)
+        return await self.send_file(request, *content)
+
+    async def mozilla(self, request):
+        path = request.match_info["path"]
+        if get_fraction("uploaded", path.lower()) < self.args.uploaded_rate:
+            return web.Response()
+        return web.Response(status=404)
+
+    async def missing_symbols(self, request):
+        if not self.args.missing_symbols:
+            return web.Response(status=404)
+        resp = web.StreamResponse(headers={"Content-Type": "text/csv"})
+        await resp.prepare(request)
+        with open(self.args.missing_symbols, "rb") as In:
+            for chunk in iter(lambda: In.read(CHUNK_SIZE), b""):
+                await resp.write(chunk)
+        await resp.write_eof()
+        return resp
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        await self.delay()
+        if request.path != "/missingsymbols.csv":
+            failure = self.get_failure(request)
+            if failure is not None:
+                return failure
+        return await handler(request)
+
+    def get_app(self):
+        app = web.Application(middlewares=[self.middleware])
+        app.router.add_get("/missingsymbols.csv", self.missing_symbols)
+        for prefix, handler in (
+            (MICROSOFT_PREFIX, self.microsoft),
+            (REDIRECT_PREFIX, self.microsoft),
+            (MOZILLA_PREFIX, self.mozilla),
+        ):
+            # add_get also adds the route for HEAD
+            app.router.add_get(prefix + "{path:.+}", handler)
+        return app
+
+
+def get_parser(add_help=True):
+    parser = argparse.ArgumentParser(
+        description="Fake Microsoft and Mozilla symbol servers for the benchmarks",
+        add_help=add_help,
+    )
+    parser.add_argument("--port", type=int, help="port to listen on", default=8080)
+    parser.add_argument(
+        "--missing-symbols", type=str, help="CSV served as /missingsymbols.csv"
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        help="mean latency in seconds of the responses",
+        default=0.05,
+    )
+    parser.add_argument(
+        "--bandwidth",
+        type=float,
+        help="bandwidth in MB/s of each download (0 for unlimited)",
+        default=0,
+    )
+    parser.add_argument(
+        "--error-rate", type=float, help="fraction of 503 responses", default=0.0
+    )
+    parser.add_argument(
+        "--throttle-rate", type=float, help="fraction of 429 responses", default=0.0
+    )
+    parser.add_argument(
+        "--reset-rate",
+        type=float,
+        help="fraction of connections closed without a response",
+        default=0.0,
+    )
+    parser.add_argument(
+        "--break-rate",
+        type=float,
+        help="fraction of downloads broken midway",
+        default=0.0,
+    )
+    parser.add_argument(
+        "--ignore-ranges",
+        action="store_true",
+        help="ignore the Range requests and always send the whole file",
+    )
+    parser.add_argument(
+        "--redirect",
+        action="store_true",
+        help="redirect the requests to Microsoft's server, like the real one does",
+    )
+    parser.add_argument(
+        "--pdb-rate",
+        type=float,
+        help="fraction of the pdbs on Microsoft's server",
+        default=0.7,
+    )
+    parser.add_argument(
+        "--code-rate",
+        type=float,
+        help="fraction of the binaries on Microsoft's server",
+        default=0.9,
+    )
+    parser.add_argument(
+        "--cab-rate",
+        type=float,
+        help="fraction of the files also available compressed (.pd_, .dl_)",
+        default=0.5,
+    )
+    parser.add_argument(
+        "--uploaded-rate",
+        type=float,
+        help="fraction of the symbols already on the Mozilla symbol server",
+        default=0.3,
+    )
+    parser.add_argument(
+        "--pdb-v2-rate",
+        type=float,
+        help="fraction of the pdbs in the old (unsupported) format",
+        default=0.01,
+    )
+    parser.add_argument(
+        "--bad-content-rate",
+        type=float,
+        help="fraction of the files served with an unknown content",
+        default=0.01,
+    )
+    parser.add_argument(
+        "--x86-64-rate",
+        type=float,
+        help="fraction of the modules for x86_64 (the other ones are for x86)",
+        default=0.3,
+    )
+    parser.add_argument(
+        "--pdb-size", type=int, help="mean size in bytes of the pdbs", default=1024 ** 2
+    )
+    parser.add_argument(
+        "--code-size",
+        type=int,
+        help="mean size in bytes of the binaries",
+        default=512 * 1024,
+    )
+    parser.add_argument("--seed", type=int, help="random seed", default=0)
+    return parser
+
+
+def run(args, print=print):
+    server = FakeSymbolServer(args)
+    web.run_app(server.get_app(), port=args.port, access_log=None, print=print)
+
+
+def main():
+    run(get_parser().parse_args())
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
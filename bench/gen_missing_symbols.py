@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 Mozilla
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Generate a missing symbols CSV (as served by symbols.mozilla.org) of any size
+# with synthetic modules, for the benchmarks of symsrv-fetch.py.
+
+import argparse
+import random
+import sys
+
+from synthetic import get_debug_file, get_debug_id
+
+
+HEADER = "debug_file,debug_id,code_file,code_id"
+
+
+def generate(rows, unique, with_code, names, seed):
+    """
+    Yield the rows of the CSV: rows lines for about unique * rows distinct
+    modules (the other lines are duplicates, like in the real list), with a
+    binary for a fraction with_code of them.
+    """
+    rng = random.Random(seed)
+    modules = []
+    for _ in range(rows):
+        if modules and rng.random() >= unique:
+            yield rng.choice(modules)
+            continue
+
+        name = f"mod{rng.randrange(names)}"
+        if rng.random() < with_code:
+            code_file = f"{name}.dll"
+            code_id = f"{rng.getrandbits(32):08X}{rng.randrange(0x1000, 0x1000000):x}"
+            line = f"{get_debug_file(code_file)},{get_debug_id(code_file, code_id)},{code_file},{code_id}"
+        else:
+            debug_id = f"{rng.getrandbits(128):032X}{rng.randrange(1, 4)}"
+            line = f"{name}.pdb,{debug_id},,"
+        modules.append(line)
+        yield line
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate a missing symbols CSV with synthetic modules"
+    )
+    parser.add_argument("rows", type=int, help="number of rows")
+    parser.add_argument(
+        "-o", "--output", type=str, help="output file (default: stdout)", default="-"
+    )
+    parser.add_argument(
+        "--unique",
+        type=float,
+        help="fraction of the rows which are distinct modules",
+        default=0.8,
+    )
+    parser.add_argument(
+        "--with-code",
+        type=float,
+        help="fraction of the modules which have a code file and id",
+        default=0.5,
+    )
+    parser.add_argument(
+        "--names",
+        type=int,
+        help="number of distinct debug file names",
+        default=5000,
+    )
+    parser.add_argument("--seed", type=int, help="random seed", default=0)
+    args = parser.parse_args()
+
+    out = sys.stdout if args.output == "-" else open(args.output, "w")
+    try:
+        out.write(HEADER + "\n")
+        for line in generate(
+            args.rows, args.unique, args.with_code, args.names, args.seed
+        ):
+            out.write(line + "\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
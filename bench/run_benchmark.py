@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 Mozilla
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Benchmark symsrv-fetch.py offline: generate a missing symbols CSV, serve it
+# with synthetic symbols from the fake symbol server, run symsrv-fetch.py
+# with the fake dump_syms and report the throughput, the peak memory and
+# the timings of the stages of the pipeline (from the metrics of the run).
+#
+#   python bench/run_benchmark.py --rows 20000 --latency 0.1 -o after.json --baseline before.json
+#
+# The options of fake_symbol_server.py are accepted too, and the fake
+# dump_syms is tuned with the BENCH_DUMP_SYMS_* environment variables
+# (see fake_dump_syms.py).
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+import fake_symbol_server
+from gen_missing_symbols import HEADER, generate
+
+
+log = logging.getLogger()
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+SYMSRV_FETCH = os.path.join(REPO_DIR, "symsrv-fetch.py")
+FAKE_DUMP_SYMS = os.path.join(BENCH_DIR, "fake_dump_syms.py")
+# Seconds to wait for the fake server to accept connections
+SERVER_TIMEOUT = 30
+
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_server(port):
+    end = time.monotonic() + SERVER_TIMEOUT
+    while time.monotonic() < end:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"The fake symbol server isn't listening on port {port}")
+
+
+def count_rows(path):
+    with open(path, "rb") as In:
+        return max(0, sum(1 for _ in In) - 1)
+
+
+def run_symsrv_fetch(port, work_dir, cache_dir, extra_args, x86_64_rate):
+    """
+    Run symsrv-fetch.py against the fake server and get (wall time, rusage,
+    exit code, metrics of the run).
+    """
+    output = os.path.join(work_dir, "symbols.zip")
+    cmd = [
+        sys.executable,
+        SYMSRV_FETCH,
+        output,
+        "--missing-symbols",
+        f"http://127.0.0.1:{port}/missingsymbols.csv",
+        "--dump-syms",
+        FAKE_DUMP_SYMS,
+        "--cache-dir",
+        cache_dir,
+    ] + extra_args
+    env = dict(
+        os.environ,
+        SYMSRV_MICROSOFT_SYMBOL_SERVER=f"http://127.0.0.1:{port}{fake_symbol_server.MICROSOFT_PREFIX}",
+        SYMSRV_MOZILLA_SYMBOL_SERVER=f"http://localhost:{port}{fake_symbol_server.MOZILLA_PREFIX}",
+        # The fake dump_syms must agree with the headers of the fake files.
+        BENCH_DUMP_SYMS_X86_64_RATE=str(x86_64_rate),
+    )
+
+    log_path = os.path.join(work_dir, "symsrv-fetch.log")
+    start = time.monotonic()
+    with open(log_path, "wb") as Out:
+        # The blacklist and the skiplist are read from the current directory.
+        proc = subprocess.Popen(cmd, cwd=REPO_DIR, env=env, stdout=Out, stderr=Out)
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = status
+    wall_time = time.monotonic() - start
+
+    metrics = {}
+    metrics_path = os.path.join(work_dir, "symbols-metrics.json")
+    if os.path.exists(metrics_path):
+        with open(metrics_path, "r") as In:
+            metrics = json.load(In)
+    if status:
+        log.error(f"symsrv-fetch.py failed (status {status}), see {log_path}")
+
+    return wall_time, rusage, status, metrics
+
+
+def check_zips(work_dir):
+    """
+    Check the zips listed in the manifest of the run (their entries are
+    written without zipfile, see ZipWriter.append) and get the list of the
+    bad ones.
+    """
+    manifest = os.path.join(work_dir, "symbols.json")
+    if not os.path.exists(manifest):
+        return []
+    with open(manifest, "r") as In:
+        shards = json.load(In)["shards"]
+
+    bad = []
+    for shard in shards:
+        path = os.path.join(work_dir, shard["name"])
+        try:
+            with zipfile.ZipFile(path) as z:
+                error = z.testzip()
+                if error is None and sorted(z.namelist()) != sorted(shard["files"]):
+                    error = "entries not matching the manifest"
+        except (OSError, zipfile.BadZipFile) as e:
+            error = str(e)
+        if error is not None:
+            log.error(f"Bad zip {shard['name']}: {error}")
+            bad.append(shard["name"])
+    return bad
+
+
+def get_report(rows, wall_time, rusage, status, metrics):
+    requests = {}
+    for host, h in metrics.get("hosts", {}).items():
+        count = sum(l["count"] for l in h["latency"].values())
+        latency = sum(l["sum"] for l in h["latency"].values())
+        requests[host] = {
+            "requests": count,
+            "mean_latency": latency / count if count else 0.0,
+            "bytes": h["bytes"],
+            "resumed_bytes": h.get("resumed_bytes", 0),
+            "status": h["status"],
+        }
+
+    return {
+        "status": status,
+        "rows": rows,
+        "wall_time": wall_time,
+        "rows_per_s": rows / wall_time if wall_time else 0.0,
+        "cpu_time": rusage.ru_utime + rusage.ru_stime,
+        "max_rss": metrics.get("max_rss", 0),
+        # ru_maxrss is in kB on Linux
+        "max_rss_with_children": rusage.ru_maxrss * 1024,
+        "dump_syms_max_rss": metrics.get("dump_syms", {}).get("max_rss", 0),
+        "dump_syms_cpu_time": metrics.get("dump_syms", {})
+        .get("cpu_time", {})
+        .get("sum", 0.0),
+        "stages": {
+            name: {
+                k: stage[k]
+                for k in ("wall_time", "busy_time", "utilization", "items", "errors")
+            }
+            for name, stage in metrics.get("stages", {}).items()
+        },
+        "queues": metrics.get("queues", {}),
+        "requests": requests,
+        "retries": metrics.get("retries", {}),
+        "counters": metrics.get("counters", {}),
+    }
+
+
+def format_change(value, baseline):
+    if baseline is None:
+        return ""
+    if not baseline:
+        return "    n/a"
+    return f"{100 * (value - baseline) / baseline:+6.1f}%"
+
+
+def print_report(report, baseline=None):
+    def line(name, value, get, fmt):
+        base = get(baseline) if baseline is not None else None
+        print(f"  {name:<32}{fmt(value):>16} {format_change(value, base)}")
+
+    mb = lambda x: f"{x / 1024 ** 2:.1f} MB"
+    sec = lambda x: f"{x:.2f} s"
+    for name, fmt in (
+        ("rows_per_s", lambda x: f"{x:.1f}"),
+        ("wall_time", sec),
+        ("cpu_time", sec),
+        ("max_rss", mb),
+        ("max_rss_with_children", mb),
+        ("dump_syms_cpu_time", sec),
+        ("dump_syms_max_rss", mb),
+    ):
+        line(name, report[name], lambda r, name=name: r.get(name, 0), fmt)
+
+    for stage, s in report["stages"].items():
+        for key, fmt in (
+            ("wall_time", sec),
+            ("busy_time", sec),
+            ("utilization", lambda x: f"{100 * x:.1f}%"),
+        ):
+            line(
+                f"{stage} {key}",
+                s[key],
+                lambda r, stage=stage, key=key: r.get("stages", {})
+                .get(stage, {})
+                .get(key, 0),
+                fmt,
+            )
+
+    for host, r in report["requests"].items():
+        print(
+            f"  {host}: {r['requests']} requests, {r['mean_latency'] * 1000:.1f} ms on average, {mb(r['bytes'])}"
+        )
+    print(f"  counters: {json.dumps(report['counters'], sort_keys=True)}")
+    if report.get("bad_zips"):
+        print(f"  BAD ZIPS: {', '.join(report['bad_zips'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark symsrv-fetch.py against a fake symbol server",
+        parents=[fake_symbol_server.get_parser(add_help=False)],
+    )
+    parser.set_defaults(port=0)
+    parser.add_argument(
+        "--rows",
+        type=int,
+        help="number of rows of the generated missing symbols CSV (ignored with --missing-symbols)",
+        default=10000,
+    )
+    parser.add_argument(
+        "--unique",
+        type=float,
+        help="fraction of the rows which are distinct modules",
+        default=0.8,
+    )
+    parser.add_argument(
+        "--with-code",
+        type=float,
+        help="fraction of the modules which have a code file and id",
+        default=0.5,
+    )
+    parser.add_argument(
+        "--names",
+        type=int,
+        help="number of distinct debug file names",
+        default=5000,
+    )
+    parser.add_argument(
+        "--runs", type=int, help="number of runs of symsrv-fetch.py", default=1
+    )
+    parser.add_argument(
+        "--warm",
+        action="store_true",
+        help="keep the cache directory from a run to the next one",
+    )
+    parser.add_argument(
+        "--dump-jobs", type=int, help="number of dump_syms to run in parallel"
+    )
+    parser.add_argument(
+        "--zip-jobs", type=int, help="number of symbol files to compress in parallel"
+    )
+    parser.add_argument(
+        "--processes", type=int, help="number of worker processes of symsrv-fetch.py"
+    )
+    parser.add_argument(
+        "--pipe-dumps",
+        action="store_true",
+        help="run symsrv-fetch.py with --pipe-dumps",
+    )
+    parser.add_argument(
+        "-o", "--output", type=str, help="write the report as JSON in this file"
+    )
+    parser.add_argument(
+        "--baseline", type=str, help="report of a previous benchmark to compare with"
+    )
+    parser.add_argument(
+        "--keep", action="store_true", help="keep the work directory"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r") as In:
+            baseline = json.load(In)["runs"][-1]
+
+    work_dir = tempfile.mkdtemp(prefix="symsrv-bench-")
+    log.info(f"Work directory: {work_dir}")
+
+    if not args.missing_symbols:
+        args.missing_symbols = os.path.join(work_dir, "missingsymbols.csv")
+        with open(args.missing_symbols, "w") as Out:
+            Out.write(HEADER + "\n")
+            for line in generate(
+                args.rows, args.unique, args.with_code, args.names, args.seed
+            ):
+                Out.write(line + "\n")
+    rows = count_rows(args.missing_symbols)
+    log.info(f"{rows} rows in {args.missing_symbols}")
+
+    if not args.port:
+        args.port = get_free_port()
+    server = multiprocessing.Process(
+        target=fake_symbol_server.run, args=(args, None), daemon=True
+    )
+    server.start()
+
+    extra_args = []
+    if args.dump_jobs:
+        extra_args += ["--dump-jobs", str(args.dump_jobs)]
+    if args.zip_jobs:
+        extra_args += ["--zip-jobs", str(args.zip_jobs)]
+    if args.processes:
+        extra_args += ["--processes", str(args.processes)]
+    if args.pipe_dumps:
+        extra_args += ["--pipe-dumps"]
+
+    runs = []
+    try:
+        wait_for_server(args.port)
+        for i in range(args.runs):
+            run_dir = os.path.join(work_dir, f"run-{i}")
+            os.makedirs(run_dir)
+            cache_dir = os.path.join(work_dir, "cache" if args.warm else f"cache-{i}")
+            log.info(f"Run {i + 1}/{args.runs}")
+            report = get_report(
+                rows,
+                *run_symsrv_fetch(
+                    args.port, run_dir, cache_dir, extra_args, args.x86_64_rate
+                ),
+            )
+            report["bad_zips"] = check_zips(run_dir)
+            runs.append(report)
+            print(f"Run {i + 1}/{args.runs}:")
+            print_report(report, baseline)
+    finally:
+        server.terminate()
+        server.join()
+        if not args.keep:
+            shutil.rmtree(work_dir, True)
+
+    if args.output:
+        with open(args.output, "w") as Out:
+            json.dump(
+                {"args": vars(args), "runs": runs},
+                Out,
+                indent=2,
+            )
+        log.info(f"Wrote the report as {args.output}")
+
+    return 0 if all(r["status"] == 0 and not r["bad_zips"] for r in runs) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
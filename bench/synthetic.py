@@ -0,0 +1,168 @@
+#
+# Copyright 2016 Mozilla
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Synthetic symbols shared by the fake symbol server, the missing symbols
+# generator and the fake dump_syms, so that they agree without talking to
+# each other: everything is derived from a hash of the file paths.
+
+import hashlib
+import struct
+import zlib
+
+
+PDB_BLOCK_SIZE = 4096
+MACHINE_X86 = 0x14C
+MACHINE_AMD64 = 0x8664
+
+
+def get_fraction(*parts):
+    """
+    Get a number in [0, 1) deterministically derived from parts.
+    """
+    h = hashlib.sha1("/".join(parts).encode("utf-8")).digest()
+    return int.from_bytes(h[:8], "big") / 2 ** 64
+
+
+def get_debug_id(code_file, code_id):
+    """
+    Get the debug id of the pdb of the binary code_file/code_id.
+    A real dump_syms reads it in the binary, here it's derived from its id.
+    """
+    h = hashlib.sha1(f"{code_file}/{code_id}".encode("utf-8")).hexdigest()
+    return h[:32].upper() + "1"
+
+
+def get_debug_file(code_file):
+    return code_file.rsplit(".", 1)[0] + ".pdb"
+
+
+def get_size(mean, *parts):
+    """
+    Get a size around mean (between mean / 2 and 3 * mean / 2).
+    """
+    return int(mean * (0.5 + get_fraction("size", *parts)))
+
+
+def is_x86_64(debug_file, debug_id, rate):
+    """
+    Check if the module is for x86_64 (a fraction rate of them are).
+    """
+    return get_fraction("arch", debug_file, debug_id) < rate
+
+
+def parse_debug_id(debug_id):
+    """
+    Get the (guid, age) of a debug id (the guid with its first three fields
+    in little endian, like in the files).
+    """
+    guid = bytes.fromhex(debug_id[:32])
+    guid = guid[3::-1] + guid[5:3:-1] + guid[7:5:-1] + guid[8:]
+    return guid, int(debug_id[32:] or "0", 16)
+
+
+def get_pdb_head(debug_id, machine, size):
+    """
+    Get the first blocks of a pdb of size bytes (the rest is zeros): the MSF
+    superblock, the block map, the stream directory, the PDB info stream and
+    the header of the DBI stream.
+    """
+    guid, age = parse_debug_id(debug_id)
+    # Streams: old directory, PDB info (block 5), TPI, DBI (block 6)
+    directory = struct.pack("<5I", 4, 0, 28, 0, 64) + struct.pack("<2I", 5, 6)
+    blocks = [
+        b"Microsoft C/C++ MSF 7.00\r\n\x1aDS\x00\x00\x00"
+        + struct.pack("<6I", PDB_BLOCK_SIZE, 1, size // PDB_BLOCK_SIZE, len(directory), 0, 3),
+        # free block maps
+        b"",
+        b"",
+        struct.pack("<I", 4),
+        directory,
+        struct.pack("<3I", 20000404, 0, age) + guid,
+        struct.pack("<iII", -1, 19990903, age) + bytes(46) + struct.pack("<HI", machine, 0),
+    ]
+    return b"".join(block.ljust(PDB_BLOCK_SIZE, b"\x00") for block in blocks)
+
+
+def get_pe_head(code_id, machine, debug_file, debug_id):
+    """
+    Get the headers of a binary: the DOS and PE headers with a section
+    containing the debug directory and its CodeView record.
+    """
+    timestamp, image_size = int(code_id[:8], 16), int(code_id[8:], 16)
+    pe32_plus = machine != MACHINE_X86
+    optional_size = 240 if pe32_plus else 224
+    section_offset = 0x400
+    guid, age = parse_debug_id(debug_id)
+    codeview = b"RSDS" + guid + struct.pack("<I", age) + debug_file.encode() + b"\x00"
+
+    optional = bytearray(optional_size)
+    struct.pack_into("<H", optional, 0, 0x20B if pe32_plus else 0x10B)
+    struct.pack_into("<I", optional, 56, image_size)
+    directories = 108 if pe32_plus else 92
+    struct.pack_into("<I", optional, directories, 16)
+    # debug directory
+    struct.pack_into("<II", optional, directories + 4 + 8 * 6, 0x1000, 28)
+
+    head = bytearray(section_offset + 28 + len(codeview))
+    head[:2] = b"MZ"
+    struct.pack_into("<I", head, 0x3C, 64)
+    head[64:88] = b"PE\x00\x00" + struct.pack(
+        "<HHIIIHH", machine, 1, timestamp, 0, 0, optional_size, 0x2022
+    )
+    head[88 : 88 + optional_size] = optional
+    struct.pack_into(
+        "<8sIIII", head, 88 + optional_size, b".rdata", 0x1000, 0x1000, 0x200, section_offset
+    )
+    struct.pack_into(
+        "<IIHHIIII",
+        head,
+        section_offset,
+        0,
+        timestamp,
+        0,
+        0,
+        2,
+        len(codeview),
+        0x1000 + 28,
+        section_offset + 28,
+    )
+    head[section_offset + 28 :] = codeview
+    return bytes(head.ljust(section_offset + 0x200, b"\x00"))
+
+
+def get_cab(name, data, block_size=32 * 1024):
+    """
+    Get a cabinet containing the file name with data, compressed with MSZIP
+    like the compressed variants of the files of Microsoft's symbol server.
+    """
+    blocks = []
+    window = b""
+    for i in range(0, len(data), block_size):
+        chunk = data[i : i + block_size]
+        # Each block is a raw deflate stream with the previous data as dictionary.
+        c = zlib.compressobj(6, zlib.DEFLATED, -15, zdict=window)
+        compressed = b"CK" + c.compress(chunk) + c.flush()
+        blocks.append(struct.pack("<IHH", 0, len(compressed), len(chunk)) + compressed)
+        window = (window + chunk)[-block_size:]
+
+    entry = struct.pack("<IIHHHH", len(data), 0, 0, 0, 0, 0) + name.encode() + b"\x00"
+    files_offset = 36 + 8
+    data_offset = files_offset + len(entry)
+    size = data_offset + sum(len(b) for b in blocks)
+    header = b"MSCF" + struct.pack(
+        "<IIIIIBBHHHHH", 0, size, 0, files_offset, 0, 3, 1, 1, 1, 0, 0, 0
+    )
+    folder = struct.pack("<IHH", data_offset, len(blocks), 1)
+    return header + folder + entry + b"".join(blocks)
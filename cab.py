@@ -0,0 +1,195 @@
+#
+# Copyright 2016 Mozilla
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Extraction of the cabinets served by Microsoft's symbol server for the
+# compressed variants of the files (foo.pd_ for foo.pdb, foo.dl_ for
+# foo.dll). They contain a single file, stored or compressed with MSZIP
+# (deflate) which are extracted here; the other compressions (LZX, Quantum)
+# are left to cabextract when it's installed.
+#
+# The extraction is CPU bound, so symsrv-fetch.py runs it in a process pool.
+
+import os
+import shutil
+import struct
+import subprocess
+import zlib
+from collections import namedtuple
+
+
+CAB_MAGIC = b"MSCF"
+HEADER_SIZE = 36
+FLAG_PREV_CABINET = 0x1
+FLAG_NEXT_CABINET = 0x2
+FLAG_RESERVE_PRESENT = 0x4
+# Files continued from or to another cabinet have a special folder index
+FOLDER_CONTINUED = 0xFFFD
+COMPRESS_NONE = 0
+COMPRESS_MSZIP = 1
+COMPRESSIONS = {0: "none", 1: "MSZIP", 2: "Quantum", 3: "LZX"}
+# Each MSZIP block is a deflate stream using the end of the previous one
+# as dictionary.
+MSZIP_WINDOW = 32 * 1024
+MAX_NAME_SIZE = 256
+
+CabFolder = namedtuple("CabFolder", ["offset", "blocks", "compression"])
+CabEntry = namedtuple("CabEntry", ["name", "size", "offset", "folder"])
+
+
+class CabError(Exception):
+    """
+    The cabinet is corrupt, truncated or not supported.
+    """
+
+
+def read_at(f, offset, size):
+    f.seek(offset)
+    data = f.read(size)
+    if len(data) != size:
+        raise CabError(f"Truncated cabinet: {size} bytes expected at {offset}")
+    return data
+
+
+def get_cab_name(path):
+    """
+    Get the name of the compressed variant of a file (foo.pd_ for foo.pdb).
+    """
+    return path[:-1] + "_"
+
+
+def read_cab(f):
+    """
+    Read the folders and the files of the cabinet f (opened in binary mode)
+    and return (folders, files, size of the reserved area of the data blocks).
+    """
+    header = read_at(f, 0, HEADER_SIZE)
+    if not header.startswith(CAB_MAGIC):
+        raise CabError("Not a cabinet")
+    (files_offset,) = struct.unpack_from("<I", header, 16)
+    folder_count, file_count, flags = struct.unpack_from("<HHH", header, 26)
+    if flags & (FLAG_PREV_CABINET | FLAG_NEXT_CABINET):
+        raise CabError("Multi-cabinet files aren't supported")
+
+    offset = HEADER_SIZE
+    folder_reserve = data_reserve = 0
+    if flags & FLAG_RESERVE_PRESENT:
+        header_reserve, folder_reserve, data_reserve = struct.unpack(
+            "<HBB", read_at(f, offset, 4)
+        )
+        offset += 4 + header_reserve
+
+    folders = []
+    for _ in range(folder_count):
+        start, blocks, compression = struct.unpack("<IHH", read_at(f, offset, 8))
+        folders.append(CabFolder(start, blocks, compression & 0xF))
+        offset += 8 + folder_reserve
+
+    files = []
+    offset = files_offset
+    for _ in range(file_count):
+        size, folder_offset, folder = struct.unpack("<IIH", read_at(f, offset, 10))
+        f.seek(offset + 16)
+        name, sep, _ = f.read(MAX_NAME_SIZE).partition(b"\x00")
+        if not sep:
+            raise CabError("Invalid file name")
+        if folder >= FOLDER_CONTINUED:
+            raise CabError("Multi-cabinet files aren't supported")
+        if folder >= len(folders):
+            raise CabError(f"Invalid folder {folder}")
+        files.append(
+            CabEntry(name.decode("utf-8", errors="replace"), size, folder_offset, folder)
+        )
+        offset += 16 + len(name) + 1
+
+    return folders, files, data_reserve
+
+
+def iter_folder(f, folder, data_reserve):
+    """
+    Yield the uncompressed data of the blocks of the folder.
+    """
+    offset = folder.offset
+    window = b""
+    for _ in range(folder.blocks):
+        _, size, uncompressed_size = struct.unpack("<IHH", read_at(f, offset, 8))
+        data = read_at(f, offset + 8 + data_reserve, size)
+        offset += 8 + data_reserve + size
+        if folder.compression == COMPRESS_MSZIP:
+            if not data.startswith(b"CK"):
+                raise CabError("Invalid MSZIP block")
+            try:
+                data = zlib.decompressobj(-15, zdict=window).decompress(data[2:])
+            except zlib.error as e:
+                raise CabError(f"Invalid MSZIP block: {e}")
+            window = (window + data)[-MSZIP_WINDOW:]
+        if len(data) != uncompressed_size:
+            raise CabError("Invalid block size")
+        yield data
+
+
+def extract_with_cabextract(path, name, output_path, compression):
+    cabextract = shutil.which("cabextract")
+    if cabextract is None:
+        typ = COMPRESSIONS.get(compression, compression)
+        raise CabError(f"Unsupported compression {typ} (cabextract isn't installed)")
+    with open(output_path, "wb") as Out:
+        proc = subprocess.run(
+            [cabextract, "-q", "-p", "-F", name, path],
+            stdout=Out,
+            stderr=subprocess.PIPE,
+        )
+    if proc.returncode:
+        raise CabError(f"cabextract failed: {proc.stderr.decode().strip()}")
+
+
+def extract_cab(path, output_path):
+    """
+    Extract the file of the cabinet path in output_path: the one with the
+    same name as output_path or else the first one. output_path is written
+    only once the extraction succeeded.
+    """
+    name = os.path.basename(output_path).lower()
+    tmp_path = output_path + ".tmp"
+    try:
+        with open(path, "rb") as f:
+            folders, files, data_reserve = read_cab(f)
+            if not files:
+                raise CabError("Empty cabinet")
+            entry = next((e for e in files if e.name.lower() == name), files[0])
+            folder = folders[entry.folder]
+
+            if folder.compression not in {COMPRESS_NONE, COMPRESS_MSZIP}:
+                extract_with_cabextract(
+                    path, entry.name, tmp_path, folder.compression
+                )
+            else:
+                # The file is at entry.offset in the uncompressed data of its folder.
+                end = entry.offset + entry.size
+                position = 0
+                with open(tmp_path, "wb") as Out:
+                    for data in iter_folder(f, folder, data_reserve):
+                        start = max(entry.offset - position, 0)
+                        stop = min(end - position, len(data))
+                        if start < stop:
+                            Out.write(data[start:stop])
+                        position += len(data)
+                        if position >= end:
+                            break
+                if position < end:
+                    raise CabError("Truncated folder")
+        os.replace(tmp_path, output_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
@@ -0,0 +1,92 @@
+#
+# Copyright 2016 Mozilla
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Journal of the state of each module in a run of symsrv-fetch.py, so that
+# a run which died partway can be resumed by the next one without redoing
+# the work already done.
+
+import time
+
+from batched_db import BatchedDB
+
+
+PROBED = "probed"
+FETCHED = "fetched"
+DUMPED = "dumped"
+ZIPPED = "zipped"
+
+
+class Journal:
+    def __init__(self, path):
+        self.db = BatchedDB(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS modules ("
+            "filename TEXT NOT NULL, "
+            "debug_id TEXT NOT NULL, "
+            "code_file TEXT, "
+            "code_id TEXT, "
+            "has_code INTEGER NOT NULL, "
+            "state TEXT NOT NULL, "
+            "sym_path TEXT, "
+            "updated REAL NOT NULL, "
+            "PRIMARY KEY (filename, debug_id)"
+            ") WITHOUT ROWID"
+        )
+        self.db.commit()
+
+    def get_last_update(self):
+        (updated,) = self.db.execute("SELECT MAX(updated) FROM modules").fetchone()
+        return updated
+
+    def get(self, filename, debug_id):
+        """
+        Get (state, has_code, sym_path) for the module or None if we know nothing about it.
+        """
+        row = self.db.execute(
+            "SELECT state, has_code, sym_path FROM modules WHERE filename = ? AND debug_id = ?",
+            (filename, debug_id),
+        ).fetchone()
+        if row is None:
+            return None
+        state, has_code, sym_path = row
+        return state, bool(has_code), sym_path
+
+    def set(self, module, state, sym_path=None):
+        filename, debug_id, code_file, code_id, has_code = module
+        self.db.write(
+            "INSERT OR REPLACE INTO modules VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                filename,
+                debug_id,
+                code_file,
+                code_id,
+                int(bool(has_code)),
+                state,
+                sym_path,
+                time.time(),
+            ),
+        )
+
+    def remove(self, filename, debug_id):
+        self.db.write(
+            "DELETE FROM modules WHERE filename = ? AND debug_id = ?",
+            (filename, debug_id),
+        )
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,402 @@
+#
+# Copyright 2016 Mozilla
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Metrics of a run of symsrv-fetch.py: time spent in each stage of the
+# pipeline, latency of the requests to each host, bytes downloaded, retries,
+# resources used by dump_syms and depth of the queues between the stages.
+#
+# They're written as JSON at the end of the run and optionally in the
+# Prometheus text format (e.g. for the node exporter textfile collector).
+
+import asyncio
+import heapq
+import json
+import logging
+import resource
+import time
+from collections import defaultdict
+
+
+log = logging.getLogger()
+
+# Upper bounds in seconds of the buckets of the latency histograms
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, float("inf"))
+# Upper bounds in seconds of the buckets of the dump_syms cpu time histogram
+CPU_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, float("inf"))
+# Number of modules kept for the list of the most expensive dumps
+TOP_DUMPS = 20
+# Seconds between two samples of the queue depths
+QUEUE_SAMPLE_INTERVAL = 1.0
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def to_json(self):
+        return {
+            "buckets": {str(b): c for b, c in zip(self.buckets, self.counts)},
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "max": self.max,
+        }
+
+    def to_prometheus(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else str(bound)
+            lines.append(f"{name}_bucket{format_labels(labels, le=le)} {cumulative}")
+        lines.append(f"{name}_sum{format_labels(labels)} {self.sum}")
+        lines.append(f"{name}_count{format_labels(labels)} {self.count}")
+        return lines
+
+
+class StageMetrics:
+    """
+    Timing of a stage of the pipeline: its wall time (from its start to the
+    end of its last worker) and the time spent by the workers on the items.
+    The items dropped when the run is stopped before its deadline are counted
+    apart.
+    """
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.start = None
+        self.end = None
+        self.first_item = None
+        self.busy = 0.0
+        self.items = 0
+        self.errors = 0
+        self.dropped = 0
+        self.item_time = Histogram(LATENCY_BUCKETS)
+
+    def started(self):
+        self.start = time.monotonic()
+
+    def finished(self):
+        self.end = time.monotonic()
+
+    def observe(self, duration, error=False):
+        if self.first_item is None:
+            self.first_item = time.monotonic() - duration
+        self.busy += duration
+        self.items += 1
+        if error:
+            self.errors += 1
+        self.item_time.observe(duration)
+
+    def drop(self):
+        self.dropped += 1
+
+    def get_wall_time(self):
+        if self.start is None:
+            return 0.0
+        return (self.end or time.monotonic()) - self.start
+
+    def to_json(self):
+        wall = self.get_wall_time()
+        return {
+            "workers": self.workers,
+            "wall_time": wall,
+            "idle_before_first_item": (self.first_item or self.start or 0) - (self.start or 0),
+            "busy_time": self.busy,
+            "utilization": self.busy / (wall * self.workers) if wall and self.workers else 0.0,
+            "items": self.items,
+            "errors": self.errors,
+            "dropped": self.dropped,
+            "item_time": self.item_time.to_json(),
+        }
+
+
+class QueueMetrics:
+    def __init__(self):
+        self.samples = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, depth):
+        self.samples += 1
+        self.sum += depth
+        self.max = max(self.max, depth)
+
+    def to_json(self):
+        return {
+            "samples": self.samples,
+            "mean": self.sum / self.samples if self.samples else 0.0,
+            "max": self.max,
+        }
+
+
+class RetryMetrics:
+    """
+    Number of retries needed by the calls of a function which retries requests.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.retries = 0
+        self.gave_up = 0
+        self.per_call = defaultdict(int)
+
+    def observe(self, retries, gave_up):
+        self.calls += 1
+        self.retries += retries
+        self.per_call[retries] += 1
+        if gave_up:
+            self.gave_up += 1
+
+    def to_json(self):
+        return {
+            "calls": self.calls,
+            "retries": self.retries,
+            "gave_up": self.gave_up,
+            "per_call": {str(n): c for n, c in sorted(self.per_call.items())},
+        }
+
+
+class HostMetrics:
+    def __init__(self):
+        self.latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.status = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.bytes = 0
+        # Downloads resumed with a Range request and bytes not downloaded again
+        self.resumed = 0
+        self.resumed_bytes = 0
+
+    def to_json(self):
+        return {
+            "latency": {method: h.to_json() for method, h in self.latency.items()},
+            "status": {str(s): n for s, n in sorted(self.status.items())},
+            "errors": dict(self.errors),
+            "bytes": self.bytes,
+            "resumed": self.resumed,
+            "resumed_bytes": self.resumed_bytes,
+        }
+
+
+class Metrics:
+    def __init__(self):
+        self.start = time.time()
+        self.start_monotonic = time.monotonic()
+        self.stages = {}
+        self.queues = defaultdict(QueueMetrics)
+        self.hosts = defaultdict(HostMetrics)
+        self.retries = defaultdict(RetryMetrics)
+        self.dump_cpu = Histogram(CPU_BUCKETS)
+        self.dump_max_rss = 0
+        self.dump_wall = 0.0
+        # Min heap of (cpu time, module, ...) of the most expensive dumps
+        self.top_dumps = []
+        self.extra = {}
+
+    def stage(self, name, workers):
+        stage = self.stages[name] = StageMetrics(name, workers)
+        return stage
+
+    def observe_request(self, host, method, status, latency):
+        host = self.hosts[host]
+        host.latency[method].observe(latency)
+        host.status[status] += 1
+
+    def observe_request_error(self, host, method, reason):
+        self.hosts[host].errors[reason] += 1
+
+    def add_bytes(self, host, size):
+        self.hosts[host].bytes += size
+
+    def add_resumed(self, host, size):
+        """
+        Record a download resumed after size bytes.
+        """
+        h = self.hosts[host]
+        h.resumed += 1
+        h.resumed_bytes += size
+
+    def observe_retries(self, kind, retries, gave_up=False):
+        """
+        Record the number of retries needed by a call of kind (e.g. the
+        function doing the requests).
+        """
+        self.retries[kind].observe(retries, gave_up)
+
+    def observe_dump(self, module, wall, cpu, max_rss):
+        """
+        Record the resources used by dump_syms for module: cpu time in
+        seconds and peak resident memory in bytes.
+        """
+        self.dump_cpu.observe(cpu)
+        self.dump_wall += wall
+        self.dump_max_rss = max(self.dump_max_rss, max_rss)
+        entry = (cpu, module, wall, max_rss)
+        if len(self.top_dumps) < TOP_DUMPS:
+            heapq.heappush(self.top_dumps, entry)
+        elif entry > self.top_dumps[0]:
+            heapq.heapreplace(self.top_dumps, entry)
+
+    async def sample_queues(self, queues):
+        """
+        Sample the depth of the queues (a dict name -> queue) until cancelled.
+        """
+        while True:
+            for name, queue in queues.items():
+                self.queues[name].observe(queue.qsize())
+            await asyncio.sleep(QUEUE_SAMPLE_INTERVAL)
+
+    def to_json(self):
+        return {
+            "start": self.start,
+            "wall_time": time.monotonic() - self.start_monotonic,
+            "max_rss": get_max_rss(),
+            "stages": {name: s.to_json() for name, s in self.stages.items()},
+            "queues": {name: q.to_json() for name, q in self.queues.items()},
+            "hosts": {name: h.to_json() for name, h in self.hosts.items()},
+            "retries": {kind: r.to_json() for kind, r in self.retries.items()},
+            "dump_syms": {
+                "wall_time": self.dump_wall,
+                "cpu_time": self.dump_cpu.to_json(),
+                "max_rss": self.dump_max_rss,
+                "top": [
+                    {"module": module, "cpu_time": cpu, "wall_time": wall, "max_rss": rss}
+                    for cpu, module, wall, rss in sorted(self.top_dumps, reverse=True)
+                ],
+            },
+            **self.extra,
+        }
+
+    def to_prometheus(self):
+        prefix = "symsrv_fetch"
+        lines = [
+            f"# TYPE {prefix}_start_time_seconds gauge",
+            f"{prefix}_start_time_seconds {self.start}",
+            f"# TYPE {prefix}_wall_time_seconds gauge",
+            f"{prefix}_wall_time_seconds {time.monotonic() - self.start_monotonic}",
+            f"# TYPE {prefix}_max_rss_bytes gauge",
+            f"{prefix}_max_rss_bytes {get_max_rss()}",
+        ]
+
+        stages = [(format_labels({"stage": n}), s) for n, s in self.stages.items()]
+        for metric, get in (
+            ("stage_wall_time_seconds", lambda s: s.get_wall_time()),
+            ("stage_busy_time_seconds", lambda s: s.busy),
+            ("stage_workers", lambda s: s.workers),
+            ("stage_items", lambda s: s.items),
+            ("stage_errors", lambda s: s.errors),
+            ("stage_dropped", lambda s: s.dropped),
+        ):
+            lines.append(f"# TYPE {prefix}_{metric} gauge")
+            lines += [f"{prefix}_{metric}{labels} {get(s)}" for labels, s in stages]
+
+        queues = [(format_labels({"queue": n}), q) for n, q in self.queues.items()]
+        for metric, get in (
+            ("queue_depth_max", lambda q: q.max),
+            ("queue_depth_mean", lambda q: q.to_json()["mean"]),
+        ):
+            lines.append(f"# TYPE {prefix}_{metric} gauge")
+            lines += [f"{prefix}_{metric}{labels} {get(q)}" for labels, q in queues]
+
+        lines.append(f"# TYPE {prefix}_request_duration_seconds histogram")
+        for host, h in self.hosts.items():
+            for method, histogram in h.latency.items():
+                lines += histogram.to_prometheus(
+                    f"{prefix}_request_duration_seconds",
+                    {"host": host, "method": method},
+                )
+        lines.append(f"# TYPE {prefix}_responses counter")
+        for host, h in self.hosts.items():
+            for status, n in sorted(h.status.items()):
+                labels = format_labels({"host": host, "status": status})
+                lines.append(f"{prefix}_responses{labels} {n}")
+        lines.append(f"# TYPE {prefix}_request_errors counter")
+        for host, h in self.hosts.items():
+            for reason, n in h.errors.items():
+                labels = format_labels({"host": host, "reason": reason})
+                lines.append(f"{prefix}_request_errors{labels} {n}")
+        lines.append(f"# TYPE {prefix}_downloaded_bytes counter")
+        for host, h in self.hosts.items():
+            lines.append(f"{prefix}_downloaded_bytes{format_labels({'host': host})} {h.bytes}")
+        lines.append(f"# TYPE {prefix}_resumed_downloads counter")
+        for host, h in self.hosts.items():
+            lines.append(f"{prefix}_resumed_downloads{format_labels({'host': host})} {h.resumed}")
+        lines.append(f"# TYPE {prefix}_resumed_bytes counter")
+        for host, h in self.hosts.items():
+            lines.append(f"{prefix}_resumed_bytes{format_labels({'host': host})} {h.resumed_bytes}")
+
+        for metric, get in (
+            ("retry_calls", lambda r: r.calls),
+            ("retries", lambda r: r.retries),
+            ("retry_gave_up", lambda r: r.gave_up),
+        ):
+            lines.append(f"# TYPE {prefix}_{metric} counter")
+            for kind, r in self.retries.items():
+                lines.append(f"{prefix}_{metric}{format_labels({'kind': kind})} {get(r)}")
+
+        lines.append(f"# TYPE {prefix}_dump_syms_cpu_seconds histogram")
+        lines += self.dump_cpu.to_prometheus(f"{prefix}_dump_syms_cpu_seconds", {})
+        lines.append(f"# TYPE {prefix}_dump_syms_max_rss_bytes gauge")
+        lines.append(f"{prefix}_dump_syms_max_rss_bytes {self.dump_max_rss}")
+
+        for name, values in self.extra.items():
+            lines.append(f"# TYPE {prefix}_{name} gauge")
+            for key, value in values.items():
+                labels = format_labels({"name": key})
+                lines.append(f"{prefix}_{name}{labels} {value}")
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, path, prometheus_path=None):
+        with open(path, "w") as Out:
+            json.dump(self.to_json(), Out, indent=2)
+        log.info(f"Wrote metrics as {path}")
+
+        if prometheus_path:
+            with open(prometheus_path, "w") as Out:
+                Out.write(self.to_prometheus())
+            log.info(f"Wrote Prometheus metrics as {prometheus_path}")
+
+
+def get_max_rss():
+    """
+    Get the peak resident memory of this process in bytes (ru_maxrss is in kB on Linux).
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def format_labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ""
+    values = ",".join(
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in labels.items()
+    )
+    return "{" + values + "}"
@@ -0,0 +1,271 @@
+#
+# Copyright 2016 Mozilla
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Minimal readers for the headers of the files downloaded from Microsoft's
+# symbol server, to check them before running dump_syms:
+#  - PE binaries (.dll, .exe): machine, code id and the CodeView record of
+#    the debug directory (debug file and debug id of the pdb);
+#  - PDB (MSF 7.00): the stream directory, the PDB info stream (guid, age)
+#    and the header of the DBI stream (age, machine).
+# Only the few blocks needed are read, so it's cheap even for huge files.
+
+import os
+import struct
+from collections import namedtuple
+
+
+MSF_MAGIC = b"Microsoft C/C++ MSF 7.00\r\n\x1aDS\x00\x00\x00"
+# Streams of a PDB
+PDB_INFO_STREAM = 1
+DBI_STREAM = 3
+NIL_STREAM_SIZE = 0xFFFFFFFF
+# Debug directory entry type of the CodeView record
+DEBUG_TYPE_CODEVIEW = 2
+DEBUG_DIRECTORY = 6
+
+MACHINES = {
+    0x14C: "x86",
+    0x8664: "x86_64",
+    0x1C4: "arm",
+    0xAA64: "arm64",
+}
+
+PdbInfo = namedtuple("PdbInfo", ["debug_id", "arch"])
+PeInfo = namedtuple("PeInfo", ["code_id", "arch", "debug_file", "debug_id"])
+
+
+class FormatError(Exception):
+    """
+    The file is corrupt or truncated.
+    """
+
+
+def read_at(f, offset, size):
+    f.seek(offset)
+    data = f.read(size)
+    if len(data) != size:
+        raise FormatError(f"Truncated file: {size} bytes expected at {offset}")
+    return data
+
+
+def format_debug_id(guid, age):
+    """
+    Format the debug id like Breakpad does: the guid (with its first three
+    fields in little endian) followed by the age.
+    """
+    data1, data2, data3 = struct.unpack_from("<IHH", guid)
+    return f"{data1:08X}{data2:04X}{data3:04X}{guid[8:].hex().upper()}{age:X}"
+
+
+def get_arch(machine):
+    """
+    Get the architecture of a machine type (None if it's unknown).
+    """
+    return MACHINES.get(machine)
+
+
+class MsfFile:
+    def __init__(self, f):
+        """
+        Read the stream directory of the MSF file f (opened in binary mode).
+        """
+        self.f = f
+        header = read_at(f, 0, 56)
+        if not header.startswith(MSF_MAGIC):
+            raise FormatError("Not a MSF 7.00 file")
+        (
+            self.block_size,
+            _,
+            self.block_count,
+            directory_size,
+            _,
+            block_map_addr,
+        ) = struct.unpack_from("<6I", header, 32)
+        if self.block_size not in {512, 1024, 2048, 4096, 8192, 16384, 32768}:
+            raise FormatError(f"Invalid block size {self.block_size}")
+        file_size = os.fstat(f.fileno()).st_size
+        if file_size < self.block_count * self.block_size:
+            raise FormatError(
+                f"Truncated file: {file_size} bytes for {self.block_count} blocks"
+            )
+
+        # The block map is a block listing the blocks of the stream directory.
+        count = self.get_block_count(directory_size)
+        if 4 * count > self.block_size:
+            raise FormatError(f"Invalid stream directory size {directory_size}")
+        directory_blocks = struct.unpack(
+            f"<{count}I", self.read_blocks([block_map_addr], 4 * count)
+        )
+        directory = self.read_blocks(directory_blocks, directory_size)
+        if len(directory) < 4:
+            raise FormatError("Invalid stream directory")
+        (stream_count,) = struct.unpack_from("<I", directory)
+        if 4 + 4 * stream_count > len(directory):
+            raise FormatError(f"Invalid number of streams {stream_count}")
+        sizes = struct.unpack_from(f"<{stream_count}I", directory, 4)
+
+        self.streams = []
+        offset = 4 + 4 * stream_count
+        for size in sizes:
+            if size == NIL_STREAM_SIZE:
+                size = 0
+            count = self.get_block_count(size)
+            if offset + 4 * count > len(directory):
+                raise FormatError("Invalid stream directory")
+            blocks = struct.unpack_from(f"<{count}I", directory, offset)
+            offset += 4 * count
+            self.streams.append((size, blocks))
+
+    def get_block_count(self, size):
+        return (size + self.block_size - 1) // self.block_size
+
+    def read_blocks(self, blocks, size):
+        """
+        Read the first size bytes of the data in blocks.
+        """
+        data = []
+        for block in blocks:
+            if block >= self.block_count:
+                raise FormatError(f"Invalid block {block}")
+            n = min(self.block_size, size)
+            if n <= 0:
+                break
+            data.append(read_at(self.f, block * self.block_size, n))
+            size -= n
+        return b"".join(data)
+
+    def read_stream(self, index, size=None):
+        """
+        Read the stream index (only its first size bytes if size isn't None).
+        An empty string is returned for a missing stream.
+        """
+        if index >= len(self.streams):
+            return b""
+        stream_size, blocks = self.streams[index]
+        if size is not None:
+            stream_size = min(stream_size, size)
+        return self.read_blocks(blocks, stream_size)
+
+
+def read_pdb_info(path):
+    """
+    Get the debug id and the architecture (None if unknown) of a pdb.
+    """
+    with open(path, "rb") as f:
+        msf = MsfFile(f)
+        info = msf.read_stream(PDB_INFO_STREAM, 28)
+        if len(info) < 28:
+            raise FormatError("Invalid PDB info stream")
+        (age,) = struct.unpack_from("<I", info, 8)
+        guid = info[12:28]
+
+        arch = None
+        # The age in the DBI stream is the one in the binaries (and in the
+        # symbol server paths).
+        dbi = msf.read_stream(DBI_STREAM, 64)
+        if len(dbi) >= 64:
+            signature, _, dbi_age = struct.unpack_from("<iII", dbi)
+            if signature == -1:
+                age = dbi_age
+                (machine,) = struct.unpack_from("<H", dbi, 58)
+                arch = get_arch(machine)
+
+    return PdbInfo(format_debug_id(guid, age), arch)
+
+
+def read_pe_info(path):
+    """
+    Get the code id, the architecture (None if unknown), the debug file and
+    the debug id (None if there's no CodeView record) of a PE binary.
+    """
+    with open(path, "rb") as f:
+        dos_header = read_at(f, 0, 64)
+        if not dos_header.startswith(b"MZ"):
+            raise FormatError("Not a PE file")
+        (pe_offset,) = struct.unpack_from("<I", dos_header, 0x3C)
+        header = read_at(f, pe_offset, 24)
+        if not header.startswith(b"PE\x00\x00"):
+            raise FormatError("Invalid PE signature")
+        (
+            machine,
+            section_count,
+            timestamp,
+            _,
+            _,
+            optional_size,
+            _,
+        ) = struct.unpack_from("<HHIIIHH", header, 4)
+
+        optional = read_at(f, pe_offset + 24, optional_size)
+        if len(optional) < 60:
+            raise FormatError("Invalid optional header")
+        (magic,) = struct.unpack_from("<H", optional)
+        if magic == 0x10B:
+            directories = 92
+        elif magic == 0x20B:
+            directories = 108
+        else:
+            raise FormatError(f"Invalid optional header magic {magic:#x}")
+        (image_size,) = struct.unpack_from("<I", optional, 56)
+        code_id = f"{timestamp:08X}{image_size:x}"
+
+        sections = []
+        data = read_at(f, pe_offset + 24 + optional_size, 40 * section_count)
+        file_size = os.fstat(f.fileno()).st_size
+        for i in range(section_count):
+            virtual_size, virtual_address, raw_size, raw_offset = struct.unpack_from(
+                "<IIII", data, 40 * i + 8
+            )
+            if raw_size and raw_offset + raw_size > file_size:
+                raise FormatError(f"Truncated file: section {i} goes past its end")
+            sections.append((virtual_address, max(virtual_size, raw_size), raw_offset))
+
+        debug_file = debug_id = None
+        directory_count = 0
+        if len(optional) >= directories + 4:
+            (directory_count,) = struct.unpack_from("<I", optional, directories)
+        entry = directories + 4 + 8 * DEBUG_DIRECTORY
+        if directory_count > DEBUG_DIRECTORY and len(optional) >= entry + 8:
+            rva, size = struct.unpack_from("<II", optional, entry)
+            offset = get_file_offset(sections, rva)
+            if size and offset is not None:
+                entries = read_at(f, offset, size - size % 28)
+                for i in range(0, len(entries), 28):
+                    typ, data_size, _, data_offset = struct.unpack_from(
+                        "<IIII", entries, i + 12
+                    )
+                    if typ == DEBUG_TYPE_CODEVIEW and data_size >= 24:
+                        record = read_at(f, data_offset, data_size)
+                        if record.startswith(b"RSDS"):
+                            (age,) = struct.unpack_from("<I", record, 20)
+                            debug_id = format_debug_id(record[4:20], age)
+                            name = record[24:].split(b"\x00", 1)[0].decode(
+                                "utf-8", errors="replace"
+                            )
+                            debug_file = name.replace("\\", "/").rsplit("/", 1)[-1]
+                        break
+
+    return PeInfo(code_id, get_arch(machine), debug_file, debug_id)
+
+
+def get_file_offset(sections, rva):
+    """
+    Get the offset in the file of the relative virtual address rva (None if
+    it isn't in a section).
+    """
+    for virtual_address, size, raw_offset in sections:
+        if virtual_address <= rva < virtual_address + size:
+            return raw_offset + rva - virtual_address
+    return None
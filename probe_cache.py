@@ -0,0 +1,125 @@
+#
+# Copyright 2016 Mozilla
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# On-disk cache of the results of the HEAD requests sent to the symbol servers.
+#
+# A symbol on the Mozilla symbol server never goes away, so positive answers
+# from it are kept forever. Answers from Microsoft's symbol server (and in
+# particular the negative ones) can change, so they expire after a TTL.
+# Negative answers from the Mozilla server aren't cached at all: they're the
+# ones we're going to fix by uploading the symbols.
+
+import logging
+import os
+import time
+
+from batched_db import BatchedDB
+
+
+log = logging.getLogger()
+
+
+class ProbeCache:
+    def __init__(self, path, ttl, max_size):
+        """
+        Open (or create) the cache in path. ttl is the time in seconds after which
+        an answer from Microsoft's server has to be checked again and max_size
+        the max number of entries to keep. The cache can be shared by several
+        processes.
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+        self.db = BatchedDB(path, buffered=True)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS probes ("
+            "server TEXT NOT NULL, "
+            "path TEXT NOT NULL, "
+            "result INTEGER NOT NULL, "
+            "checked REAL NOT NULL, "
+            "used REAL NOT NULL, "
+            "PRIMARY KEY (server, path)"
+            ") WITHOUT ROWID"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS probes_used ON probes (used)")
+        self.db.commit()
+
+    @staticmethod
+    def is_permanent(server, result):
+        return result and "mozilla" in server
+
+    def get(self, server, path):
+        """
+        Get the cached answer for this file or None when we need to ask the server.
+        """
+        row = self.db.execute(
+            "SELECT result, checked FROM probes WHERE server = ? AND path = ?",
+            (server, path),
+        ).fetchone()
+        now = time.time()
+        if row is not None:
+            result, checked = bool(row[0]), row[1]
+            if self.is_permanent(server, result) or now - checked < self.ttl:
+                self.hits += 1
+                self.db.write(
+                    "UPDATE probes SET used = ? WHERE server = ? AND path = ?",
+                    (now, server, path),
+                )
+                return result
+
+        self.misses += 1
+        return None
+
+    def put(self, server, path, result):
+        if not result and "mozilla" in server:
+            return
+
+        now = time.time()
+        self.db.write(
+            "INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?, ?)",
+            (server, path, int(result), now, now),
+        )
+
+    def evict(self):
+        """
+        Remove the expired answers and then the least recently used ones
+        to keep the cache under max_size entries.
+        """
+        expired = time.time() - self.ttl
+        self.db.execute(
+            "DELETE FROM probes WHERE checked < ? AND NOT (result = 1 AND server LIKE '%mozilla%')",
+            (expired,),
+        )
+        (size,) = self.db.execute("SELECT COUNT(*) FROM probes").fetchone()
+        if size > self.max_size:
+            self.db.execute(
+                "DELETE FROM probes WHERE (server, path) IN "
+                "(SELECT server, path FROM probes ORDER BY used LIMIT ?)",
+                (size - self.max_size,),
+            )
+            log.debug(f"Evicted {size - self.max_size} entries from the probe cache")
+        self.db.commit()
+
+    def close(self, evict=True):
+        if evict:
+            self.evict()
+        self.db.close()
+        log.info(f"Probe cache: {self.hits} hits, {self.misses} misses")
@@ -0,0 +1,217 @@
+#
+# Copyright 2016 Mozilla
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Per-host adaptive rate limiting for an aiohttp ClientSession.
+#
+# Each host has its own concurrency budget and token bucket. Both are
+# increased additively while the host answers quickly and halved when it
+# throttles us (429), fails (5xx) or resets the connection, like TCP
+# congestion control does.
+
+import asyncio
+import logging
+import time
+from urllib.parse import urlsplit
+
+
+log = logging.getLogger()
+
+
+class HostLimits:
+    def __init__(
+        self, concurrency, max_concurrency, rate, max_rate, target_latency=2.0
+    ):
+        """
+        concurrency and rate (requests per second) are the initial values,
+        they're never increased above max_concurrency and max_rate.
+        The limits are only increased when the responses come in less than
+        target_latency seconds.
+        """
+        self.concurrency = concurrency
+        self.max_concurrency = max_concurrency
+        self.rate = rate
+        self.max_rate = max_rate
+        self.target_latency = target_latency
+
+    def split(self, n):
+        """
+        Get the limits of one of n clients sharing these ones (e.g. one per process).
+        """
+        return HostLimits(
+            max(1, self.concurrency // n),
+            max(1, self.max_concurrency // n),
+            self.rate / n,
+            self.max_rate / n,
+            self.target_latency,
+        )
+
+
+class HostLimiter:
+    # Min number of seconds between two decreases of the limits,
+    # to avoid collapsing them on a burst of errors.
+    COOLDOWN = 1.0
+    MIN_RATE = 1.0
+
+    def __init__(self, host, limits):
+        self.host = host
+        self.limits = limits
+        self.concurrency = float(limits.concurrency)
+        self.rate = float(limits.rate)
+        self.tokens = self.rate
+        self.last_refill = time.monotonic()
+        self.last_decrease = 0
+        self.active = 0
+        self.cond = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.cond:
+            await self.cond.wait_for(lambda: self.active < int(self.concurrency))
+            self.active += 1
+
+        # Token bucket: the bucket holds at most one second of requests.
+        while True:
+            now = time.monotonic()
+            self.tokens = min(
+                self.rate, self.tokens + (now - self.last_refill) * self.rate
+            )
+            self.last_refill = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    async def release(self):
+        async with self.cond:
+            self.active -= 1
+            self.cond.notify_all()
+
+    def on_success(self, latency):
+        if latency >= self.limits.target_latency:
+            return
+        self.concurrency = min(
+            self.limits.max_concurrency, self.concurrency + 1 / self.concurrency
+        )
+        self.rate = min(self.limits.max_rate, self.rate + 1 / self.rate)
+
+    def on_error(self, reason):
+        now = time.monotonic()
+        if now - self.last_decrease < self.COOLDOWN:
+            return
+        self.last_decrease = now
+        self.concurrency = max(1.0, self.concurrency / 2)
+        self.rate = max(self.MIN_RATE, self.rate / 2)
+        self.tokens = min(self.tokens, self.rate)
+        log.warning(
+            f"{reason} from {self.host}: slow down to {int(self.concurrency)} connections and {self.rate:.1f} requests/s"
+        )
+
+    def report(self, status, latency):
+        if status == 429 or status >= 500:
+            self.on_error(f"Status {status}")
+        else:
+            self.on_success(latency)
+
+
+class RequestContextManager:
+    def __init__(self, limiter, ctx, method, metrics):
+        self.limiter = limiter
+        self.ctx = ctx
+        self.method = method
+        self.metrics = metrics
+
+    def on_error(self, reason):
+        self.limiter.on_error(reason)
+        if self.metrics is not None:
+            self.metrics.observe_request_error(self.limiter.host, self.method, reason)
+
+    async def __aenter__(self):
+        await self.limiter.acquire()
+        start = time.monotonic()
+        try:
+            resp = await self.ctx.__aenter__()
+        except BaseException as e:
+            if isinstance(e, Exception):
+                self.on_error(type(e).__name__)
+            await self.limiter.release()
+            raise
+        latency = time.monotonic() - start
+        self.limiter.report(resp.status, latency)
+        if self.metrics is not None:
+            self.metrics.observe_request(
+                self.limiter.host, self.method, resp.status, latency
+            )
+        return resp
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            return await self.ctx.__aexit__(exc_type, exc, tb)
+        finally:
+            # An error while reading the body (e.g. a connection reset).
+            if exc_type is not None and issubclass(exc_type, Exception):
+                self.on_error(exc_type.__name__)
+            await self.limiter.release()
+
+
+class RateLimitedClient:
+    """
+    Wrap an aiohttp ClientSession so that each request waits for the limiter
+    of its host. The limits of the hosts which aren't in host_limits are the
+    ones of default_limits. The latency and the status of the responses are
+    recorded in metrics (see metrics.py) if any, and retry_policy is the
+    policy used to retry the failed requests (see retry_policy.py).
+    """
+
+    def __init__(
+        self, session, host_limits, default_limits, metrics=None, retry_policy=None
+    ):
+        self.session = session
+        self.host_limits = host_limits
+        self.default_limits = default_limits
+        self.metrics = metrics
+        self.retry_policy = retry_policy
+        self.limiters = {}
+
+    def get_limiter(self, url):
+        host = urlsplit(url).hostname
+        limiter = self.limiters.get(host)
+        if limiter is None:
+            limits = self.host_limits.get(host, self.default_limits)
+            limiter = self.limiters[host] = HostLimiter(host, limits)
+        return limiter
+
+    def head(self, url, **kwargs):
+        return RequestContextManager(
+            self.get_limiter(url),
+            self.session.head(url, **kwargs),
+            "HEAD",
+            self.metrics,
+        )
+
+    def get(self, url, **kwargs):
+        return RequestContextManager(
+            self.get_limiter(url),
+            self.session.get(url, **kwargs),
+            "GET",
+            self.metrics,
+        )
+
+    async def close(self):
+        await self.session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
@@ -0,0 +1,242 @@
+#
+# Copyright 2016 Mozilla
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Retry policy shared by the HTTP requests of symsrv-fetch.py (asyncio) and
+# upload_symbols.py (threads):
+#  - the responses are classified as a success, a definitive failure or a
+#    transient failure which is worth retrying;
+#  - the delay between two attempts is randomized with decorrelated jitter
+#    (so that the clients which failed together don't retry together) and is
+#    at least what the server asks for with Retry-After;
+#  - each host has a circuit breaker: after too many failures in a row
+#    (transport errors, 429 and 5xx, not the problems of a single file),
+#    the requests to the host wait for a cooldown, then a single request is
+#    sent to check if the host is back;
+#  - no retry is attempted if it would go past the deadline of the task.
+#
+# Nothing sleeps here: the callers get the delays and sleep with asyncio
+# or time.
+
+import email.utils
+import logging
+import random
+import threading
+import time
+
+
+log = logging.getLogger()
+
+
+SUCCESS = "success"
+FAILURE = "failure"
+TRANSIENT = "transient"
+
+# Transient client errors (timeout, too early, too many requests)
+TRANSIENT_STATUSES = {408, 425, 429}
+# Server errors which won't go away by retrying
+PERMANENT_SERVER_STATUSES = {501, 505}
+
+
+def classify(status):
+    """
+    Classify an HTTP status: SUCCESS (2xx and 3xx), TRANSIENT (worth
+    retrying) or FAILURE (a definitive answer, like a 404).
+    """
+    if 200 <= status < 400:
+        return SUCCESS
+    if status in TRANSIENT_STATUSES or (
+        status >= 500 and status not in PERMANENT_SERVER_STATUSES
+    ):
+        return TRANSIENT
+    return FAILURE
+
+
+def get_retry_after(headers):
+    """
+    Get the number of seconds to wait from the Retry-After header
+    (a number of seconds or a date) or None if there's none.
+    """
+    value = headers.get("Retry-After")
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0.0, email.utils.mktime_tz(date) - time.time())
+
+
+class CircuitBreaker:
+    # Seconds between two checks while another request checks if the host is back
+    POLL_INTERVAL = 1.0
+
+    def __init__(self, host, threshold, cooldown):
+        """
+        Open the circuit after threshold failures in a row and keep it open
+        for cooldown seconds.
+        """
+        self.host = host
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial_at = None
+        self.lock = threading.Lock()
+
+    def get_wait(self):
+        """
+        Get the number of seconds to wait before sending a request (0 to send it now).
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return 0.0
+            now = time.monotonic()
+            wait = self.opened_at + self.cooldown - now
+            if wait > 0:
+                return wait
+            # Half open: a single request checks if the host is back, unless
+            # it's taking so long that it has probably been abandoned.
+            if self.trial_at is not None and now - self.trial_at < self.cooldown:
+                return self.POLL_INTERVAL
+            self.trial_at = now
+            return 0.0
+
+    def on_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_at = None
+
+    def on_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_at is not None or (
+                self.opened_at is None and self.failures >= self.threshold
+            ):
+                if self.opened_at is None:
+                    log.warning(
+                        f"{self.failures} failures in a row from {self.host}: "
+                        f"pause the requests for {self.cooldown}s"
+                    )
+                self.opened_at = time.monotonic()
+                self.trial_at = None
+
+
+class Retry:
+    """
+    State of the retries of a request (see RetryPolicy.start).
+    """
+
+    def __init__(self, policy, breaker):
+        self.policy = policy
+        self.breaker = breaker
+        self.retries = 0
+        self.delay = policy.base_delay
+
+    def get_wait(self):
+        """
+        Get the number of seconds to wait before the next attempt because of the
+        circuit breaker (0 to go now) or None if it'd be past the deadline.
+        """
+        wait = self.breaker.get_wait()
+        if wait and not self.policy.has_time(wait):
+            return None
+        return wait
+
+    def on_success(self):
+        """
+        Record a response which isn't a transient failure (so a 404 is a success here).
+        """
+        self.breaker.on_success()
+
+    def on_failure(self, retry_after=None, host_failure=True):
+        """
+        Record a transient failure and get the number of seconds to wait
+        before retrying or None if we must give up. host_failure is False
+        when the host answered but not with what we want for this request
+        (e.g. an unexpected content): only this request backs off, and the
+        circuit breaker sees that the host is up.
+        """
+        if host_failure:
+            self.breaker.on_failure()
+        else:
+            self.breaker.on_success()
+        self.retries += 1
+        if self.retries >= self.policy.attempts:
+            return None
+
+        # Decorrelated jitter: the delay grows randomly from the previous one.
+        self.delay = min(
+            self.policy.max_delay,
+            random.uniform(self.policy.base_delay, self.delay * 3),
+        )
+        delay = self.delay
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.policy.max_retry_after))
+
+        if not self.policy.has_time(delay):
+            return None
+        return delay
+
+
+class RetryPolicy:
+    def __init__(
+        self,
+        attempts=5,
+        base_delay=0.5,
+        max_delay=60.0,
+        max_retry_after=300.0,
+        breaker_threshold=10,
+        breaker_cooldown=30.0,
+        deadline=None,
+    ):
+        """
+        attempts is the max number of attempts for a request. The delays
+        between two attempts go from base_delay to max_delay seconds, or up to
+        max_retry_after when the server asks for it. See CircuitBreaker for
+        breaker_threshold and breaker_cooldown. deadline is the number of
+        seconds from now after which there's no retry anymore (None for no limit).
+        """
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.deadline = None
+        if deadline is not None:
+            self.deadline = time.time() + deadline
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def get_breaker(self, host):
+        with self.lock:
+            breaker = self.breakers.get(host)
+            if breaker is None:
+                breaker = self.breakers[host] = CircuitBreaker(
+                    host, self.breaker_threshold, self.breaker_cooldown
+                )
+            return breaker
+
+    def has_time(self, delay):
+        return self.deadline is None or time.time() + delay < self.deadline
+
+    def start(self, host):
+        """
+        Get the Retry for a new request to host.
+        """
+        return Retry(self, self.get_breaker(host))
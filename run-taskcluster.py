@@ -17,6 +17,10 @@
 '''
 This script triggers taskcluster tasks to fetch missing symbols from
 Microsoft's symbol server and upload them to crash-stats.mozilla.com.
+
+The modules of the missing symbols CSV are split between several fetch
+tasks (see shards.py), according to the number of modules to process,
+and the upload task uploads the symbols of all of them.
 '''
 
 from __future__ import print_function
@@ -28,9 +32,18 @@ import os
 import sys
 import taskcluster
 
+import requests
 import requests.packages.urllib3
 requests.packages.urllib3.disable_warnings()
 
+from shards import get_shard
+
+
+MISSING_SYMBOLS_URL = 'https://symbols.mozilla.org/missingsymbols.csv?microsoft=only'
+# Number of modules we want to process in each fetch task
+MODULES_PER_FETCH_TASK = 20000
+MAX_FETCH_TASKS = 8
+
 
 def local_file(filename):
     '''
@@ -46,6 +59,80 @@ def read_tc_auth():
     return json.load(open(local_file('taskcluster-auth.json'), 'rb'))
 
 
+def read_list(filename):
+    '''
+    Read the lowercased debug files of a list next to this script (e.g. blacklist.txt).
+    '''
+    with open(local_file(filename), 'r') as f:
+        return set(line.strip().lower() for line in f if line.strip())
+
+
+def read_skiplist(filename):
+    '''
+    Read the (debug_id, lowercased debug file) of the skiplist next to this script.
+    '''
+    skiplist = set()
+    with open(local_file(filename), 'r') as f:
+        for line in f:
+            bits = line.split()
+            if len(bits) >= 2:
+                skiplist.add((bits[0], bits[1].lower()))
+    return skiplist
+
+
+def get_modules(missing_symbols_url):
+    '''
+    Get the (debug file, debug id) of the modules of the missing symbols CSV
+    that symsrv-fetch.py would process, filtered like it does with the
+    blacklist and the skiplist of this repository (the skiplist grown by the
+    fetch tasks is in their cache, so it's an upper bound).
+    '''
+    blacklist = read_list('blacklist.txt')
+    skiplist = read_skiplist('skiplist.txt')
+    modules = set()
+
+    r = requests.get(missing_symbols_url, stream=True, timeout=(10, 300))
+    r.raise_for_status()
+    lines = r.iter_lines()
+    # skip the column headers
+    next(lines, None)
+    for line in lines:
+        bits = line.decode('utf-8', 'replace').strip().split(',')
+        if len(bits) < 2:
+            continue
+        pdb, debug_id = bits[:2]
+        if not pdb or not debug_id or not pdb.endswith('.pdb'):
+            continue
+        if pdb.lower() in blacklist or (debug_id, pdb.lower()) in skiplist:
+            continue
+        modules.add((pdb.lower(), debug_id.upper()))
+
+    return modules
+
+
+def get_fetch_task_count(args):
+    '''
+    Get the number of fetch tasks needed for the modules to process.
+    '''
+    if args.fetch_tasks:
+        return args.fetch_tasks
+    try:
+        modules = get_modules(args.missing_symbols)
+    except Exception as e:
+        print('Cannot get the missing symbols ({}): use {} fetch tasks'.format(
+            e, args.max_fetch_tasks), file=sys.stderr)
+        return args.max_fetch_tasks
+
+    count = (len(modules) + args.modules_per_task - 1) // args.modules_per_task
+    count = min(args.max_fetch_tasks, max(1, count))
+    shards = [0] * count
+    for pdb, debug_id in modules:
+        shards[get_shard(pdb, debug_id, count)] += 1
+    print('{} modules to process in {} fetch tasks: {}'.format(
+        len(modules), count, ', '.join(str(n) for n in shards)))
+    return count
+
+
 def fill_template_property(val, keys):
     if isinstance(val, basestring) and '{' in val:
          return val.format(**keys)
@@ -81,11 +168,13 @@ def format_timedelta(d, **kwargs):
     return d.isoformat() + 'Z'
 
 
-def spawn_task(queue, keys, decision_task_id, template_file):
+def spawn_task(queue, keys, decision_task_id, template_file, dependencies=None):
     task_id = taskcluster.utils.slugId()
     with open(local_file(template_file), 'rb') as template:
         payload = fill_template(template, keys)
-        if decision_task_id and not payload.get('dependencies'):
+        if dependencies:
+            payload['dependencies'] = dependencies
+        elif decision_task_id and not payload.get('dependencies'):
             payload['dependencies'] = [decision_task_id]
         queue.createTask(task_id, payload)
     return task_id
@@ -94,6 +183,15 @@ def spawn_task(queue, keys, decision_task_id, template_file):
 def main():
     parser = argparse.ArgumentParser(
         description='Spawn tasks to fetch missing symbols from Microsoft symbol server')
+    parser.add_argument('--missing-symbols', type=str, default=MISSING_SYMBOLS_URL,
+                        help='missing symbols URL, to size the fetch tasks')
+    parser.add_argument('--fetch-tasks', type=int, default=None,
+                        help='number of fetch tasks (default: according to the '
+                             'number of modules to process)')
+    parser.add_argument('--modules-per-task', type=int, default=MODULES_PER_FETCH_TASK,
+                        help='number of modules to process in each fetch task')
+    parser.add_argument('--max-fetch-tasks', type=int, default=MAX_FETCH_TASKS,
+                        help='max number of fetch tasks')
 
     args = parser.parse_args()
     decision_task_id = os.environ.get('TASK_ID')
@@ -111,11 +209,24 @@ def main():
         'artifacts_expires': format_timedelta(now, days=1),
         'date_index': now.strftime('%Y%m%d%H%M%S'),
     }
+    fetch_tasks = get_fetch_task_count(args)
     try:
         queue = taskcluster.Queue(options)
-        fetch_task_id = spawn_task(queue, keys, decision_task_id, "fetch-task.json")
-        keys['fetch_task_id'] = fetch_task_id
-        spawn_task(queue, keys, decision_task_id, "upload-task.json")
+        fetch_task_ids = []
+        for i in range(fetch_tasks):
+            keys['shard'] = '{}/{}'.format(i, fetch_tasks)
+            # A single task keeps the index of the unsharded runs.
+            keys['index_name'] = 'fetch-win32-symbols'
+            if fetch_tasks > 1:
+                keys['index_name'] += '.shard-{}'.format(i)
+            fetch_task_ids.append(
+                spawn_task(queue, keys, decision_task_id, "fetch-task.json"))
+        keys['fetch_task_ids'] = ' '.join(fetch_task_ids)
+        # The upload task requires the fetch tasks to be resolved, not
+        # completed (see upload-task.json): the symbols of the shards which
+        # succeeded are uploaded even if another one failed.
+        spawn_task(queue, keys, decision_task_id, "upload-task.json",
+                   dependencies=fetch_task_ids)
         print('https://tools.taskcluster.net/task-group-inspector/#/' + task_group_id)
     except taskcluster.exceptions.TaskclusterAuthFailure as e:
         print('TaskclusterAuthFailure: {}'.format(e.body), file=sys.stderr)
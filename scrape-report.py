@@ -14,29 +14,45 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+# This script writes a CSV of the modules missing symbols in some crash reports,
+# which can be passed to symsrv-fetch.py with --missing-symbols.
+# The crashes are given on the command line (crash IDs, crash report URLs or
+# JSON files) or, with --batch, in a file (one per line, - for stdin).
+
+import argparse
 import csv
+import json
 import logging
 import os
 import requests
 import sys
-import urlparse
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import urlparse
 
 
 log = logging.getLogger()
 
+PROCESSED_CRASH_URL = 'https://crash-stats.mozilla.com/api/ProcessedCrash/?crash_id={crash_id}&datatype=processed'
+MAX_PARALLEL_FETCHES = 8
+# Number of crashes submitted to the fetching threads per thread
+PENDING_PER_JOB = 2
+# Timeout in seconds to connect to the server and between two reads
+TIMEOUT = 30
+
 
-def fetch_missing_symbols_from_crash(file_or_crash):
+def fetch_missing_symbols_from_crash(file_or_crash, session=requests):
     if os.path.isfile(file_or_crash):
         log.info('Fetching missing symbols from JSON file: %s' % file_or_crash)
         j = {'json_dump': json.load(open(file_or_crash, 'rb'))}
     else:
         if 'report/index/' in file_or_crash:
-            crash_id = urlparse.urlparse(file_or_crash).path.split('/')[-1]
+            crash_id = urlparse(file_or_crash).path.split('/')[-1]
         else:
             crash_id = file_or_crash
-        url = 'https://crash-stats.mozilla.com/api/ProcessedCrash/?crash_id={crash_id}&datatype=processed'.format(crash_id = crash_id)
+        url = PROCESSED_CRASH_URL.format(crash_id=crash_id)
         log.info('Fetching missing symbols from crash: %s' % url)
-        r = requests.get(url)
+        r = session.get(url, timeout=TIMEOUT)
         if r.status_code != 200:
             log.error('Failed to fetch crash %s' % url)
             return set()
@@ -44,21 +60,82 @@ def fetch_missing_symbols_from_crash(file_or_crash):
     return set([(m['debug_file'], m['debug_id'], m['filename'], m['code_id']) for m in j['json_dump']['modules'] if 'missing_symbols' in m])
 
 
+def read_crashes(path):
+    f = sys.stdin if path == '-' else open(path, 'r')
+    try:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                yield line
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def write_missing_symbols(crashes, out, jobs):
+    '''
+    Fetch the crashes with jobs requests in parallel and write the modules
+    missing symbols in out as soon as each crash is fetched, without duplicates.
+    '''
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=jobs)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    seen = set()
+    lock = threading.Lock()
+    c = csv.writer(out)
+    c.writerow(['debug_file', 'debug_id', 'code_file', 'code_id'])
+
+    def helper(file_or_crash):
+        try:
+            symbols = fetch_missing_symbols_from_crash(file_or_crash, session)
+        except Exception as e:
+            log.error('Failed to get missing symbols from %s: %s' % (file_or_crash, e))
+            return
+        with lock:
+            for row in symbols - seen:
+                seen.add(row)
+                c.writerow(row)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        # Only read the next crashes once some are fetched, so that they
+        # aren't all in memory (--batch can be a long file or stdin).
+        pending = set()
+        for file_or_crash in crashes:
+            if len(pending) >= jobs * PENDING_PER_JOB:
+                _, pending = wait(pending, return_when=FIRST_COMPLETED)
+            pending.add(executor.submit(helper, file_or_crash))
+        wait(pending)
+
+    return len(seen)
+
+
 def main():
     logging.basicConfig()
     log.setLevel(logging.DEBUG)
     urllib3_logger = logging.getLogger('urllib3')
     urllib3_logger.setLevel(logging.ERROR)
 
-    if len(sys.argv) < 2:
+    parser = argparse.ArgumentParser(
+        description='Write a CSV of the modules missing symbols in crash reports')
+    parser.add_argument('crashes', nargs='*',
+                        help='crash IDs, crash report URLs or JSON files')
+    parser.add_argument('--batch', type=str,
+                        help='file with one crash per line (- for stdin)')
+    parser.add_argument('--jobs', type=int, default=MAX_PARALLEL_FETCHES,
+                        help='number of crashes to fetch in parallel')
+    args = parser.parse_args()
+
+    crashes = iter(args.crashes)
+    if args.batch:
+        crashes = (x for it in (crashes, read_crashes(args.batch)) for x in it)
+    elif not args.crashes:
         log.error('Specify a crash URL or ID')
         sys.exit(1)
-    symbols = fetch_missing_symbols_from_crash(sys.argv[1])
-    log.info('Found %d missing symbols' % len(symbols))
-    c = csv.writer(sys.stdout)
-    c.writerow(['debug_file', 'debug_id', 'code_file', 'code_id'])
-    for row in symbols:
-        c.writerow(row)
+
+    count = write_missing_symbols(crashes, sys.stdout, args.jobs)
+    log.info('Found %d missing symbols' % count)
 
 if __name__ == '__main__':
     main()
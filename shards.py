@@ -0,0 +1,51 @@
+#
+# Copyright 2016 Mozilla
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Partition of the missing symbols between several fetch tasks: the module
+# (debug_file, debug_id) goes to the shard given by a hash of both, so it's
+# the same whatever the order of the CSV and whoever computes it. The debug
+# file is lowercased and the debug id uppercased, like when symsrv-fetch.py
+# removes the duplicates, so all the variants of a module are in one shard.
+#
+# This module is imported by run-taskcluster.py (the decision task) to size
+# the fetch tasks, so it must work with Python 2 too.
+
+from __future__ import absolute_import
+
+import hashlib
+
+
+def parse_shard(value):
+    '''
+    Parse a shard given as 'i/N' (0 <= i < N) and return (i, N).
+    '''
+    index, sep, count = value.partition('/')
+    if not sep or not index.isdigit() or not count.isdigit():
+        raise ValueError('Invalid shard {0!r}: expected i/N'.format(value))
+    index, count = int(index), int(count)
+    if index >= count:
+        raise ValueError('Invalid shard {0!r}: i must be less than N'.format(value))
+    return index, count
+
+
+def get_shard(debug_file, debug_id, count, salt=''):
+    '''
+    Get the shard (in [0, count)) of the module. Partitions with different
+    salts are independent, e.g. to split a shard again.
+    '''
+    key = '{0}{1}/{2}'.format(salt, debug_file.lower(), debug_id.upper())
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    return int(hashlib.sha1(key).hexdigest()[:8], 16) % count
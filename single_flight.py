@@ -0,0 +1,42 @@
+#
+# Copyright 2016 Mozilla
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Coalescing of concurrent requests: when a request is already in flight for
+# a key, the other callers wait for its result instead of sending their own.
+
+import asyncio
+
+
+class SingleFlight:
+    def __init__(self, name, stats):
+        """
+        The number of coalesced calls is counted in stats[f"{name}_coalesced"].
+        """
+        self.name = name
+        self.stats = stats
+        self.futures = {}
+
+    async def run(self, key, func):
+        """
+        Get the result of func() or the one of the call in flight for key.
+        """
+        fut = self.futures.get(key)
+        if fut is not None:
+            self.stats[f"{self.name}_coalesced"] += 1
+        else:
+            fut = self.futures[key] = asyncio.ensure_future(func())
+            fut.add_done_callback(lambda _: self.futures.pop(key, None))
+        # A cancelled caller mustn't cancel the call for the other ones.
+        return await asyncio.shield(fut)
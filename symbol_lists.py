@@ -0,0 +1,274 @@
+#
+# Copyright 2016 Mozilla
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Indexed store for the lists of symbols used by symsrv-fetch.py:
+#  - the blacklist (blacklist.txt) and the known Microsoft symbols
+#    (known-microsoft-symbols.txt): one debug file per line;
+#  - the skiplist (skiplist.txt): "debug_id debug_file" or
+#    "debug_id debug_file first_seen last_seen hits" per line.
+#
+# The lists are kept in a SQLite database, with the debug files lowercased
+# when they're written, so that a lookup is just an index query and the
+# lists don't need to be loaded in memory. The text files are imported
+# when their content changes and the lists can be exported back to text
+# (the skiplist in the old "debug_id debug_file" format, unless --with-stats
+# is given):
+#   python symbol_lists.py export [--with-stats] DATABASE LIST OUTPUT
+#   python symbol_lists.py import DATABASE LIST INPUT
+
+import argparse
+import hashlib
+import logging
+import os
+import sys
+import time
+from collections import namedtuple
+
+from batched_db import BatchedDB
+
+
+log = logging.getLogger()
+
+SkiplistEntry = namedtuple("SkiplistEntry", ["debug_file", "first_seen", "last_seen", "hits"])
+
+BLACKLIST = "blacklist"
+KNOWN_MS_SYMBOLS = "known-microsoft-symbols"
+SKIPLIST = "skiplist"
+
+
+def read_list(path):
+    with open(path, "r") as In:
+        for line in In:
+            line = line.strip()
+            if line:
+                yield line.lower()
+
+
+def read_skiplist(path):
+    now = int(time.time())
+    with open(path, "r") as In:
+        for line in In:
+            line = line.strip()
+            if line == "":
+                continue
+            s = line.split(" ", maxsplit=1)
+            if len(s) != 2:
+                continue
+            debug_id, debug_file = s
+            # The line is either "debug_id debug_file" (old format, considered
+            # as just seen) or "debug_id debug_file first_seen last_seen hits"
+            bits = debug_file.rsplit(" ", maxsplit=3)
+            if len(bits) == 4 and all(x.isdigit() for x in bits[1:]):
+                debug_file = bits[0]
+                first_seen, last_seen, hits = map(int, bits[1:])
+            else:
+                first_seen = last_seen = now
+                hits = 1
+            yield debug_id, SkiplistEntry(debug_file.lower(), first_seen, last_seen, hits)
+
+
+def get_digest(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as In:
+        for chunk in iter(lambda: In.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class SymbolLists:
+    def __init__(self, path):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+        self.db = BatchedDB(path)
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS lists (
+                name TEXT NOT NULL,
+                debug_file TEXT NOT NULL,
+                PRIMARY KEY (name, debug_file)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS skiplist (
+                debug_id TEXT NOT NULL PRIMARY KEY,
+                debug_file TEXT NOT NULL,
+                first_seen INTEGER NOT NULL,
+                last_seen INTEGER NOT NULL,
+                hits INTEGER NOT NULL
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS sources (
+                path TEXT NOT NULL PRIMARY KEY,
+                digest TEXT NOT NULL
+            );
+            """
+        )
+        self.db.commit()
+
+    def _is_imported(self, path):
+        """
+        Check if path has already been imported as it is now, and if not
+        return its digest to record once the import is done.
+        """
+        digest = get_digest(path)
+        row = self.db.execute(
+            "SELECT digest FROM sources WHERE path = ?", (os.path.abspath(path),)
+        ).fetchone()
+        if row is not None and row[0] == digest:
+            return None
+        return digest
+
+    def _set_imported(self, path, digest):
+        self.db.execute(
+            "INSERT OR REPLACE INTO sources VALUES (?, ?)", (os.path.abspath(path), digest)
+        )
+        self.db.commit()
+
+    def import_list(self, name, path):
+        """
+        Replace the list name by the content of the text file path.
+        """
+        try:
+            digest = self._is_imported(path)
+        except FileNotFoundError:
+            return
+        if digest is None:
+            return
+
+        self.db.execute("DELETE FROM lists WHERE name = ?", (name,))
+        self.db.executemany(
+            "INSERT OR IGNORE INTO lists VALUES (?, ?)",
+            ((name, debug_file) for debug_file in read_list(path)),
+        )
+        self._set_imported(path, digest)
+        log.debug(f"{path} imported: {self.get_list_size(name)} items in {name}")
+
+    def import_skiplist(self, path, replace=False):
+        """
+        Add the entries of the skiplist text file path. By default the entries
+        already in the store are kept, since they're more up to date.
+        """
+        try:
+            digest = self._is_imported(path)
+        except FileNotFoundError:
+            return
+        if digest is None:
+            return
+
+        verb = "REPLACE" if replace else "IGNORE"
+        self.db.executemany(
+            f"INSERT OR {verb} INTO skiplist VALUES (?, ?, ?, ?, ?)",
+            ((debug_id,) + tuple(entry) for debug_id, entry in read_skiplist(path)),
+        )
+        self._set_imported(path, digest)
+        log.debug(f"{path} imported: {self.get_skiplist_size()} items in skiplist")
+
+    def export_list(self, name, path):
+        with open(path, "w") as Out:
+            for (debug_file,) in self.db.execute(
+                "SELECT debug_file FROM lists WHERE name = ? ORDER BY debug_file", (name,)
+            ):
+                Out.write(f"{debug_file}\n")
+
+    def export_skiplist(self, path, with_stats=False):
+        """
+        Write the skiplist in the old "debug_id debug_file" format, or with
+        "first_seen last_seen hits" appended when with_stats is True.
+        """
+        with open(path, "w") as Out:
+            for debug_id, debug_file, first_seen, last_seen, hits in self.db.execute(
+                "SELECT * FROM skiplist ORDER BY debug_file, debug_id"
+            ):
+                if with_stats:
+                    Out.write(
+                        f"{debug_id} {debug_file} {first_seen} {last_seen} {hits}\n"
+                    )
+                else:
+                    Out.write(f"{debug_id} {debug_file}\n")
+
+    def get_list_size(self, name):
+        (size,) = self.db.execute(
+            "SELECT COUNT(*) FROM lists WHERE name = ?", (name,)
+        ).fetchone()
+        return size
+
+    def get_skiplist_size(self):
+        (size,) = self.db.execute("SELECT COUNT(*) FROM skiplist").fetchone()
+        return size
+
+    def in_list(self, name, debug_file):
+        return (
+            self.db.execute(
+                "SELECT 1 FROM lists WHERE name = ? AND debug_file = ?",
+                (name, debug_file.lower()),
+            ).fetchone()
+            is not None
+        )
+
+    def get_skipped(self, debug_id):
+        row = self.db.execute(
+            "SELECT debug_file, first_seen, last_seen, hits FROM skiplist WHERE debug_id = ?",
+            (debug_id,),
+        ).fetchone()
+        return None if row is None else SkiplistEntry(*row)
+
+    def set_skipped(self, debug_id, entry):
+        self.db.write(
+            "INSERT OR REPLACE INTO skiplist VALUES (?, ?, ?, ?, ?)",
+            (debug_id,) + tuple(entry),
+        )
+
+    def remove_skipped(self, debug_id):
+        self.db.write("DELETE FROM skiplist WHERE debug_id = ?", (debug_id,))
+
+    def close(self):
+        self.db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Import or export a list of symbols from the symbol lists database"
+    )
+    parser.add_argument("action", choices=["import", "export"])
+    parser.add_argument("database", type=str, help="symbol lists database")
+    parser.add_argument("list", choices=[BLACKLIST, KNOWN_MS_SYMBOLS, SKIPLIST])
+    parser.add_argument("path", type=str, help="text file")
+    parser.add_argument(
+        "--with-stats",
+        action="store_true",
+        help="export the skiplist with the first_seen, last_seen and hits columns",
+    )
+    args = parser.parse_args()
+
+    store = SymbolLists(args.database)
+    if args.action == "import":
+        # An explicit import always wins over what we have.
+        store.db.execute(
+            "DELETE FROM sources WHERE path = ?", (os.path.abspath(args.path),)
+        )
+        if args.list == SKIPLIST:
+            store.import_skiplist(args.path, replace=True)
+        else:
+            store.import_list(args.list, args.path)
+    elif args.list == SKIPLIST:
+        store.export_skiplist(args.path, args.with_stats)
+    else:
+        store.export_list(args.list, args.path)
+    store.close()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
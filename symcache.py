@@ -0,0 +1,310 @@
+#
+# Copyright 2016 Mozilla
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Local cache of the files downloaded from Microsoft's symbol server, kept
+# across runs. It's laid out like a SRV* symbol store (name/id/name), so it's
+# also the cache dump_syms uses with --symbol-server.
+#
+# The files downloaded by symsrv-fetch.py are recorded in an index with their
+# size and type, which are checked before reusing them. The files which are
+# on disk but not in the index (downloaded by another process sharing the
+# cache with its own index, or by dump_syms itself) are added to it when
+# they look valid. The least recently used files are removed to keep the
+# cache under a max size: the indexed ones as soon as a new file goes over
+# it (except the pinned ones, still waiting to be used), and the other ones
+# at the end of the run.
+
+import fcntl
+import logging
+import os
+import sqlite3
+import time
+
+from batched_db import BatchedDB
+
+
+log = logging.getLogger()
+
+INDEX = "index.sqlite"
+# Suffix of the files locking a file of the cache while it's downloaded
+LOCK_SUFFIX = ".lock"
+# Fraction of the max size to which the cache is brought back when a new
+# file goes over it, so that it's not at each new file
+EVICT_TO = 0.9
+
+
+class SymbolCache:
+    def __init__(self, path, max_size, get_type, index=INDEX):
+        """
+        Open the cache in the directory path: max_size is its max size in
+        bytes and get_type a function giving the type of a file from its
+        first bytes. The processes sharing the directory must each have
+        their own index file.
+        """
+        self.path = path
+        self.max_size = max_size
+        self.get_type = get_type
+        self.hits = 0
+        self.misses = 0
+        # Number of pins of the files which mustn't be evicted, by path
+        self.pinned = {}
+
+        os.makedirs(path, exist_ok=True)
+        self.db = BatchedDB(os.path.join(path, index))
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT NOT NULL PRIMARY KEY, "
+            "size INTEGER NOT NULL, "
+            "type TEXT NOT NULL, "
+            "used REAL NOT NULL"
+            ") WITHOUT ROWID"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_used ON files (used)")
+        self.db.commit()
+        # Total size of the indexed files
+        (self.size,) = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM files"
+        ).fetchone()
+
+    def get_path(self, filename, file_id):
+        return os.path.join(self.path, filename, file_id, filename)
+
+    def _get_file_type(self, path, size=64):
+        with open(path, "rb") as In:
+            return self.get_type(In.read(size))
+
+    def get(self, filename, file_id):
+        """
+        Get the path of the file if it's in the cache and it looks valid.
+        """
+        rel_path = os.path.join(filename, file_id, filename)
+        row = self.db.execute(
+            "SELECT size, type FROM files WHERE path = ?", (rel_path,)
+        ).fetchone()
+        if row is not None:
+            path = os.path.join(self.path, rel_path)
+            size, typ = row
+            try:
+                valid = (
+                    os.path.getsize(path) == size and self._get_file_type(path) == typ
+                )
+            except OSError:
+                valid = False
+            if valid:
+                self.hits += 1
+                self.db.write(
+                    "UPDATE files SET used = ? WHERE path = ?", (time.time(), rel_path)
+                )
+                return path
+
+            if os.path.exists(path):
+                log.warning(f"Corrupted file in the symbol cache: {rel_path}")
+                self.remove(filename, file_id)
+            else:
+                # Evicted by another process
+                self._forget(rel_path)
+        elif self._adopt(filename, file_id):
+            self.hits += 1
+            return self.get_path(filename, file_id)
+
+        self.misses += 1
+        return None
+
+    def _adopt(self, filename, file_id):
+        """
+        Add the file to the index if it's on disk and its type is known. The
+        files are renamed in the cache once complete, so it's not a partial one.
+        """
+        path = self.get_path(filename, file_id)
+        try:
+            if self._get_file_type(path) == "unknown":
+                return False
+        except OSError:
+            return False
+        self.add(filename, file_id)
+        return True
+
+    def add(self, filename, file_id):
+        rel_path = os.path.join(filename, file_id, filename)
+        path = os.path.join(self.path, rel_path)
+        size = os.path.getsize(path)
+        self._forget(rel_path)
+        self.db.write(
+            "INSERT INTO files VALUES (?, ?, ?, ?)",
+            (rel_path, size, self._get_file_type(path), time.time()),
+        )
+        self.size += size
+        if self.size > self.max_size:
+            self._evict_indexed(rel_path)
+
+    def remove(self, filename, file_id):
+        rel_path = os.path.join(filename, file_id, filename)
+        path = os.path.join(self.path, rel_path)
+        self._forget(rel_path)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def pin(self, filename, file_id):
+        """
+        Keep the file (downloaded or not yet) in the cache until it's unpinned
+        as many times as it's been pinned.
+        """
+        rel_path = os.path.join(filename, file_id, filename)
+        self.pinned[rel_path] = self.pinned.get(rel_path, 0) + 1
+
+    def unpin(self, filename, file_id):
+        rel_path = os.path.join(filename, file_id, filename)
+        count = self.pinned.pop(rel_path) - 1
+        if count:
+            self.pinned[rel_path] = count
+
+    def lock(self, filename, file_id):
+        """
+        Try to lock the file against the other processes sharing the cache
+        (its directory must exist) and return the lock to give to unlock,
+        or None if another process has it.
+        """
+        fd = os.open(self.get_path(filename, file_id) + LOCK_SUFFIX, os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        return fd
+
+    def unlock(self, lock):
+        os.close(lock)
+
+    def _forget(self, rel_path):
+        """
+        Remove the file from the index (but not from the disk).
+        """
+        row = self.db.execute(
+            "SELECT size FROM files WHERE path = ?", (rel_path,)
+        ).fetchone()
+        if row is not None:
+            self.size -= row[0]
+            self.db.write("DELETE FROM files WHERE path = ?", (rel_path,))
+
+    def _remove_file(self, rel_path):
+        path = os.path.join(self.path, rel_path)
+        for p in (path, path + LOCK_SUFFIX):
+            try:
+                os.remove(p)
+            except FileNotFoundError:
+                pass
+        # Remove the empty name/id directories.
+        try:
+            os.removedirs(os.path.dirname(path))
+        except OSError:
+            pass
+
+    def _evict_indexed(self, keep):
+        """
+        Remove the least recently used indexed files, except keep and the
+        pinned ones, until the cache is under EVICT_TO of its max size.
+        """
+        target = self.max_size * EVICT_TO
+        removed = 0
+        # The files kept stay at the beginning of the ones left
+        kept = 0
+        while self.size > target:
+            rows = self.db.execute(
+                "SELECT path, size FROM files ORDER BY used LIMIT 100 OFFSET ?",
+                (kept,),
+            ).fetchall()
+            if not rows:
+                break
+            for rel_path, size in rows:
+                if self.size <= target:
+                    break
+                if rel_path == keep or rel_path in self.pinned:
+                    kept += 1
+                    continue
+                self._remove_file(rel_path)
+                self._forget(rel_path)
+                removed += 1
+        self.db.commit()
+        log.info(f"Evicted {removed} files from the symbol cache")
+
+    def evict(self):
+        """
+        Remove the least recently used files until the cache is under its max size.
+        The files which aren't in the index (i.e. downloaded by dump_syms)
+        are considered as used when they were modified.
+        """
+        used = self._get_used()
+        files = []
+        total = 0
+        for root, _, filenames in os.walk(self.path):
+            if root == self.path:
+                # The index files
+                continue
+            for f in filenames:
+                if f.endswith(LOCK_SUFFIX):
+                    continue
+                path = os.path.join(root, f)
+                rel_path = os.path.relpath(path, self.path)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                total += st.st_size
+                files.append((used.get(rel_path, st.st_mtime), st.st_size, rel_path))
+
+        if total <= self.max_size:
+            return
+
+        files.sort()
+        removed = 0
+        for _, size, rel_path in files:
+            if total <= self.max_size:
+                break
+            self._remove_file(rel_path)
+            self._forget(rel_path)
+            total -= size
+            removed += 1
+        self.db.commit()
+        log.info(f"Evicted {removed} files from the symbol cache")
+
+    def _get_used(self):
+        """
+        Get when the files were last used according to all the index files.
+        """
+        self.db.commit()
+        used = {}
+        for f in os.listdir(self.path):
+            if not f.endswith(".sqlite"):
+                continue
+            db = sqlite3.connect(os.path.join(self.path, f))
+            try:
+                for rel_path, t in db.execute("SELECT path, used FROM files"):
+                    used[rel_path] = max(used.get(rel_path, 0), t)
+            except sqlite3.Error as e:
+                log.warning(f"Cannot read the symbol cache index {f}: {e}")
+            finally:
+                db.close()
+        return used
+
+    def close(self, evict=True):
+        """
+        Close the cache, after removing the files over its max size unless
+        evict is False (e.g. when other processes are still using it).
+        """
+        self.db.commit()
+        if evict:
+            self.evict()
+        self.db.close()
+        log.info(f"Symbol cache: {self.hits} hits, {self.misses} misses")
@@ -21,36 +21,124 @@
 # and it maintains its own list of symbols that the MS symbol server
 # doesn't have (skiplist.txt).
 #
-# The script also depends on having write access to the directory it is
-# installed in, to write the skiplist text file.
+# The script also depends on having write access to its cache directory
+# (--cache-dir), where the lists are stored (see symbol_lists.py) and the
+# skiplist grown by the previous runs is written.
 
-from aiofile import AIOFile, LineReader
-from aiohttp import ClientSession, ClientTimeout
+from aiofile import AIOFile, LineReader, Writer
+from aiohttp import ClientResponseError, ClientSession, ClientTimeout
 from aiohttp.connector import TCPConnector
 import argparse
 import asyncio
+import datetime
+import heapq
+import json
 import sys
 import os
 import shutil
 import logging
+import multiprocessing
+import stat
+import subprocess
+import threading
+import time
 from collections import defaultdict
-from tempfile import mkdtemp
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from urllib.parse import urljoin
 from urllib.parse import quote
+from urllib.parse import urlsplit
 import zipfile
+import zlib
+
+from batched_db import COMMIT_INTERVAL
+from cab import CabError, extract_cab, get_cab_name
+from journal import DUMPED, FETCHED, PROBED, ZIPPED, Journal
+from metrics import Metrics
+from pe_pdb import FormatError, read_pdb_info, read_pe_info
+from probe_cache import ProbeCache
+from rate_limit import HostLimits, RateLimitedClient
+from retry_policy import FAILURE, TRANSIENT, RetryPolicy, classify, get_retry_after
+from shards import get_shard, parse_shard
+from single_flight import SingleFlight
+from symcache import INDEX as SYMCACHE_INDEX, SymbolCache
+from symbol_lists import (
+    BLACKLIST,
+    KNOWN_MS_SYMBOLS,
+    SkiplistEntry,
+    SymbolLists,
+)
 
 
-# Just hardcoded here
-MICROSOFT_SYMBOL_SERVER = "https://msdl.microsoft.com/download/symbols/"
+# Just hardcoded here, the symbol servers can be overridden from the environment
+# (e.g. to use the fake ones of the benchmarks, see bench/)
+MICROSOFT_SYMBOL_SERVER = os.environ.get(
+    "SYMSRV_MICROSOFT_SYMBOL_SERVER", "https://msdl.microsoft.com/download/symbols/"
+)
 USER_AGENT = "Microsoft-Symbol-Server/6.3.0.0"
-MOZILLA_SYMBOL_SERVER = (
-    "https://s3-us-west-2.amazonaws.com/org.mozilla.crash-stats.symbols-public/v1/"
+MOZILLA_SYMBOL_SERVER = os.environ.get(
+    "SYMSRV_MOZILLA_SYMBOL_SERVER",
+    "https://s3-us-west-2.amazonaws.com/org.mozilla.crash-stats.symbols-public/v1/",
 )
 MISSING_SYMBOLS_URL = "https://symbols.mozilla.org/missingsymbols.csv?microsoft=only"
+MISSING_SYMBOLS_HEADER = "debug_file,debug_id,code_file,code_id\n"
 HEADERS = {"User-Agent": USER_AGENT}
-SYM_SRV = "SRV*{}*https://msdl.microsoft.com/download/symbols"
+SYM_SRV = "SRV*{}*" + MICROSOFT_SYMBOL_SERVER.rstrip("/")
 TIMEOUT = 7200
 RETRIES = 5
+# Seconds kept at the end of the task (to finish the dumps and upload the
+# artifacts) during which no new module is started and the failed requests
+# aren't retried anymore
+RUN_TIME_MARGIN = 1800
+# Downloads are streamed to disk by chunks of this size
+CHUNK_SIZE = 64 * 1024
+# Number of bytes needed to guess the type of a downloaded file
+MAGIC_SIZE = 64
+# Beginning of the symbol files for x86
+X86_MODULE = b"MODULE windows x86 "
+# Number of concurrent workers for each stage of the pipeline
+PROBE_WORKERS = 200
+FETCH_WORKERS = 100
+# Max number of open connections for all the hosts
+CONNECTIONS = 300
+# Initial and max concurrency and rate (requests/s) for each host,
+# adapted according to the way the hosts respond.
+HOST_LIMITS = {
+    urlsplit(MICROSOFT_SYMBOL_SERVER).hostname: HostLimits(50, 150, 50, 300),
+    urlsplit(MOZILLA_SYMBOL_SERVER).hostname: HostLimits(100, 200, 100, 1000),
+    urlsplit(MISSING_SYMBOLS_URL).hostname: HostLimits(10, 20, 10, 50),
+}
+DEFAULT_HOST_LIMITS = HostLimits(20, 50, 20, 100)
+# Number of processes extracting the compressed variants of the files
+CAB_JOBS = 2
+# Memory we expect a dump_syms process to use, to compute the default number of jobs
+DUMP_MEMORY = 2 * 1024 ** 3
+# Compression level of the zip
+ZIP_LEVEL = 6
+# Max size of each output zip in MB, to upload them separately
+ZIP_SHARD_SIZE = 512
+# Salt of the hash splitting the modules between the worker processes, so
+# that the split is independent of the one between the tasks (see shards.py)
+PROCESS_SALT = "process:"
+# Max number of modules waiting between two stages of the pipeline
+QUEUE_SIZE = 1000
+# Days after which an answer from Microsoft's symbol server is checked again
+PROBE_CACHE_TTL = 7
+PROBE_CACHE_SIZE = 5000000
+# Max size in GB of the cache of the files downloaded from Microsoft's symbol server
+SYMCACHE_SIZE = 50
+# Seconds between two attempts to lock a file of the symbol cache which is
+# downloaded by another worker process
+LOCK_DELAY = 0.5
+# Days after which a symbol in the skiplist is checked again,
+# the delay is doubled each time the symbol is still missing.
+SKIPLIST_RETRY_AFTER = 7
+SKIPLIST_MAX_RETRY_AFTER = 180 * 24 * 3600
+# Seconds after which the work left by a previous run isn't resumed anymore
+JOURNAL_MAX_AGE = 2 * 24 * 3600
+# Priorities of the modules in the pipeline (the lower, the sooner)
+PRIORITY_KNOWN_MS = 0
+PRIORITY_UNKNOWN = 1
+PRIORITY_SKIPLIST_RETRY = 2
 
 
 log = logging.getLogger()
@@ -73,128 +161,452 @@ def get_type(data):
     return "unknown"
 
 
-async def exp_backoff(retry_num):
-    await asyncio.sleep(2 ** retry_num)
+async def wait_breaker(retry):
+    """
+    Wait until the circuit breaker of the host lets the request go.
+    Return False if it would be past the deadline.
+    """
+    while True:
+        wait = retry.get_wait()
+        if wait is None:
+            return False
+        if not wait:
+            return True
+        await asyncio.sleep(wait)
 
 
-async def server_has_file(client, server, filename):
+def get_flight_key(server, filename):
+    """
+    Get the key used to coalesce the requests for this file: its URL,
+    lowercased for Microsoft's symbol server which is case insensitive.
+    """
+    if server == MICROSOFT_SYMBOL_SERVER:
+        filename = filename.lower()
+    return urljoin(server, quote(filename))
+
+
+async def server_has_file(client, cache, flights, server, filename):
     """
     Send the symbol server a HEAD request to see if it has this symbol file.
+    The answer is taken from the probe cache when possible, and the concurrent
+    probes for the same file share the same request.
+    Return True or False, or None when we don't know (e.g. the server kept
+    failing or an error page was served instead of the file).
+    """
+    result = cache.get(server, filename)
+    if result is not None:
+        log.debug(f"Probe cache hit ({result}): {server}{filename}")
+        return result
+
+    return await flights.run(
+        get_flight_key(server, filename),
+        lambda: probe_file(client, cache, server, filename),
+    )
+
+
+async def probe_file(client, cache, server, filename):
+    """
+    Send the HEAD request and record the answer in the probe cache, unless
+    there's no definitive answer.
     """
     url = urljoin(server, quote(filename))
-    for i in range(RETRIES):
+    retry = client.retry_policy.start(urlsplit(url).hostname)
+    while await wait_breaker(retry):
+        retry_after = None
         try:
             async with client.head(url, headers=HEADERS, allow_redirects=True) as resp:
-                if resp.status == 200 and (
-                    (
-                        "microsoft" in server
-                        and resp.headers["Content-Type"] == "application/octet-stream"
-                    )
-                    or "mozilla" in server
-                ):
-                    log.debug(f"File exists: {url}")
-                    return True
-                else:
-                    return False
+                status = classify(resp.status)
+                if status != TRANSIENT:
+                    retry.on_success()
+                    client.metrics.observe_retries("server_has_file", retry.retries)
+                    if status == FAILURE:
+                        cache.put(server, filename, False)
+                        return False
+                    if resp.status == 200 and (
+                        "mozilla" in server
+                        or resp.headers.get("Content-Type") == "application/octet-stream"
+                    ):
+                        log.debug(f"File exists: {url}")
+                        cache.put(server, filename, True)
+                        return True
+                    log.warning(f"Unexpected answer (status {resp.status}) for {url}")
+                    return None
+                log.warning(f"Status {resp.status} for {url}: retry")
+                retry_after = get_retry_after(resp.headers)
         except Exception as e:
             # Sometimes we've SSL errors or disconnections... so in such a situation just retry
             log.warning(f"Error with {url}: retry")
             log.exception(e)
-            await exp_backoff(i)
+        delay = retry.on_failure(retry_after)
+        if delay is None:
+            break
+        await asyncio.sleep(delay)
 
     log.debug(f"Too many retries (HEAD) for {url}: give up.")
-    return False
+    client.metrics.observe_retries("server_has_file", retry.retries, gave_up=True)
+    return None
+
+
+def get_partial_size(output_path):
+    """
+    Get the size of the partial download of output_path which can be resumed
+    (0 if there's none).
+    """
+    try:
+        size = os.path.getsize(output_path + ".part")
+    except OSError:
+        return 0
+    # The type of the file is sniffed from its first bytes.
+    return size if size >= MAGIC_SIZE else 0
 
 
-async def fetch_file(client, server, filename):
+def get_range_start(headers):
     """
-    Fetch the file from the server
+    Get the first byte of a partial response from its Content-Range
+    (e.g. "bytes 1000-1999/2000") or None.
+    """
+    value = headers.get("Content-Range", "")
+    unit, _, value = value.strip().partition(" ")
+    start = value.partition("-")[0]
+    if unit != "bytes" or not start.isdigit():
+        return None
+    return int(start)
+
+
+def get_validator(headers):
+    """
+    Get the value for If-Range: a strong ETag or the Last-Modified date (or None).
+    """
+    etag = headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return headers.get("Last-Modified")
+
+
+async def write_response(resp, output_path, offset=0):
+    """
+    Stream the response body to output_path and return its type.
+    The type is sniffed from the first bytes, so nothing is written on disk
+    for files we don't want. The data are written in a temporary file which
+    is renamed once the download is complete. If the download breaks, the
+    temporary file is kept and can be resumed: the response is then the
+    content from offset and is written after the first offset bytes.
+    """
+    tmp_path = output_path + ".part"
+    chunks = resp.content.iter_chunked(CHUNK_SIZE)
+    head = b""
+    if offset:
+        # The first bytes are in the partial file.
+        with open(tmp_path, "rb") as In:
+            typ = get_type(In.read(MAGIC_SIZE))
+        if typ == "unknown":
+            os.remove(tmp_path)
+            return typ
+        mode = "r+b"
+    else:
+        async for chunk in chunks:
+            head += chunk
+            if len(head) >= MAGIC_SIZE:
+                break
+
+        typ = get_type(head)
+        if typ in {"unknown", "pdb-v2"}:
+            return typ
+        mode = "wb"
+
+    async with AIOFile(tmp_path, mode) as Out:
+        writer = Writer(Out, offset)
+        if head:
+            await writer(head)
+        async for chunk in chunks:
+            await writer(chunk)
+    os.replace(tmp_path, output_path)
+
+    return typ
+
+
+async def fetch_file(client, server, filename, output_path):
+    """
+    Fetch the file from the server and write it in output_path.
+    An interrupted download is resumed with a Range request, from this
+    call or from a previous run (the files are identified by their id,
+    so their content doesn't change).
+    Return True once it's written, False if the server definitively doesn't
+    have it (or only a PDB v2) and None if we gave up.
     """
     url = urljoin(server, quote(filename))
     log.debug(f"Fetch url: {url}")
-    for i in range(RETRIES):
+    host = urlsplit(url).hostname
+    # ETag or Last-Modified of the file, to check it didn't change when resuming.
+    validator = None
+    retry = client.retry_policy.start(host)
+    while await wait_breaker(retry):
+        retry_after = None
+        # Whether the failure is the host's or only this file's
+        host_failure = True
+        offset = get_partial_size(output_path)
+        headers = HEADERS
+        if offset:
+            headers = dict(HEADERS, Range=f"bytes={offset}-")
+            if validator:
+                headers["If-Range"] = validator
         try:
-            async with client.get(url, headers=HEADERS, allow_redirects=True) as resp:
-                if resp.status == 200:
-                    data = await resp.read()
-                    typ = get_type(data)
-                    if typ == "unknown":
-                        # try again
-                        await exp_backoff(i)
-                    elif typ == "pdb-v2":
+            async with client.get(url, headers=headers, allow_redirects=True) as resp:
+                resumed = (
+                    offset
+                    and resp.status == 206
+                    and get_range_start(resp.headers) == offset
+                )
+                if resp.status == 200 or resumed:
+                    if not resumed:
+                        # The range was ignored: start again from scratch.
+                        offset = 0
+                    else:
+                        log.debug(f"Resume the download of {url} from byte {offset}")
+                    validator = get_validator(resp.headers)
+                    typ = await write_response(resp, output_path, offset)
+                    if typ == "pdb-v2":
                         # too old: skip it
                         log.debug(f"PDB v2 (skipped because too old): {url}")
-                        return None
-                    else:
-                        return data
+                        retry.on_success()
+                        client.metrics.observe_retries("fetch_file", retry.retries)
+                        return False
+                    if typ != "unknown":
+                        retry.on_success()
+                        client.metrics.add_bytes(
+                            host, os.path.getsize(output_path) - offset
+                        )
+                        if offset:
+                            client.metrics.add_resumed(host, offset)
+                        client.metrics.observe_retries("fetch_file", retry.retries)
+                        return True
+                    # Probably an error page: try again
+                    log.warning(f"Unknown content for {url}: retry")
+                    host_failure = False
+                elif resp.status in {206, 416}:
+                    # Not the range we asked for or the partial file is bigger
+                    # than the file: start again from scratch.
+                    log.warning(
+                        f"Cannot resume the download of {url} (status {resp.status}): retry"
+                    )
+                    if offset:
+                        os.remove(output_path + ".part")
+                    host_failure = False
+                elif classify(resp.status) == TRANSIENT:
+                    log.warning(f"Cannot get data (status {resp.status}) for {url}: retry")
+                    retry_after = get_retry_after(resp.headers)
                 else:
-                    log.error(f"Cannot get data (status {resp.status}) for {url}: ")
+                    log.error(f"Cannot get data (status {resp.status}) for {url}")
+                    retry.on_success()
+                    client.metrics.observe_retries("fetch_file", retry.retries)
+                    return False
         except Exception as e:
             log.warning(f"Error with {url}")
             log.exception(e)
-            await asyncio.sleep(0.5)
+        delay = retry.on_failure(retry_after, host_failure)
+        if delay is None:
+            break
+        await asyncio.sleep(delay)
 
     log.debug(f"Too many retries (GET) for {url}: give up.")
+    client.metrics.observe_retries("fetch_file", retry.retries, gave_up=True)
     return None
 
 
-def write_skiplist(skiplist):
-    with open("skiplist.txt", "w") as sf:
-        sf.writelines(
-            f"{debug_id} {debug_file}\n" for debug_id, debug_file in skiplist.items()
-        )
+async def fetch_missing_symbols(client, u):
+    """
+    Yield the lines of the missing symbols CSV (from an URL or a local file,
+    e.g. written by scrape-report.py) as they're downloaded.
+    The download is retried on transient failures (without yielding again the
+    lines already yielded), and an exception is raised if we gave up: an
+    error mustn't look like an empty CSV.
+    """
+    log.info("Trying missing symbols from %s" % u)
+    if not u.startswith("http"):
+        async with AIOFile(u, "r") as In:
+            header = True
+            async for line in LineReader(In):
+                if header:
+                    header = False
+                    continue
+                yield line
+        return
 
+    host = urlsplit(u).hostname
+    # Number of lines yielded so far
+    count = 0
+    retry = client.retry_policy.start(host)
+    while await wait_breaker(retry):
+        retry_after = None
+        host_failure = True
+        try:
+            async with client.get(u, headers=HEADERS) as resp:
+                status = classify(resp.status)
+                if status == TRANSIENT:
+                    log.warning(f"Cannot get data (status {resp.status}) for {u}: retry")
+                    retry_after = get_retry_after(resp.headers)
+                elif status == FAILURE:
+                    resp.raise_for_status()
+                else:
+                    # just skip the first line since it contains column headers
+                    header = True
+                    skip = count
+                    async for line in resp.content:
+                        client.metrics.add_bytes(host, len(line))
+                        if header:
+                            if line.lstrip().startswith(b"<"):
+                                raise ValueError(f"Error page instead of {u}")
+                            header = False
+                        elif skip:
+                            skip -= 1
+                        else:
+                            count += 1
+                            yield line.decode("utf-8", errors="replace")
+                    retry.on_success()
+                    client.metrics.observe_retries("missing_symbols", retry.retries)
+                    return
+        except asyncio.CancelledError:
+            raise
+        except ClientResponseError:
+            raise
+        except ValueError as e:
+            log.warning(f"{e}: retry")
+            host_failure = False
+        except Exception as e:
+            log.warning(f"Error with {u} after {count} lines: retry")
+            log.exception(e)
+        delay = retry.on_failure(retry_after, host_failure)
+        if delay is None:
+            break
+        await asyncio.sleep(delay)
 
-async def fetch_missing_symbols(u):
-    log.info("Trying missing symbols from %s" % u)
-    async with ClientSession() as client:
-        async with client.get(u, headers=HEADERS) as resp:
-            # just skip the first line since it contains column headers
-            data = await resp.text()
-            return data.splitlines()[1:]
+    client.metrics.observe_retries("missing_symbols", retry.retries, gave_up=True)
+    raise Exception(f"Cannot get the missing symbols from {u}")
 
 
-async def get_list(filename):
-    alist = set()
-    try:
-        async with AIOFile(filename, "r") as In:
-            async for line in LineReader(In):
-                line = line.rstrip()
-                alist.add(line)
-    except FileNotFoundError:
-        pass
+class Skiplist:
+    """
+    Symbols that we've asked for in the past unsuccessfully.
+    Each entry is rechecked once its retry delay is expired: the delay starts
+    at retry_after seconds and doubles each time the symbol is still missing.
+    Symbols that we know belong to Microsoft are never skiplisted.
+    """
 
-    log.debug(f"{filename} contains {len(alist)} items")
+    def __init__(self, store, retry_after):
+        self.store = store
+        self.retry_after = retry_after
+
+    def get_retry_delay(self, entry):
+        return min(self.retry_after * 2 ** (entry.hits - 1), SKIPLIST_MAX_RETRY_AFTER)
+
+    def is_skipped(self, debug_id, debug_file, now):
+        """
+        Return None if the symbol isn't in the skiplist, True if it must be
+        skipped and False if it's time to check it again.
+        """
+        entry = self.store.get_skipped(debug_id)
+        if entry is None or entry.debug_file != debug_file.lower():
+            return None
+
+        return now - entry.last_seen < self.get_retry_delay(entry)
+
+    def add(self, debug_id, debug_file):
+        debug_file = debug_file.lower()
+        if self.store.in_list(KNOWN_MS_SYMBOLS, debug_file):
+            return
+
+        now = int(time.time())
+        entry = self.store.get_skipped(debug_id)
+        if entry is None or entry.debug_file != debug_file:
+            entry = SkiplistEntry(debug_file, now, now, 1)
+        else:
+            entry = entry._replace(last_seen=now, hits=entry.hits + 1)
+        self.store.set_skipped(debug_id, entry)
+
+    def remove(self, debug_id, debug_file):
+        entry = self.store.get_skipped(debug_id)
+        if entry is not None and entry.debug_file == debug_file.lower():
+            self.store.remove_skipped(debug_id)
+
+    def apply(self, updates):
+        """
+        Apply the updates recorded by a DeferredSkiplist.
+        """
+        for action, debug_id, debug_file in updates:
+            if action == "add":
+                self.add(debug_id, debug_file)
+            else:
+                self.remove(debug_id, debug_file)
 
-    return alist
 
+class DeferredSkiplist(Skiplist):
+    """
+    Skiplist of a worker process: the store is only read and the updates
+    are recorded, to be applied by the parent process.
+    """
 
-async def get_skiplist():
-    skiplist = {}
-    path = "skiplist.txt"
-    try:
-        async with AIOFile(path, "r") as In:
-            async for line in LineReader(In):
-                line = line.strip()
-                if line == "":
-                    continue
-                s = line.split(" ", maxsplit=1)
-                if len(s) != 2:
-                    continue
-                debug_id, debug_file = s
-                skiplist[debug_id] = debug_file.lower()
-    except FileNotFoundError:
-        pass
+    def __init__(self, store, retry_after):
+        super().__init__(store, retry_after)
+        self.updates = []
 
-    log.debug(f"{path} contains {len(skiplist)} items")
+    def add(self, debug_id, debug_file):
+        self.updates.append(("add", debug_id, debug_file))
 
-    return skiplist
+    def remove(self, debug_id, debug_file):
+        self.updates.append(("remove", debug_id, debug_file))
 
 
-def get_missing_symbols(missing_symbols, skiplist, blacklist):
-    modules = defaultdict(set)
-    stats = {"blacklist": 0, "skiplist": 0}
-    for line in missing_symbols:
+def get_priority(store, pdb, skipped):
+    """
+    Get the priority of a module (the lower, the sooner it's processed):
+    the symbols we know belong to Microsoft first, then the unknown ones and
+    finally the ones from the skiplist which are checked again.
+    """
+    if store.in_list(KNOWN_MS_SYMBOLS, pdb):
+        return PRIORITY_KNOWN_MS
+    if skipped is not None:
+        return PRIORITY_SKIPLIST_RETRY
+    return PRIORITY_UNKNOWN
+
+
+async def get_missing_symbols(
+    missing_symbols, skiplist, store, stats, shard=None, process=None
+):
+    """
+    Filter the lines of the missing symbols CSV against the blacklist and the
+    skiplist, and yield ((priority, rank), (pdb, debug_id, code_file, code_id))
+    for each module to process, where rank is the line of its first row (the
+    CSV is sorted by crash count). A module (pdb, debug_id) is yielded once
+    whatever the case of its file and id, since they're the same for the
+    symbol servers: the first row with a code file and id is kept, so the
+    modules of the rows without them are only yielded at the end of the CSV,
+    but with their rank.
+    With shard=(i, N), only the modules of the i-th of N shards are yielded,
+    and with process=(j, P) only the ones of the j-th of P worker processes.
+    """
+    seen = set()
+    without_code = {}
+    now = int(time.time())
+
+    def check_skiplist(module, rank):
+        """
+        Get ((priority, rank), module) or None if the module is in the skiplist.
+        """
+        pdb, debug_id = module[:2]
+        skipped = skiplist.is_skipped(debug_id, pdb, now)
+        if skipped:
+            stats["skiplist"] += 1
+            # We've asked the symbol server previously about this,
+            # so skip it.
+            log.debug("%s/%s already in skiplist", pdb, debug_id)
+            return None
+        if skipped is not None:
+            stats["skiplist_retry"] += 1
+            log.debug("%s/%s in skiplist but checked again", pdb, debug_id)
+        return (get_priority(store, pdb, skipped), rank), module
+
+    async for line in missing_symbols:
+        stats["total"] += 1
         line = line.rstrip()
         bits = line.split(",")
         if len(bits) < 2:
@@ -204,34 +616,67 @@ def get_missing_symbols(missing_symbols, skiplist, blacklist):
         if len(bits) >= 4:
             code_file, code_id = bits[2:4]
         if pdb and debug_id and pdb.endswith(".pdb"):
-            if pdb.lower() in blacklist:
+            if shard is not None and get_shard(pdb, debug_id, shard[1]) != shard[0]:
+                stats["other_shard"] += 1
+                continue
+            if (
+                process is not None
+                and get_shard(pdb, debug_id, process[1], PROCESS_SALT) != process[0]
+            ):
+                stats["other_process"] += 1
+                continue
+
+            if store.in_list(BLACKLIST, pdb):
                 stats["blacklist"] += 1
                 continue
 
-            if skiplist.get(debug_id) != pdb.lower():
-                modules[pdb].add((debug_id, code_file, code_id))
-            else:
-                stats["skiplist"] += 1
-                # We've asked the symbol server previously about this,
-                # so skip it.
-                log.debug("%s/%s already in skiplist", pdb, debug_id)
+            module = (pdb, debug_id, code_file, code_id)
+            key = (pdb.lower(), debug_id.upper())
+            if key in seen:
+                stats["duplicate"] += 1
+                continue
+            if not (code_file and code_id):
+                if key in without_code:
+                    stats["duplicate"] += 1
+                else:
+                    without_code[key] = module, stats["total"]
+                continue
+            rank = stats["total"]
+            if key in without_code:
+                stats["duplicate"] += 1
+                _, rank = without_code.pop(key)
+            seen.add(key)
+
+            item = check_skiplist(module, rank)
+            if item is not None:
+                yield item
 
-    return modules, stats
+    for module, rank in without_code.values():
+        item = check_skiplist(module, rank)
+        if item is not None:
+            yield item
 
 
-async def collect_info(client, filename, debug_id, code_file, code_id):
+async def collect_info(client, cache, flights, filename, debug_id, code_file, code_id):
     pdb_path = os.path.join(filename, debug_id, filename)
     sym_path = os.path.join(filename, debug_id, filename.replace(".pdb", "") + ".sym")
 
-    has_pdb = await server_has_file(client, MICROSOFT_SYMBOL_SERVER, pdb_path)
+    has_pdb = await server_has_file(
+        client, cache, flights, MICROSOFT_SYMBOL_SERVER, pdb_path
+    )
     has_code = is_there = False
     if has_pdb:
-        if not await server_has_file(client, MOZILLA_SYMBOL_SERVER, sym_path):
-            has_code = (
+        if not await server_has_file(
+            client, cache, flights, MOZILLA_SYMBOL_SERVER, sym_path
+        ):
+            # Without an answer for the binary, the pdb is dumped alone.
+            has_code = bool(
                 code_file
                 and code_id
                 and await server_has_file(
                     client,
+                    cache,
+                    flights,
                     MICROSOFT_SYMBOL_SERVER,
                     f"{code_file}/{code_id}/{code_file}",
                 )
@@ -246,43 +691,134 @@ async def collect_info(client, filename, debug_id, code_file, code_id):
 
 async def check_x86_file(path):
     async with AIOFile(path, "rb") as In:
-        head = b"MODULE windows x86 "
-        chunk = await In.read(len(head))
-        if chunk == head:
+        chunk = await In.read(len(X86_MODULE))
+        if chunk == X86_MODULE:
             return True
     return False
 
 
-async def run_command(cmd):
-    proc = await asyncio.create_subprocess_shell(
-        cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+def wait_command(cmd, read_output=None):
+    """
+    Run cmd and return its stderr with its resource usage and the result of
+    read_output(stdout of cmd), or None when read_output is None and the
+    output is discarded. If read_output stops reading early, cmd gets a
+    broken pipe. The process is reaped with wait4 to get the usage of this
+    process only.
+    """
+    proc = subprocess.Popen(
+        cmd,
+        shell=True,
+        stdout=subprocess.DEVNULL if read_output is None else subprocess.PIPE,
+        stderr=subprocess.PIPE,
     )
-    _, err = await proc.communicate()
-    err = err.decode().strip()
+    result = None
+    try:
+        if read_output is None:
+            err = proc.stderr.read()
+        else:
+            # Read stderr aside so that cmd can't block on it.
+            errors = []
+            thread = threading.Thread(target=lambda: errors.append(proc.stderr.read()))
+            thread.start()
+            try:
+                with proc.stdout:
+                    result = read_output(proc.stdout)
+            finally:
+                thread.join()
+            err = errors[0]
+    finally:
+        proc.stderr.close()
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = status
+
+    return err.decode().strip(), rusage, result
+
+
+async def run_command(cmd, executor, read_output=None):
+    """
+    Run wait_command in executor: its threads spend their time waiting for
+    the command, so it has one per command running at the same time.
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor, wait_command, cmd, read_output)
 
-    return err
+
+def zip_output(writer, sym_path, has_code):
+    """
+    Get a function compressing the output of dump_syms for the zip entry
+    sym_path with writer and returning (zip entry, path of the compressed
+    data), or None without reading further if it's useless (see dump_module).
+    """
+
+    def read_output(In):
+        head = In.read(len(X86_MODULE))
+        # A shorter output is an error: let dump_syms tell it.
+        if not has_code and len(head) == len(X86_MODULE) and head != X86_MODULE:
+            return None
+        return writer.compress_stream(In, sym_path, head)
+
+    return read_output
 
 
 async def dump_module(
-    output, symcache, filename, debug_id, code_file, code_id, has_code, dump_syms
+    output,
+    symcache,
+    filename,
+    debug_id,
+    code_file,
+    code_id,
+    has_code,
+    dump_syms,
+    metrics,
+    executor,
+    writer=None,
 ):
+    """
+    Dump the module with a thread of executor and return (path of the symbol file, None), or with a
+    writer (path of the symbol file, its zip entry from writer.compress_stream):
+    the output of dump_syms is then compressed as it comes, without writing
+    the symbol file in output.
+    Return 1 on error and 2 for useless symbols.
+    """
     sym_path = os.path.join(filename, debug_id, filename.replace(".pdb", ".sym"))
     output_path = os.path.join(output, sym_path)
     sym_srv = SYM_SRV.format(symcache)
 
     if has_code:
-        cmd = f"{dump_syms} {code_file} --code-id {code_id} --store {output} --symbol-server '{sym_srv}' --verbose error"
+        cmd = f"{dump_syms} {code_file} --code-id {code_id}"
     else:
-        cmd = f"{dump_syms} {filename} --debug-id {debug_id} --store {output} --symbol-server '{sym_srv}' --verbose error"
-
-    err = await run_command(cmd)
+        cmd = f"{dump_syms} {filename} --debug-id {debug_id}"
+    if writer is None:
+        cmd += f" --store {output}"
+        read_output = None
+    else:
+        read_output = zip_output(writer, sym_path, has_code)
+    cmd += f" --symbol-server '{sym_srv}' --verbose error"
+
+    start = time.monotonic()
+    err, rusage, entry = await run_command(cmd, executor, read_output)
+    # ru_maxrss is in kB on Linux
+    metrics.observe_dump(
+        f"{filename}/{debug_id}",
+        time.monotonic() - start,
+        rusage.ru_utime + rusage.ru_stime,
+        rusage.ru_maxrss * 1024,
+    )
 
-    if err:
+    if writer is None:
+        useless = not err and not has_code and not await check_x86_file(output_path)
+    else:
+        # The output has been checked as it came and dump_syms stopped with
+        # a broken pipe if it's useless.
+        useless = entry is None
+    if err and not useless:
         log.error(f"Error with {cmd}")
         log.error(err)
+        if entry is not None:
+            os.remove(entry[1])
         return 1
 
-    if not has_code and not await check_x86_file(output_path):
+    if useless:
         # PDB for 32 bits contains everything we need (symbols + stack unwind info)
         # But PDB for 64 bits don't contain stack unwind info (they're in the binary (.dll/.exe) itself).
         # So here we're logging because we've a PDB (64 bits) without its DLL/EXE
@@ -293,152 +829,1215 @@ async def dump_module(
         return 2
 
     log.info(f"Successfully dumped: {filename}/{debug_id}")
-    return sym_path
+    return sym_path, entry
 
 
-async def dump(output, symcache, modules, dump_syms):
-    tasks = []
-    for filename, debug_id, code_file, code_id, has_code in modules:
-        tasks.append(
-            dump_module(
-                output,
-                symcache,
-                filename,
-                debug_id,
-                code_file,
-                code_id,
-                has_code,
-                dump_syms,
-            )
+def new_client(metrics, retry_policy, processes=1):
+    """
+    Create the client shared by all the requests: the number of connections
+    and the rate of requests to each host are handled by its limiter.
+    With several processes, each one gets its share of the limits.
+    """
+    # In case of errors (Too many open files), just change limit
+    connector = TCPConnector(limit=max(1, CONNECTIONS // processes), limit_per_host=0)
+    session = ClientSession(timeout=ClientTimeout(total=TIMEOUT), connector=connector)
+
+    return RateLimitedClient(
+        session,
+        {host: limits.split(processes) for host, limits in HOST_LIMITS.items()},
+        DEFAULT_HOST_LIMITS.split(processes),
+        metrics,
+        retry_policy,
+    )
+
+
+async def make_dirs(path):
+    loop = asyncio.get_event_loop()
+
+    def helper(path):
+        os.makedirs(path, exist_ok=True)
+
+    await loop.run_in_executor(None, helper, path)
+
+
+def link_file(src, dst):
+    """
+    Hard link src to dst (or copy it when it isn't possible) unless dst exists.
+    """
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        pass
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+async def fetch_compressed(client, cache, flights, cab_executor, path, output_path):
+    """
+    Fetch the compressed variant of the file (foo.pd_ for foo.pdb), often
+    several times smaller, and extract it in output_path with cab_executor.
+    Return False when the server doesn't have it or it can't be extracted:
+    the plain file must be fetched instead.
+    """
+    cab_path = get_cab_name(path)
+    if not await server_has_file(
+        client, cache, flights, MICROSOFT_SYMBOL_SERVER, cab_path
+    ):
+        return False
+    cab_output_path = get_cab_name(output_path)
+    if not await fetch_file(client, MICROSOFT_SYMBOL_SERVER, cab_path, cab_output_path):
+        return False
+
+    loop = asyncio.get_event_loop()
+    try:
+        # Decompression is CPU bound so keep it out of the event loop.
+        await loop.run_in_executor(
+            cab_executor, extract_cab, cab_output_path, output_path
         )
+    except (CabError, OSError) as e:
+        log.warning(f"Cannot extract {cab_path}: {e}")
+        # Don't try this one again.
+        cache.put(MICROSOFT_SYMBOL_SERVER, cab_path, False)
+        return False
+    finally:
+        os.remove(cab_output_path)
 
-    res = await asyncio.gather(*tasks)
-    file_index = {x for x in res if isinstance(x, str)}
-    stats = {
-        "dump_error": sum(1 for x in res if x == 1),
-        "no_bin": sum(1 for x in res if x == 2),
-    }
+    with open(output_path, "rb") as In:
+        typ = get_type(In.read(MAGIC_SIZE))
+    if typ in {"unknown", "pdb-v2"}:
+        os.remove(output_path)
+        return False
 
-    return file_index, stats
+    log.debug(f"Extracted {cab_path}")
+    return True
+
+
+async def lock_file(symcache, filename, file_id):
+    """
+    Lock the file of the symbol cache against the other worker processes
+    and return (lock, whether another process had it).
+    """
+    waited = False
+    while True:
+        lock = symcache.lock(filename, file_id)
+        if lock is not None:
+            return lock, waited
+        waited = True
+        await asyncio.sleep(LOCK_DELAY)
+
+
+async def fetch_and_write(
+    symcache, client, cache, flights, cab_executor, filename, file_id
+):
+    """
+    Download the file in the symbol cache unless it's already there: its
+    compressed variant first when cab_executor isn't None, or else (or if
+    it's missing) the plain file. The concurrent downloads of the same file
+    share the same request, in this process, and wait for each other across
+    the worker processes sharing the cache.
+    Return True or, like fetch_file, False or None when it's not fetched.
+    """
+    if symcache.get(filename, file_id) is not None:
+        log.debug(f"Symbol cache hit: {filename}/{file_id}")
+        return True
 
+    path = os.path.join(filename, file_id, filename)
+    output_path = symcache.get_path(filename, file_id)
+
+    async def download():
+        await make_dirs(os.path.dirname(output_path))
+        lock, waited = await lock_file(symcache, filename, file_id)
+        try:
+            if waited and symcache.get(filename, file_id) is not None:
+                # Downloaded by another process
+                return output_path
+            # An interrupted download of the plain file is resumed instead.
+            compressed = (
+                cab_executor is not None
+                and not get_partial_size(output_path)
+                and await fetch_compressed(
+                    client, cache, flights, cab_executor, path, output_path
+                )
+            )
+            if not compressed:
+                fetched = await fetch_file(
+                    client, MICROSOFT_SYMBOL_SERVER, path, output_path
+                )
+                if not fetched:
+                    return fetched
+            symcache.add(filename, file_id)
+            return output_path
+        finally:
+            symcache.unlock(lock)
+
+    downloaded = await flights.run(
+        get_flight_key(MICROSOFT_SYMBOL_SERVER, path), download
+    )
+    if not downloaded:
+        return downloaded
+
+    if downloaded != output_path:
+        # It's the same file with a different case, dump_syms needs it
+        # where it expects it.
+        await make_dirs(os.path.dirname(output_path))
+        link_file(downloaded, output_path)
+        symcache.add(filename, file_id)
+
+    return True
 
-async def collect(modules):
+
+def check_pdb(path, debug_id):
+    """
+    Check the headers of the pdb and return its architecture (None if unknown).
+    """
+    with open(path, "rb") as In:
+        if get_type(In.read(MAGIC_SIZE)) != "pdb-v7":
+            # e.g. a cab: dump_syms will tell
+            return None
+    info = read_pdb_info(path)
+    if info.debug_id != debug_id.upper():
+        raise FormatError(f"Unexpected debug id {info.debug_id}")
+    return info.arch
+
+
+def check_binary(path, code_id):
+    """
+    Check the headers of the binary and return (debug file, debug id) of its pdb.
+    """
+    with open(path, "rb") as In:
+        if get_type(In.read(MAGIC_SIZE)) != "dll":
+            return None, None
+    info = read_pe_info(path)
+    if info.code_id.upper() != code_id.upper():
+        raise FormatError(f"Unexpected code id {info.code_id}")
+    return info.debug_file, info.debug_id
+
+
+async def inspect_module(symcache, module, stats):
+    """
+    Check the headers of the downloaded files of the module before dumping it
+    and return the module, or None when the dump would be wasted:
+     - a corrupt file, or not the one we asked for, is removed from the symbol
+       cache to be downloaded again by the next run;
+     - only the pdbs for x86 contain the stack unwind info, the other ones
+       are useless without their binary (see dump_module).
+    A binary which isn't the one of the pdb is ignored.
+    """
+    filename, debug_id, code_file, code_id, has_code = module
     loop = asyncio.get_event_loop()
-    tasks = []
-
-    # In case of errors (Too many open files), just change limit_per_host
-    connector = TCPConnector(limit=100, limit_per_host=0)
-
-    async with ClientSession(
-        loop=loop, timeout=ClientTimeout(total=TIMEOUT), connector=connector
-    ) as client:
-        for filename, ids in modules.items():
-            for debug_id, code_file, code_id in ids:
-                tasks.append(
-                    collect_info(client, filename, debug_id, code_file, code_id)
+
+    try:
+        arch = await loop.run_in_executor(
+            None, check_pdb, symcache.get_path(filename, debug_id), debug_id
+        )
+    except (FormatError, OSError) as e:
+        log.warning(f"Bad pdb {filename}/{debug_id}: {e}")
+        symcache.remove(filename, debug_id)
+        stats["corrupt"] += 1
+        return None
+
+    if has_code:
+        try:
+            pdb_file, pdb_id = await loop.run_in_executor(
+                None, check_binary, symcache.get_path(code_file, code_id), code_id
+            )
+        except (FormatError, OSError) as e:
+            log.warning(f"Bad binary {code_file}/{code_id}: {e}")
+            symcache.remove(code_file, code_id)
+            stats["corrupt"] += 1
+            has_code = False
+        else:
+            if pdb_id is not None and (
+                pdb_file.lower() != filename.lower() or pdb_id != debug_id.upper()
+            ):
+                log.warning(
+                    f"The binary {code_file}/{code_id} is for {pdb_file}/{pdb_id}, not {filename}/{debug_id}"
                 )
+                stats["mismatch"] += 1
+                has_code = False
 
-        res = await asyncio.gather(*tasks)
-    to_dump = []
-    stats = {"no_pdb": 0, "is_there": 0}
-    for filename, debug_id, code_file, code_id, has_pdb, has_code, is_there in res:
-        if not has_pdb:
-            if is_there:
-                stats["is_there"] += 1
-            else:
-                stats["no_pdb"] += 1
-                log.info(f"No pdb for {filename}/{debug_id}")
-            continue
+    if not has_code and arch not in {None, "x86"}:
+        log.debug(f"{arch} binary for {filename}/{debug_id} required: not dumped")
+        stats["no_bin"] += 1
+        stats["dump_avoided"] += 1
+        return None
 
-        log.info(
-            f"To dump: {filename}/{debug_id}, {code_file}/{code_id} and has_code = {has_code}"
+    return filename, debug_id, code_file, code_id, has_code
+
+
+async def probe_stage(client, cache, flights, skiplist, journal, item, stats):
+    priority, (filename, debug_id, code_file, code_id) = item
+    filename, debug_id, code_file, code_id, has_pdb, has_code, is_there = await collect_info(
+        client, cache, flights, filename, debug_id, code_file, code_id
+    )
+    if not has_pdb:
+        if is_there:
+            stats["is_there"] += 1
+            skiplist.remove(debug_id, filename)
+        elif has_pdb is None:
+            # Only the definitive answers go to the skiplist, this one is
+            # checked again by the next run.
+            stats["probe_error"] += 1
+            log.warning(f"Cannot know if there's a pdb for {filename}/{debug_id}")
+        else:
+            stats["no_pdb"] += 1
+            log.info(f"No pdb for {filename}/{debug_id}")
+            skiplist.add(debug_id, filename)
+        return None
+
+    skiplist.remove(debug_id, filename)
+
+    log.info(
+        f"To dump: {filename}/{debug_id}, {code_file}/{code_id} and has_code = {has_code}"
+    )
+    stats["to_dump"] += 1
+    module = (filename, debug_id, code_file, code_id, has_code)
+    journal.set(module, PROBED)
+
+    return (priority, module)
+
+
+def get_module_size(output, module):
+    """
+    Get the size of the downloaded files for the module or None if they're missing.
+    """
+    filename, debug_id, code_file, code_id, has_code = module
+    try:
+        size = os.path.getsize(os.path.join(output, filename, debug_id, filename))
+        if has_code:
+            size += os.path.getsize(os.path.join(output, code_file, code_id, code_file))
+    except FileNotFoundError:
+        return None
+    return size
+
+
+def pin_module(symcache, module):
+    """
+    Keep the downloaded files of the module in the symbol cache until
+    unpin_module: the downloads of the other modules mustn't evict them
+    before the module is dumped.
+    """
+    filename, debug_id, code_file, code_id, has_code = module
+    symcache.pin(filename, debug_id)
+    if has_code:
+        symcache.pin(code_file, code_id)
+
+
+def unpin_module(symcache, module):
+    filename, debug_id, code_file, code_id, has_code = module
+    symcache.unpin(filename, debug_id)
+    if has_code:
+        symcache.unpin(code_file, code_id)
+
+
+async def fetch_stage(
+    symcache, client, cache, flights, cab_executor, skiplist, journal, item, stats
+):
+    priority, requested = item
+    filename, debug_id = requested[:2]
+    pin_module(symcache, requested)
+    try:
+        module = await fetch_module(
+            symcache, client, cache, flights, cab_executor, skiplist, requested, stats
+        )
+    finally:
+        unpin_module(symcache, requested)
+    if module is None:
+        journal.remove(filename, debug_id)
+        return None
+
+    size = get_module_size(symcache.path, module)
+    if size is None:
+        # Evicted by another process sharing the symbol cache
+        log.warning(f"The files of {filename}/{debug_id} aren't in the symbol cache")
+        stats["fetch_error"] += 1
+        journal.remove(filename, debug_id)
+        return None
+    # Unpinned once dumped
+    pin_module(symcache, module)
+    journal.set(module, FETCHED)
+
+    # The size of the inputs is used to dump the biggest modules first
+    # (among the ones with the same priority, whatever their rank).
+    return ((priority[0], -size), module)
+
+
+async def fetch_module(
+    symcache, client, cache, flights, cab_executor, skiplist, module, stats
+):
+    """
+    Download the files of the module and return the module to dump, or None.
+    """
+    filename, debug_id, code_file, code_id, has_code = module
+    # The pdb and the binary are independent downloads, so do them together.
+    if has_code:
+        fetched_pdb, has_code = await asyncio.gather(
+            fetch_and_write(
+                symcache, client, cache, flights, cab_executor, filename, debug_id
+            ),
+            fetch_and_write(
+                symcache, client, cache, flights, cab_executor, code_file, code_id
+            ),
+        )
+    else:
+        fetched_pdb = await fetch_and_write(
+            symcache, client, cache, flights, cab_executor, filename, debug_id
         )
-        to_dump.append((filename, debug_id, code_file, code_id, has_code))
 
-    log.info(f"Collected {len(to_dump)} files to dump")
+    if not fetched_pdb:
+        stats["fetch_error"] += 1
+        if fetched_pdb is False:
+            # The pdb is too old or not there anymore. If we gave up (the
+            # server kept failing or the deadline is close), the next run
+            # tries again.
+            skiplist.add(debug_id, filename)
+        return None
+
+    return await inspect_module(
+        symcache, (filename, debug_id, code_file, code_id, has_code), stats
+    )
 
-    return to_dump, stats
 
+async def dump_stage(
+    output, symcache, dump_syms, executor, writer, journal, item, stats, metrics
+):
+    _, module = item
+    filename, debug_id, code_file, code_id, has_code = module
+    try:
+        res = await dump_module(
+            output,
+            symcache.path,
+            filename,
+            debug_id,
+            code_file,
+            code_id,
+            has_code,
+            dump_syms,
+            metrics,
+            executor,
+            writer,
+        )
+    finally:
+        unpin_module(symcache, module)
+    if res == 1:
+        stats["dump_error"] += 1
+        return None
+    if res == 2:
+        stats["no_bin"] += 1
+        return None
 
-async def make_dirs(path):
-    loop = asyncio.get_event_loop()
+    sym_path, entry = res
+    # Without a symbol file on disk (entry isn't None), a resumed run dumps
+    # the module again.
+    journal.set(module, DUMPED, sym_path=sym_path)
 
-    def helper(path):
-        os.makedirs(path, exist_ok=True)
+    return (module, sym_path, entry)
 
-    await loop.run_in_executor(None, helper, path)
 
+class StageQueue(asyncio.PriorityQueue):
+    """
+    Queue of (key, module) giving the modules with the lowest key first:
+    the key is (priority, rank in the CSV) and, for the dumps, (priority,
+    opposite of the size of the module) so that the longest dumps don't hold
+    up the end of the run.
+    The None marking the end of the stream always comes last.
+    """
 
-async def fetch_and_write(output, client, filename, file_id):
-    path = os.path.join(filename, file_id, filename)
-    data = await fetch_file(client, MICROSOFT_SYMBOL_SERVER, path)
+    def _init(self, maxsize):
+        super()._init(maxsize)
+        # Insertion counter, to keep the order between modules with the same key
+        self._count = 0
 
-    if not data:
-        return False
+    def _put(self, item):
+        self._count += 1
+        key = (1,) if item is None else (0, item[0])
+        heapq.heappush(self._queue, (key, self._count, item))
 
-    output_dir = os.path.join(output, filename, file_id)
-    await make_dirs(output_dir)
+    def _get(self):
+        return heapq.heappop(self._queue)[2]
 
-    output_path = os.path.join(output_dir, filename)
-    async with AIOFile(output_path, "wb") as Out:
-        await Out.write(data)
 
-    return True
+def get_dump_jobs():
+    """
+    Get the number of dump_syms which can run in parallel according to
+    the number of cpus and the available memory.
+    """
+    cpus = os.cpu_count() or 1
+    try:
+        with open("/proc/meminfo", "r") as In:
+            for line in In:
+                if line.startswith("MemAvailable:"):
+                    # The value is in kB
+                    memory = int(line.split()[1]) * 1024
+                    break
+            else:
+                return cpus
+    except (OSError, ValueError):
+        return cpus
+
+    return max(1, min(cpus, memory // DUMP_MEMORY))
+
+
+async def run_stage(func, in_queue, out_queue, workers, stage, stop=None):
+    """
+    Run func on every item coming from in_queue with the given number of workers.
+    Results which aren't None are pushed to out_queue, and once in_queue is
+    exhausted a None is pushed to out_queue to signal the end of the stream.
+    The time spent on each item is recorded in stage (a StageMetrics).
+    Once the event stop is set, the items left are dropped (the ones in
+    progress still go to out_queue).
+    """
 
+    async def worker():
+        while True:
+            item = await in_queue.get()
+            if item is None:
+                # Put it back for the other workers of this stage.
+                await in_queue.put(None)
+                return
+            if stop is not None and stop.is_set():
+                stage.drop()
+                continue
+            start = time.monotonic()
+            try:
+                res = await func(item)
+            except Exception as e:
+                stage.observe(time.monotonic() - start, error=True)
+                log.error(f"Unexpected error with {item}")
+                log.exception(e)
+                continue
+            stage.observe(time.monotonic() - start)
+            if res is not None:
+                await out_queue.put(res)
+
+    stage.started()
+    await asyncio.gather(*[worker() for _ in range(workers)])
+    stage.finished()
+    await out_queue.put(None)
+
+
+class ZipWriter:
+    """
+    Append symbol files to the output zips as soon as they're dumped.
+    The symbols are split in several zips (shards) of at most shard_size bytes
+    named after output (foo.zip gives foo-000.zip, foo-001.zip, ...), and a
+    manifest listing them is written next to them (foo.json), even if
+    there's nothing to put in the zips so that the upload knows it.
+
+    The entries are deflated in parallel by compress() (zlib releases the GIL,
+    so threads are enough) into temporary files which are then appended
+    to the zip, one at a time, by append(). compress_stream() does the same
+    for the output of dump_syms, without a symbol file on disk.
+    """
 
-async def fetch_all(output, modules):
+    def __init__(self, output, output_dir, level, shard_size):
+        self.output_base = os.path.splitext(output)[0]
+        self.output_dir = output_dir
+        self.level = level
+        self.shard_size = shard_size
+        self.zip = None
+        self.shards = []
+        self.file_index = set()
+
+    def deflate(self, In, zinfo, head=b""):
+        """
+        Deflate head and the data read from In for the zip entry zinfo and
+        return the path of the compressed data.
+        """
+        tmp_path = os.path.join(self.output_dir, zinfo.filename) + ".deflate"
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        # Raw deflate stream, as stored in zip files
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        crc = zlib.crc32(head)
+        size = len(head)
+        with open(tmp_path, "wb") as Out:
+            Out.write(compressor.compress(head))
+            for chunk in iter(lambda: In.read(CHUNK_SIZE), b""):
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+                Out.write(compressor.compress(chunk))
+            Out.write(compressor.flush())
+            zinfo.compress_size = Out.tell()
+        zinfo.CRC = crc
+        zinfo.file_size = size
+
+        return tmp_path
+
+    def compress(self, f):
+        """
+        Deflate the file f and return the zip entry for it with the path of
+        the compressed data.
+        """
+        path = os.path.join(self.output_dir, f)
+        zinfo = zipfile.ZipInfo.from_file(path, f)
+        with open(path, "rb") as In:
+            tmp_path = self.deflate(In, zinfo)
+
+        return zinfo, tmp_path
+
+    def compress_stream(self, In, f, head=b""):
+        """
+        Same as compress for the file f whose data are head and then the
+        ones read from the stream In.
+        """
+        zinfo = zipfile.ZipInfo(f, time.localtime()[:6])
+        zinfo.external_attr = (stat.S_IFREG | 0o644) << 16
+        os.makedirs(os.path.dirname(os.path.join(self.output_dir, f)), exist_ok=True)
+        tmp_path = self.deflate(In, zinfo, head)
+
+        return zinfo, tmp_path
+
+    def open_shard(self):
+        path = f"{self.output_base}-{len(self.shards):03d}.zip"
+        self.zip = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED)
+        self.shards.append({"name": os.path.basename(path), "entries": 0, "files": []})
+
+    def close_shard(self):
+        self.zip.close()
+        self.shards[-1]["size"] = os.path.getsize(self.zip.filename)
+        log.info(f"Wrote zip as {self.zip.filename}")
+        self.zip = None
+
+    def append(self, zinfo, tmp_path):
+        header = zinfo.FileHeader()
+        if (
+            self.zip is not None
+            and self.shards[-1]["entries"]
+            and self.zip.fp.tell() + len(header) + zinfo.compress_size
+            > self.shard_size
+        ):
+            self.close_shard()
+        if self.zip is None:
+            self.open_shard()
+
+        # zipfile can't write already compressed data, so write the entry
+        # (local header + data) ourselves and register it for the central directory.
+        # This relies on private attributes of ZipFile (fp, filelist,
+        # NameToInfo, start_dir and _didModify), the same from CPython 3.7
+        # (the one of the Docker image) to 3.12: check them when upgrading
+        # Python. bench/run_benchmark.py tests the zips it gets.
+        zinfo.header_offset = self.zip.fp.tell()
+        self.zip.fp.write(header)
+        with open(tmp_path, "rb") as In:
+            shutil.copyfileobj(In, self.zip.fp, CHUNK_SIZE)
+        self.zip.filelist.append(zinfo)
+        self.zip.NameToInfo[zinfo.filename] = zinfo
+        self.zip.start_dir = self.zip.fp.tell()
+        self.zip._didModify = True
+        self.shards[-1]["entries"] += 1
+        self.shards[-1]["files"].append(zinfo.filename)
+        os.remove(tmp_path)
+
+    def close(self):
+        if self.zip is not None:
+            self.close_shard()
+        manifest = f"{self.output_base}.json"
+        with open(manifest, "w") as Out:
+            json.dump({"shards": self.shards}, Out, indent=2)
+        log.info(f"Wrote manifest for {len(self.shards)} zips as {manifest}")
+
+
+async def zip_stage(writer, journal, in_queue, jobs, stage):
     loop = asyncio.get_event_loop()
-    tasks = []
-    fetched_modules = []
-
-    # In case of errors (Too many open files), just change limit_per_host
-    connector = TCPConnector(limit=100, limit_per_host=0)
-
-    async with ClientSession(
-        loop=loop, timeout=ClientTimeout(total=TIMEOUT), connector=connector
-    ) as client:
-        for filename, debug_id, code_file, code_id, has_code in modules:
-            tasks.append(fetch_and_write(output, client, filename, debug_id))
-            if has_code:
-                tasks.append(fetch_and_write(output, client, code_file, code_id))
-
-        res = await asyncio.gather(*tasks)
-        res = iter(res)
-        for filename, debug_id, code_file, code_id, has_code in modules:
-            fetched_pdb = next(res)
-            if has_code:
-                has_code = next(res)
-            if fetched_pdb:
-                fetched_modules.append(
-                    (filename, debug_id, code_file, code_id, has_code)
-                )
+    executor = ThreadPoolExecutor(jobs)
+    lock = asyncio.Lock()
+
+    async def compress(item):
+        # The entry is None unless the file has been compressed while dumped.
+        module, f, entry = item
+        if f in writer.file_index:
+            log.debug(f"{f} is already in the zip")
+            if entry is not None:
+                os.remove(entry[1])
+        else:
+            writer.file_index.add(f)
+            if entry is None:
+                # Compression is CPU bound so keep it out of the event loop.
+                entry = await loop.run_in_executor(executor, writer.compress, f)
+            async with lock:
+                await loop.run_in_executor(executor, writer.append, *entry)
+        journal.set(module, ZIPPED, sym_path=f)
 
-    return fetched_modules
+    try:
+        await run_stage(compress, in_queue, asyncio.Queue(), jobs, stage)
+        await loop.run_in_executor(executor, writer.close)
+    finally:
+        executor.shutdown(wait=False)
+
+
+async def produce(
+    modules,
+    journal,
+    symbol_path,
+    symcache,
+    probe_queue,
+    fetch_queue,
+    dump_queue,
+    zip_queue,
+    stats,
+):
+    """
+    Push the modules in the pipeline as they come. The modules which have been
+    processed partially by a previous run go directly to the stage where they stopped.
+    The end of the stream is pushed even if it's cancelled (when the run
+    is stopped before its deadline).
+    """
+    try:
+        async for priority, module in modules:
+            filename, debug_id, code_file, code_id = module
+            entry = journal.get(filename, debug_id)
+            if entry is not None:
+                state, has_code, sym_path = entry
+                resumed = (filename, debug_id, code_file, code_id, has_code)
+                if state in {DUMPED, ZIPPED} and os.path.isfile(
+                    os.path.join(symbol_path, sym_path)
+                ):
+                    stats["resumed"] += 1
+                    await zip_queue.put((resumed, sym_path, None))
+                    continue
+                if state in {FETCHED, DUMPED, ZIPPED}:
+                    size = get_module_size(symcache.path, resumed)
+                    if size is not None:
+                        stats["resumed"] += 1
+                        # Unpinned once dumped
+                        pin_module(symcache, resumed)
+                        await dump_queue.put(((priority[0], -size), resumed))
+                        continue
+                stats["resumed"] += 1
+                await fetch_queue.put((priority, resumed))
+                continue
 
+            await probe_queue.put((priority, module))
+    except asyncio.CancelledError:
+        log.info("Stopped reading the missing symbols")
+    finally:
+        # The probe queue isn't bounded, so this can't block.
+        probe_queue.put_nowait(None)
+
+
+async def pipeline(
+    *,
+    output,
+    symbol_path,
+    symcache,
+    missing_symbols,
+    store,
+    probe_cache,
+    skiplist,
+    journal,
+    dump_syms,
+    dump_jobs,
+    pipe_dumps,
+    zip_jobs,
+    zip_level,
+    zip_shard_size,
+    stats,
+    metrics,
+    retry_policy,
+    cab_executor,
+    shard,
+    process,
+    stop_time,
+):
+    """
+    Probe, fetch, dump and zip the modules in a streaming way: each module
+    goes to the next stage as soon as it's ready, the queues between the
+    stages are bounded so a slow stage applies backpressure on the previous one.
+    At stop_time (a timestamp or None), the missing symbols aren't read anymore
+    and the modules waiting to be probed, fetched or dumped are dropped, so
+    that the run ends with the zips of what was dumped so far.
+    The arguments are keyword-only, there are too many to keep their order right.
+    """
+    # The probe queue isn't bounded: this way the missing symbols CSV is read
+    # as fast as it comes and the modules with the highest priority are
+    # probed first among all the ones read so far.
+    probe_queue = StageQueue()
+    fetch_queue = StageQueue(QUEUE_SIZE)
+    dump_queue = StageQueue(QUEUE_SIZE)
+    zip_queue = asyncio.Queue(QUEUE_SIZE)
+    writer = ZipWriter(output, symbol_path, zip_level, zip_shard_size)
+    probe_flights = SingleFlight("probe", stats)
+    fetch_flights = SingleFlight("fetch", stats)
+    sampler = asyncio.ensure_future(
+        metrics.sample_queues(
+            {
+                "probe": probe_queue,
+                "fetch": fetch_queue,
+                "dump": dump_queue,
+                "zip": zip_queue,
+            }
+        )
+    )
 
-def get_base_data(url):
-    async def helper(url):
-        return await asyncio.gather(
-            fetch_missing_symbols(url),
-            # Symbols that we know belong to us, so don't ask Microsoft for them.
-            get_list("blacklist.txt"),
-            # Symbols that we know belong to Microsoft, so don't skiplist them.
-            get_list("known-microsoft-symbols.txt"),
-            # Symbols that we've asked for in the past unsuccessfully
-            get_skiplist(),
+    async def flush_periodically():
+        # The writes are committed by batches: don't leave the last ones
+        # pending while there are no new ones.
+        while True:
+            await asyncio.sleep(COMMIT_INTERVAL)
+            for db in (journal.db, probe_cache.db, store.db, symcache.db):
+                db.flush()
+
+    flusher = asyncio.ensure_future(flush_periodically())
+    # The dumps get their own threads, one per job: with the default
+    # executor of the loop, they would compete with the checks of the
+    # downloaded files, and its size doesn't depend on the dump jobs.
+    dump_executor = ThreadPoolExecutor(dump_jobs)
+    stop = asyncio.Event()
+
+    async def stop_later(producer):
+        await asyncio.sleep(max(0, stop_time - time.time()))
+        log.warning("Close to the deadline: stop and zip what was dumped")
+        stop.set()
+        producer.cancel()
+
+    processes = 1 if process is None else process[1]
+    async with new_client(metrics, retry_policy, processes) as client:
+        modules = get_missing_symbols(
+            fetch_missing_symbols(client, missing_symbols),
+            skiplist,
+            store,
+            stats,
+            shard,
+            process,
+        )
+        producer = asyncio.ensure_future(
+            produce(
+                modules,
+                journal,
+                symbol_path,
+                symcache,
+                probe_queue,
+                fetch_queue,
+                dump_queue,
+                zip_queue,
+                stats,
+            )
         )
+        stopper = None
+        if stop_time is not None:
+            stopper = asyncio.ensure_future(stop_later(producer))
+        await asyncio.gather(
+            producer,
+            run_stage(
+                lambda m: probe_stage(
+                    client, probe_cache, probe_flights, skiplist, journal, m, stats
+                ),
+                probe_queue,
+                fetch_queue,
+                PROBE_WORKERS,
+                metrics.stage("probe", PROBE_WORKERS),
+                stop,
+            ),
+            run_stage(
+                lambda m: fetch_stage(
+                    symcache,
+                    client,
+                    probe_cache,
+                    fetch_flights,
+                    cab_executor,
+                    skiplist,
+                    journal,
+                    m,
+                    stats,
+                ),
+                fetch_queue,
+                dump_queue,
+                FETCH_WORKERS,
+                metrics.stage("fetch", FETCH_WORKERS),
+                stop,
+            ),
+            run_stage(
+                lambda m: dump_stage(
+                    symbol_path,
+                    symcache,
+                    dump_syms,
+                    dump_executor,
+                    writer if pipe_dumps else None,
+                    journal,
+                    m,
+                    stats,
+                    metrics,
+                ),
+                dump_queue,
+                zip_queue,
+                dump_jobs,
+                metrics.stage("dump", dump_jobs),
+                stop,
+            ),
+            zip_stage(
+                writer, journal, zip_queue, zip_jobs, metrics.stage("zip", zip_jobs)
+            ),
+        )
+        if stopper is not None:
+            stopper.cancel()
+    sampler.cancel()
+    flusher.cancel()
+    dump_executor.shutdown(wait=False)
 
-    return asyncio.run(helper(url))
+    log.info(
+        f"Collected {stats['to_dump']} files to dump, {stats['resumed']} resumed from a previous run"
+    )
+    if stop.is_set():
+        dropped = {name: s.dropped for name, s in metrics.stages.items() if s.dropped}
+        log.warning(f"Stopped before the deadline, modules dropped: {dropped}")
+
+    return writer.file_index
+
+
+def get_symbol_lists(cache_dir):
+    store = SymbolLists(os.path.join(cache_dir, "symbol-lists.sqlite"))
+    # Symbols that we know belong to us, so don't ask Microsoft for them.
+    store.import_list(BLACKLIST, "blacklist.txt")
+    # Symbols that we know belong to Microsoft, so don't skiplist them.
+    store.import_list(KNOWN_MS_SYMBOLS, "known-microsoft-symbols.txt")
+    # Symbols that we've asked for in the past unsuccessfully: the ones in the
+    # repository and the ones from the text skiplist written by older versions.
+    store.import_skiplist("skiplist.txt")
+    store.import_skiplist(os.path.join(cache_dir, "skiplist.txt"))
+
+    log.debug(
+        f"{store.get_list_size(BLACKLIST)} items in blacklist, "
+        f"{store.get_list_size(KNOWN_MS_SYMBOLS)} items in known Microsoft symbols, "
+        f"{store.get_skiplist_size()} items in skiplist"
+    )
 
+    return store
 
-def gen_zip(output, output_dir, file_index):
-    if not file_index:
+
+def remove_stale_work_dirs(cache_dir, keep):
+    """
+    Remove the work directories other than keep which weren't updated for
+    JOURNAL_MAX_AGE: they're too old to be resumed, and the ones of another
+    number of shards (which changes from a day to another) wouldn't be.
+    """
+    now = time.time()
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if not name.startswith("work") or path == keep or not os.path.isdir(path):
+            continue
+        journal_path = os.path.join(path, "journal.sqlite")
+        try:
+            updated = os.path.getmtime(
+                journal_path if os.path.exists(journal_path) else path
+            )
+        except OSError:
+            continue
+        if now - updated >= JOURNAL_MAX_AGE:
+            log.info(f"Remove the stale work directory {path}")
+            shutil.rmtree(path, True)
+
+
+def get_work_dir(cache_dir, shard=None):
+    """
+    Get the work directory and its journal. If a previous run died partway,
+    we resume from what it left unless it's too old. Each shard has its own
+    work directory, since the cache can be used by the tasks of other shards.
+    """
+    work_dir = os.path.join(cache_dir, "work")
+    if shard is not None:
+        work_dir += f"-{shard[0]}-of-{shard[1]}"
+    os.makedirs(cache_dir, exist_ok=True)
+    remove_stale_work_dirs(cache_dir, work_dir)
+    journal_path = os.path.join(work_dir, "journal.sqlite")
+    if os.path.exists(journal_path):
+        journal = Journal(journal_path)
+        last_update = journal.get_last_update()
+        journal.close()
+        if last_update is not None and time.time() - last_update < JOURNAL_MAX_AGE:
+            log.info(f"Resuming the previous run from {work_dir}")
+        else:
+            shutil.rmtree(work_dir, True)
+
+    os.makedirs(work_dir, exist_ok=True)
+
+    return work_dir, Journal(journal_path)
+
+
+def write_metrics(output, metrics, stats, probe_cache, symcache, prometheus):
+    """
+    Write the metrics of the run next to the output zip (foo-metrics.json for foo.zip).
+    """
+    metrics.extra["counters"] = dict(stats)
+    metrics.extra["caches"] = {
+        "probe_cache_hits": probe_cache.hits,
+        "probe_cache_misses": probe_cache.misses,
+        "symcache_hits": symcache.hits,
+        "symcache_misses": symcache.misses,
+    }
+    base = os.path.splitext(output)[0]
+    try:
+        metrics.write(
+            f"{base}-metrics.json", f"{base}-metrics.prom" if prometheus else None
+        )
+    except OSError as e:
+        log.error("Cannot write the metrics")
+        log.exception(e)
+
+
+def get_retry_policy(args):
+    """
+    Get the retry policy of the run: no retry in the last RUN_TIME_MARGIN
+    seconds before the deadline.
+    """
+    return RetryPolicy(
+        attempts=RETRIES,
+        deadline=None
+        if args.deadline is None
+        else max(0, args.deadline - RUN_TIME_MARGIN - time.time()),
+    )
+
+
+def fetch_symbols(args, store, skiplist):
+    """
+    Process the modules of the missing symbols CSV (only the ones of
+    args.process in a worker process) and return (file index, stats).
+    """
+    stats = defaultdict(int)
+    metrics = Metrics()
+    retry_policy = get_retry_policy(args)
+
+    work_dir, journal = get_work_dir(args.cache_dir, args.shard)
+    symbol_path = os.path.join(work_dir, "symbols")
+    os.makedirs(symbol_path, exist_ok=True)
+    symcache = SymbolCache(
+        args.symcache_dir,
+        args.symcache_size * 1024 ** 3,
+        get_type,
+        args.symcache_index,
+    )
+
+    probe_cache = ProbeCache(
+        args.probe_cache,
+        args.probe_cache_ttl * 24 * 3600,
+        args.probe_cache_size,
+    )
+    # The workers are spawned rather than forked from a process running
+    # an event loop and threads.
+    cab_executor = None
+    if args.cab_jobs:
+        cab_executor = ProcessPoolExecutor(
+            args.cab_jobs, mp_context=multiprocessing.get_context("spawn")
+        )
+
+    try:
+        file_index = asyncio.run(
+            pipeline(
+                output=args.zip,
+                symbol_path=symbol_path,
+                symcache=symcache,
+                missing_symbols=args.missing_symbols,
+                store=store,
+                probe_cache=probe_cache,
+                skiplist=skiplist,
+                journal=journal,
+                dump_syms=args.dump_syms,
+                dump_jobs=args.dump_jobs,
+                pipe_dumps=args.pipe_dumps,
+                zip_jobs=args.zip_jobs,
+                zip_level=args.zip_level,
+                zip_shard_size=args.zip_shard_size * 1024 ** 2,
+                stats=stats,
+                metrics=metrics,
+                retry_policy=retry_policy,
+                cab_executor=cab_executor,
+                shard=args.shard,
+                process=args.process,
+                stop_time=None
+                if args.deadline is None
+                else args.deadline - RUN_TIME_MARGIN,
+            )
+        )
+    finally:
+        if cab_executor is not None:
+            cab_executor.shutdown()
+        # The parent process evicts the entries and the files once all the
+        # workers are done.
+        probe_cache.close(evict=args.process is None)
+        journal.close()
+        symcache.close(evict=args.process is None)
+        write_metrics(args.zip, metrics, stats, probe_cache, symcache, args.prometheus)
+
+    # Everything went fine so there's nothing to resume.
+    shutil.rmtree(work_dir, True)
+
+    return file_index, stats
+
+
+def run_worker(args, process):
+    """
+    Run fetch_symbols in the worker process (i, N) and return its stats, its
+    file index and the updates of the skiplist.
+    """
+    i, n = process
+    args = argparse.Namespace(**vars(args))
+    args.process = process
+    base = os.path.splitext(args.zip)[0]
+    args.zip = f"{base}-p{i}.zip"
+    # The same modules always go to the same process, so each one has its own
+    # work directory, with its share of the resources. The probe cache and
+    # the symcache directory are shared (the binaries are often used by
+    # modules of several processes, and changing the number of processes
+    # doesn't lose them), but each process has its own symcache index.
+    symbol_lists_path = os.path.join(args.cache_dir, "symbol-lists.sqlite")
+    args.cache_dir = os.path.join(args.cache_dir, f"process-{i}-of-{n}")
+    args.symcache_index = f"index-{i}-of-{n}.sqlite"
+    args.dump_jobs = max(1, args.dump_jobs // n)
+    args.zip_jobs = max(1, args.zip_jobs // n)
+    if args.cab_jobs:
+        args.cab_jobs = max(1, args.cab_jobs // n)
+    args.symcache_size /= n
+
+    store = SymbolLists(symbol_lists_path)
+    skiplist = DeferredSkiplist(store, args.skiplist_retry_after * 24 * 3600)
+    try:
+        file_index, stats = fetch_symbols(args, store, skiplist)
+    finally:
+        store.close()
+
+    return dict(stats), file_index, skiplist.updates
+
+
+async def download_missing_symbols(url, path, retry_policy):
+    """
+    Download the missing symbols CSV in path, with the retries of
+    fetch_missing_symbols.
+    """
+    async with new_client(Metrics(), retry_policy) as client:
+        with open(path, "w") as Out:
+            Out.write(MISSING_SYMBOLS_HEADER)
+            async for line in fetch_missing_symbols(client, url):
+                Out.write(line if line.endswith("\n") else line + "\n")
+
+
+def merge_stats(all_stats):
+    """
+    Merge the stats of the worker processes. They all read all the rows of
+    the CSV, so the counters of the rows before the split between the
+    processes are the same in each one.
+    """
+    stats = defaultdict(int)
+    for s in all_stats:
+        for key, value in s.items():
+            if key in {"total", "other_shard"}:
+                stats[key] = max(stats[key], value)
+            elif key != "other_process":
+                stats[key] += value
+    return stats
+
+
+def merge_manifests(output, processes):
+    """
+    Merge the manifests of the zips of the worker processes (foo-p0.json,
+    foo-p1.json, ...) into the one of the output (foo.json).
+    """
+    base = os.path.splitext(output)[0]
+    shards = []
+    for i in range(processes):
+        path = f"{base}-p{i}.json"
+        if os.path.exists(path):
+            with open(path, "r") as In:
+                shards += json.load(In)["shards"]
+            os.remove(path)
+    with open(f"{base}.json", "w") as Out:
+        json.dump({"shards": shards}, Out, indent=2)
+    log.info(f"Wrote manifest for {len(shards)} zips as {base}.json")
+
+
+def remove_stale_process_dirs(cache_dir, processes):
+    """
+    Remove the directories of the worker processes (process-i-of-N) of the
+    runs with another number of processes: their modules are split
+    differently, so their work directories cannot be resumed.
+    """
+    if not os.path.isdir(cache_dir):
         return
+    suffix = f"-of-{processes}"
+    for name in os.listdir(cache_dir):
+        if name.startswith("process-") and not name.endswith(suffix):
+            log.info(f"Remove the directory {name} of a previous run")
+            shutil.rmtree(os.path.join(cache_dir, name), True)
+
 
-    with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as z:
-        for f in file_index:
-            z.write(os.path.join(output_dir, f), f)
-    log.info(f"Wrote zip as {output}")
+def fetch_symbols_in_processes(args):
+    """
+    Split the modules between args.processes worker processes by a hash of
+    (debug file, debug id). Each one runs its own event loop and connection
+    pool, writes its own zips and only reads the symbol lists. The parent
+    process merges their stats, file indexes, zips manifests and skiplist
+    updates, and returns (file index, stats).
+    """
+    n = args.processes
+    remove_stale_process_dirs(args.cache_dir, n)
+    # Import the lists before the workers read them.
+    get_symbol_lists(args.cache_dir).close()
+
+    args = argparse.Namespace(**vars(args))
+    if args.missing_symbols.startswith("http"):
+        # Download the CSV once for all the processes.
+        path = os.path.join(args.cache_dir, "missing-symbols.csv")
+        asyncio.run(
+            download_missing_symbols(args.missing_symbols, path, get_retry_policy(args))
+        )
+        args.missing_symbols = path
+
+    results = []
+    error = None
+    with ProcessPoolExecutor(n) as executor:
+        futures = [executor.submit(run_worker, args, (i, n)) for i in range(n)]
+        for i, future in enumerate(futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                log.error(f"Worker process {i} failed")
+                log.exception(e)
+                error = error or e
+
+    store = SymbolLists(os.path.join(args.cache_dir, "symbol-lists.sqlite"))
+    skiplist = Skiplist(store, args.skiplist_retry_after * 24 * 3600)
+    try:
+        for _, _, updates in results:
+            skiplist.apply(updates)
+    finally:
+        store.close()
+    merge_manifests(args.zip, n)
+    SymbolCache(args.symcache_dir, args.symcache_size * 1024 ** 3, get_type).close()
+    ProbeCache(
+        args.probe_cache,
+        args.probe_cache_ttl * 24 * 3600,
+        args.probe_cache_size,
+    ).close()
+
+    stats = merge_stats(s for s, _, _ in results)
+    base = os.path.splitext(args.zip)[0]
+    try:
+        with open(f"{base}-metrics.json", "w") as Out:
+            json.dump(
+                {
+                    "counters": stats,
+                    "processes": [
+                        f"{os.path.basename(base)}-p{i}-metrics.json" for i in range(n)
+                    ],
+                },
+                Out,
+                indent=2,
+            )
+    except OSError as e:
+        log.error("Cannot write the metrics")
+        log.exception(e)
+
+    if error is not None:
+        raise error
+
+    return set().union(*(file_index for _, file_index, _ in results)), stats
+
+
+def parse_deadline(value):
+    """
+    Parse a date like the deadlines of Taskcluster (2019-01-01T12:00:00.000Z)
+    and return it as a timestamp.
+    """
+    date = datetime.datetime.fromisoformat(value.rstrip("Z"))
+    return date.replace(tzinfo=datetime.timezone.utc).timestamp()
 
 
 def main():
@@ -448,59 +2047,170 @@ def main():
     parser.add_argument(
         "--missing-symbols",
         type=str,
-        help="missing symbols URL",
+        help="missing symbols URL or CSV file",
         default=MISSING_SYMBOLS_URL,
     )
-    parser.add_argument("zip", type=str, help="output zip file")
+    parser.add_argument(
+        "zip",
+        type=str,
+        help="output zip file (the symbols are written in foo-000.zip, foo-001.zip, ... and listed in foo.json for foo.zip)",
+    )
     parser.add_argument(
         "--dump-syms",
         type=str,
         help="dump_syms path",
         default=os.environ.get("DUMP_SYMS_PATH"),
     )
+    parser.add_argument(
+        "--dump-jobs",
+        type=int,
+        help="number of dump_syms to run in parallel (default: according to cpus and memory)",
+        default=None,
+    )
+    parser.add_argument(
+        "--pipe-dumps",
+        action="store_true",
+        help="compress the output of dump_syms into the zips as it comes instead of "
+        "writing the symbol files on disk first",
+    )
+    parser.add_argument(
+        "--zip-jobs",
+        type=int,
+        help="number of symbol files to compress in parallel",
+        default=os.cpu_count() or 1,
+    )
+    parser.add_argument(
+        "--cab-jobs",
+        type=int,
+        help="number of processes extracting the compressed variants (.pd_, .dl_) of the files "
+        "downloaded from Microsoft's symbol server (0 to only download the plain files)",
+        default=CAB_JOBS,
+    )
+    parser.add_argument(
+        "--zip-level",
+        type=int,
+        choices=range(0, 10),
+        metavar="[0-9]",
+        help="compression level of the zip",
+        default=ZIP_LEVEL,
+    )
+    parser.add_argument(
+        "--zip-shard-size",
+        type=int,
+        help="max size in MB of each output zip",
+        default=ZIP_SHARD_SIZE,
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        help="directory where the data persisted across runs are stored",
+        default=os.environ.get("SYMSRV_CACHE_DIR", "cache"),
+    )
+    parser.add_argument(
+        "--probe-cache-ttl",
+        type=float,
+        help="number of days after which an answer from Microsoft's symbol server is checked again",
+        default=PROBE_CACHE_TTL,
+    )
+    parser.add_argument(
+        "--probe-cache-size",
+        type=int,
+        help="max number of entries in the probe cache",
+        default=PROBE_CACHE_SIZE,
+    )
+    parser.add_argument(
+        "--symcache-size",
+        type=float,
+        help="max size in GB of the cache of the files downloaded from Microsoft's symbol server",
+        default=SYMCACHE_SIZE,
+    )
+    parser.add_argument(
+        "--skiplist-retry-after",
+        type=float,
+        help="number of days after which a symbol in the skiplist is checked again (doubled each time it's still missing)",
+        default=SKIPLIST_RETRY_AFTER,
+    )
+    parser.add_argument(
+        "--max-run-time",
+        type=float,
+        help="max run time in seconds of the task: the failed requests aren't retried "
+        f"during its last {RUN_TIME_MARGIN} seconds (default: no limit)",
+        default=os.environ.get("SYMSRV_MAX_RUN_TIME"),
+    )
+    parser.add_argument(
+        "--deadline",
+        type=parse_deadline,
+        help="deadline of the task (e.g. 2019-01-01T12:00:00.000Z): the failed requests "
+        f"aren't retried during its last {RUN_TIME_MARGIN} seconds (default: no limit)",
+        default=os.environ.get("SYMSRV_DEADLINE"),
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        help="only process the modules of the i-th of N shards, given as i/N with 0 <= i < N "
+        "(see run-taskcluster.py)",
+        default=os.environ.get("SYMSRV_SHARD"),
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        help="number of worker processes, each one processing its share of the modules "
+        "with its own event loop",
+        default=1,
+    )
+    parser.add_argument(
+        "--prometheus",
+        action="store_true",
+        help="also write the metrics of the run in the Prometheus text format (foo-metrics.prom for foo.zip)",
+    )
 
     args = parser.parse_args()
 
     assert args.dump_syms, "dump_syms path is empty"
+    args.dump_jobs = args.dump_jobs or get_dump_jobs()
+    args.process = None
+    args.symcache_dir = os.path.join(args.cache_dir, "symcache")
+    args.symcache_index = SYMCACHE_INDEX
+    args.probe_cache = os.path.join(args.cache_dir, "probe-cache.sqlite")
+    # The task is stopped at its deadline or after its max run time,
+    # whichever comes first.
+    if args.max_run_time is not None:
+        end = time.time() + args.max_run_time
+        args.deadline = end if args.deadline is None else min(args.deadline, end)
 
     logging.basicConfig(level=logging.DEBUG)
     aiohttp_logger = logging.getLogger("aiohttp.client")
     aiohttp_logger.setLevel(logging.INFO)
-    log.info("Started")
-
-    missing_symbols, blacklist, known_ms_symbols, skiplist = get_base_data(
-        args.missing_symbols
-    )
-
-    modules, stats_skipped = get_missing_symbols(missing_symbols, skiplist, blacklist)
-
-    symbol_path = mkdtemp("symsrvfetch")
-    temp_path = mkdtemp(prefix="symcache")
-
-    modules, stats_collect = asyncio.run(collect(modules))
-    modules = asyncio.run(fetch_all(temp_path, modules))
-
-    file_index, stats_dump = asyncio.run(
-        dump(symbol_path, temp_path, modules, args.dump_syms)
-    )
+    log.info(f"Started (with {args.dump_jobs} dump jobs)")
+    if args.shard is not None:
+        log.info(f"Shard {args.shard[0]}/{args.shard[1]}")
 
-    gen_zip(args.zip, symbol_path, file_index)
-
-    shutil.rmtree(symbol_path, True)
-    shutil.rmtree(temp_path, True)
-
-    write_skiplist(skiplist)
+    if args.processes > 1:
+        log.info(f"Split the work between {args.processes} processes")
+        file_index, stats = fetch_symbols_in_processes(args)
+    else:
+        remove_stale_process_dirs(args.cache_dir, 1)
+        store = get_symbol_lists(args.cache_dir)
+        skiplist = Skiplist(store, args.skiplist_retry_after * 24 * 3600)
+        try:
+            file_index, stats = fetch_symbols(args, store, skiplist)
+        finally:
+            store.close()
 
     if not file_index:
-        log.info(f"No symbols downloaded: {len(missing_symbols)} considered")
+        log.info(f"No symbols downloaded: {stats['total']} considered")
     else:
         log.info(
-            f"Total files: {len(missing_symbols)}, Stored {len(file_index)} symbol files"
+            f"Total files: {stats['total']}, Stored {len(file_index)} symbol files"
         )
 
     log.info(
-        f"{stats_collect['is_there']} already present, {stats_skipped['blacklist']} in blacklist, {stats_skipped['skiplist']} skipped, {stats_collect['no_pdb']} not found, "
-        f"{stats_dump['dump_error']} processed with errors, {stats_dump['no_bin']} processed but with no binaries (x86_64)"
+        f"{stats['is_there']} already present, {stats['blacklist']} in blacklist, {stats['skiplist']} skipped, {stats['skiplist_retry']} skipped before and checked again, {stats['no_pdb']} not found, {stats['probe_error']} not probed, "
+        f"{stats['fetch_error']} not fetched, {stats['dump_error']} processed with errors, {stats['no_bin']} processed but with no binaries (x86_64), "
+        f"{stats['dump_avoided']} of them without running dump_syms, {stats['corrupt']} corrupt downloads, {stats['mismatch']} binaries for another pdb"
+    )
+    log.info(
+        f"{stats['other_shard']} in other shards, {stats['duplicate']} duplicates, {stats['probe_coalesced']} probes and {stats['fetch_coalesced']} downloads shared with another module"
     )
     log.info("Finished, exiting")
 
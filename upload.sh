@@ -3,7 +3,13 @@
 set -v -e -x
 
 # TODO: We shouldn't install these at runtime, but in the docker image.
-pip install redo
 pip install requests
 
-python upload_symbols.py https://queue.taskcluster.net/v1/task/${ARTIFACT_TASKID}/artifacts/public/build/target.crashreporter-symbols.zip
+# The symbols of all the fetch tasks (one per shard, see run-taskcluster.py).
+manifests=""
+for task_id in ${ARTIFACT_TASKIDS}; do
+    manifests="${manifests} https://queue.taskcluster.net/v1/task/${task_id}/artifacts/public/build/target.crashreporter-symbols.json"
+done
+
+# The failed requests aren't retried past the maxRunTime of upload-task.json.
+python upload_symbols.py --max-run-time 7200 ${manifests}
@@ -6,6 +6,10 @@
 #
 # This script uploads a symbol zip file from a path or URL passed on the commandline
 # to the symbol server at https://symbols.mozilla.org/ .
+# It can also be passed the JSON manifest written by symsrv-fetch.py, in which
+# case all the zip files listed in it are uploaded in parallel.
+# Before the upload, the symbol files already on the symbol server are
+# removed from the zip files (unless --no-check is passed).
 #
 # Using this script requires you to have generated an authentication
 # token in the symbol server web interface. You must store the token in a Taskcluster
@@ -17,15 +21,32 @@
 from __future__ import absolute_import, print_function, unicode_literals
 
 import argparse
+import json
 import logging
 import os
+import shutil
 import sys
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from urllib.parse import quote, urljoin, urlparse
+except ImportError:
+    from urllib import quote
+    from urlparse import urljoin, urlparse
+
+from retry_policy import SUCCESS, TRANSIENT, RetryPolicy, classify, get_retry_after
 
 log = logging.getLogger('upload-symbols')
 log.setLevel(logging.INFO)
 
 DEFAULT_URL = 'https://symbols.mozilla.org/upload/'
+DEFAULT_SYMBOLS_URL = 'https://symbols.mozilla.org/'
 MAX_RETRIES = 5
+MAX_PARALLEL_UPLOADS = 4
+MAX_PARALLEL_CHECKS = 32
 
 
 def print_error(r):
@@ -56,20 +77,295 @@ def get_taskcluster_secret(secret_name):
     return auth_token
 
 
+def get_manifest(session, retry_policy, url):
+    """
+    Get the manifest at url, retrying on transient failures.
+    Return None if there's none (404) and raise an exception if we gave up.
+    """
+    import requests
+
+    retry = retry_policy.start(urlparse(url).hostname)
+    while wait_breaker(retry):
+        r = None
+        try:
+            r = session.get(url, timeout=(10, 300))
+            if r.status_code == 404:
+                retry.on_success()
+                return None
+            if classify(r.status_code) != TRANSIENT:
+                retry.on_success()
+                r.raise_for_status()
+                return r.json()
+            log.error('Error while getting {0}: HTTP {1}'.format(url, r.status_code))
+        except requests.exceptions.HTTPError:
+            raise
+        except (requests.exceptions.RequestException, ValueError) as e:
+            # ValueError: not JSON (e.g. an error page)
+            log.error('Error while getting {0}: {1}'.format(url, e))
+        if not retry_after_failure(retry, r):
+            break
+    raise Exception('Cannot get the manifest {0}'.format(url))
+
+
+def get_zips(session, retry_policy, location):
+    """
+    Get the zip files to upload: either location itself or the zip files
+    listed in the manifest at location. A missing manifest is taken as an
+    empty one (e.g. a fetch task which failed), so that the other ones are
+    still uploaded.
+    Return a list of (path or URL, list of the files in the zip or None if unknown).
+    """
+    if not location.endswith('.json'):
+        return [(location, None)]
+
+    if location.startswith('http'):
+        manifest = get_manifest(session, retry_policy, location)
+        if manifest is None:
+            log.warning('No manifest at {0}: nothing to upload from it'.format(location))
+            return []
+        return [(urljoin(location, shard['name']), shard.get('files'))
+                for shard in manifest['shards']]
+
+    if not os.path.isfile(location):
+        log.warning('No manifest at {0}: nothing to upload from it'.format(location))
+        return []
+    with open(location, 'r') as f:
+        manifest = json.load(f)
+    return [(os.path.join(os.path.dirname(location), shard['name']), shard.get('files'))
+            for shard in manifest['shards']]
+
+
+def wait_breaker(retry):
+    """
+    Wait until the circuit breaker of the host lets the request go.
+    Return False if it would be past the deadline.
+    """
+    while True:
+        wait = retry.get_wait()
+        if wait is None:
+            return False
+        if not wait:
+            return True
+        time.sleep(wait)
+
+
+def retry_after_failure(retry, response=None):
+    """
+    Wait before retrying a request which failed (with the response if any).
+    Return False if we must give up.
+    """
+    retry_after = None if response is None else get_retry_after(response.headers)
+    delay = retry.on_failure(retry_after)
+    if delay is None:
+        return False
+    time.sleep(delay)
+    return True
+
+
+def download_zip(session, retry_policy, url, tmp_dir):
+    import requests
+
+    path = os.path.join(tmp_dir, '{0}-{1}'.format(len(os.listdir(tmp_dir)),
+                                                   url.rsplit('/', 1)[-1]))
+    log.info('Downloading "{0}"'.format(url))
+    retry = retry_policy.start(urlparse(url).hostname)
+    while wait_breaker(retry):
+        r = None
+        try:
+            with session.get(url, stream=True, timeout=(10, 300)) as r:
+                if classify(r.status_code) != TRANSIENT:
+                    retry.on_success()
+                    r.raise_for_status()
+                    with open(path, 'wb') as f:
+                        shutil.copyfileobj(r.raw, f)
+                    return path
+                log.error('Error while downloading {0}: HTTP {1}'.format(url, r.status_code))
+        except requests.exceptions.HTTPError:
+            break
+        except Exception as e:
+            log.error('Error while downloading {0}: {1}'.format(url, e))
+        if not retry_after_failure(retry, r):
+            break
+    raise Exception('Cannot download {0}'.format(url))
+
+
+def symbol_exists(session, retry_policy, symbols_url, name):
+    """
+    Check if the symbol server has the symbol file name: it redirects
+    to the file when it has it. In case of doubt, the file is considered missing.
+    """
+    import requests
+
+    url = urljoin(symbols_url, quote(name))
+    retry = retry_policy.start(urlparse(url).hostname)
+    while wait_breaker(retry):
+        r = None
+        try:
+            r = session.head(url, allow_redirects=False, timeout=(10, 60))
+            status = classify(r.status_code)
+            if status != TRANSIENT:
+                retry.on_success()
+                return status == SUCCESS
+        except requests.exceptions.RequestException as e:
+            log.debug('Error while checking {0}: {1}'.format(url, e))
+        if not retry_after_failure(retry, r):
+            break
+    return False
+
+
+def find_existing(session, retry_policy, symbols_url, names, jobs):
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = executor.map(
+            lambda name: symbol_exists(session, retry_policy, symbols_url, name), names)
+        return {name for name, exists in zip(names, results) if exists}
+
+
+def strip_zip(zip_path, existing, tmp_dir):
+    """
+    Write a copy of the zip file without the files in existing and return its path.
+    """
+    path = os.path.join(tmp_dir, '{0}-{1}'.format(len(os.listdir(tmp_dir)),
+                                                   os.path.basename(zip_path)))
+    with zipfile.ZipFile(zip_path, 'r') as In, \
+            zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as Out:
+        for info in In.infolist():
+            if info.filename not in existing:
+                with In.open(info) as src, Out.open(info, 'w') as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+    return path
+
+
+def remove_existing(session, retry_policy, symbols_url, zips, jobs, tmp_dir):
+    """
+    Remove the symbol files which are already on the symbol server from the zips.
+    Return the list of the paths or URLs of the zip files to upload.
+    """
+    # Get the list of the files in each zip, downloading it if we don't know it.
+    local = {}
+    zips_files = []
+    # A zip which can't be downloaded is uploaded by URL without the check.
+    unchecked = []
+    for zip_path, files in zips:
+        if files is None:
+            if zip_path.startswith('http'):
+                try:
+                    local[zip_path] = download_zip(session, retry_policy, zip_path, tmp_dir)
+                except Exception as e:
+                    log.error('{0}: upload it without the check ({1})'.format(zip_path, e))
+                    unchecked.append(zip_path)
+                    continue
+            with zipfile.ZipFile(local.get(zip_path, zip_path), 'r') as z:
+                files = z.namelist()
+        zips_files.append((zip_path, files))
+
+    names = sorted({name for _, files in zips_files for name in files})
+    existing = find_existing(session, retry_policy, symbols_url, names, jobs)
+    log.info('{0} of {1} symbol files are already on the symbol server'.format(
+        len(existing), len(names)))
+
+    to_upload = unchecked
+    for zip_path, files in zips_files:
+        present = sum(1 for name in files if name in existing)
+        if present == len(files):
+            log.info('{0}: all the symbol files are already there, skip it'.format(zip_path))
+        elif present == 0:
+            to_upload.append(zip_path)
+        else:
+            if zip_path.startswith('http') and zip_path not in local:
+                try:
+                    local[zip_path] = download_zip(session, retry_policy, zip_path, tmp_dir)
+                except Exception as e:
+                    log.error('{0}: upload it whole ({1})'.format(zip_path, e))
+                    to_upload.append(zip_path)
+                    continue
+            stripped = strip_zip(local.get(zip_path, zip_path), existing, tmp_dir)
+            log.info('{0}: upload {1} without the {2} symbol files already there'.format(
+                zip_path, stripped, present))
+            to_upload.append(stripped)
+
+    return to_upload
+
+
+def upload(session, retry_policy, url, auth_token, zip_path):
+    """
+    Upload a zip file (path or URL), retrying on transient failures.
+    Return True on success.
+    """
+    import requests
+
+    log.info('Uploading symbol file "{0}" to "{1}"'.format(zip_path, url))
+
+    def post(**zip_arg):
+        return session.post(
+            url,
+            headers={'Auth-Token': auth_token},
+            allow_redirects=False,
+            # Allow a longer read timeout because uploading by URL means the server
+            # has to fetch the entire zip file, which can take a while. The load balancer
+            # in front of symbols.mozilla.org has a 300 second timeout, so we'll use that.
+            timeout=(10, 300),
+            **zip_arg)
+
+    retry = retry_policy.start(urlparse(url).hostname)
+    while wait_breaker(retry):
+        log.info('{0}: attempt {1} of {2}...'.format(zip_path, retry.retries + 1, MAX_RETRIES))
+        r = None
+        try:
+            if zip_path.startswith('http'):
+                r = post(data={'url': zip_path})
+            else:
+                # The file is opened again for each attempt, and closed
+                # whatever the outcome.
+                with open(zip_path, 'rb') as f:
+                    r = post(files={'symbols.zip': f})
+            # 429 or any 5XX is likely to be a transient failure.
+            # Break out for success or other error codes.
+            if classify(r.status_code) != TRANSIENT:
+                retry.on_success()
+                break
+            print_error(r)
+        except requests.exceptions.RequestException as e:
+            log.error('Error: {0}'.format(e))
+        if not retry_after_failure(retry, r):
+            log.warn('{0}: maximum retries hit, giving up!'.format(zip_path))
+            return False
+        log.info('{0}: retrying...'.format(zip_path))
+    else:
+        log.warn('{0}: out of time, giving up!'.format(zip_path))
+        return False
+
+    if r.status_code >= 200 and r.status_code < 300:
+        log.info('{0}: uploaded successfully!'.format(zip_path))
+        return True
+
+    print_error(r)
+    return False
+
+
 def main():
-    import redo
     import requests
 
     logging.basicConfig()
     parser = argparse.ArgumentParser(
         description='Upload symbols in ZIP using token from Taskcluster secrets service.')
-    parser.add_argument('zip',
-                        help='Symbols zip file - URL or path to local file')
+    parser.add_argument('zip', nargs='+',
+                        help='Symbols zip files or JSON manifests of zip files '
+                             '(e.g. one per fetch task) - URLs or paths to local files')
+    parser.add_argument('--jobs', type=int, default=MAX_PARALLEL_UPLOADS,
+                        help='Number of zip files to upload in parallel')
+    parser.add_argument('--check-jobs', type=int, default=MAX_PARALLEL_CHECKS,
+                        help='Number of symbol files to check in parallel')
+    parser.add_argument('--no-check', action='store_true',
+                        help="Don't remove the symbol files already on the symbol server")
+    parser.add_argument('--max-run-time', type=float, default=None,
+                        help='Max run time in seconds, the failed requests are not '
+                             'retried past it (default: no limit)')
     args = parser.parse_args()
 
-    if not args.zip.startswith('http') and not os.path.isfile(args.zip):
-        log.error('Error: zip file "{0}" does not exist!'.format(args.zip))
-        return 1
+    for location in args.zip:
+        if not location.startswith('http') and not os.path.isfile(location):
+            log.error('Error: zip file "{0}" does not exist!'.format(location))
+            return 1
 
     secret_name = os.environ.get('SYMBOL_SECRET')
     if secret_name is not None:
@@ -92,42 +388,58 @@ def main():
     else:
         url = DEFAULT_URL
 
-    log.info('Uploading symbol file "{0}" to "{1}"'.format(args.zip, url))
+    symbols_url = os.environ.get('SOCORRO_SYMBOL_DOWNLOAD_URL', DEFAULT_SYMBOLS_URL)
+
+    # Share the connections between the manifests, the checks and the uploads.
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_maxsize=max(args.jobs, args.check_jobs))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
 
-    for i, _ in enumerate(redo.retrier(attempts=MAX_RETRIES), start=1):
-        log.info('Attempt %d of %d...' % (i, MAX_RETRIES))
+    retry_policy = RetryPolicy(attempts=MAX_RETRIES, deadline=args.max_run_time)
+
+    # The zips of the other manifests are still uploaded when one can't be read.
+    zips = []
+    failed_manifests = []
+    for location in args.zip:
         try:
-            if args.zip.startswith('http'):
-                zip_arg = {'data': {'url': args.zip}}
-            else:
-                zip_arg = {'files': {'symbols.zip': open(args.zip, 'rb')}}
-            r = requests.post(
-                url,
-                headers={'Auth-Token': auth_token},
-                allow_redirects=False,
-                # Allow a longer read timeout because uploading by URL means the server
-                # has to fetch the entire zip file, which can take a while. The load balancer
-                # in front of symbols.mozilla.org has a 300 second timeout, so we'll use that.
-                timeout=(10, 300),
-                **zip_arg)
-            # 429 or any 5XX is likely to be a transient failure.
-            # Break out for success or other error codes.
-            if r.ok or (r.status_code < 500 and r.status_code != 429):
-                break
-            print_error(r)
-        except requests.exceptions.RequestException as e:
+            zips += get_zips(session, retry_policy, location)
+        except Exception as e:
             log.error('Error: {0}'.format(e))
-        log.info('Retrying...')
-    else:
-        log.warn('Maximum retries hit, giving up!')
-        return 1
+            failed_manifests.append(location)
+    for zip_path, _ in zips:
+        if not zip_path.startswith('http') and not os.path.isfile(zip_path):
+            log.error('Error: zip file "{0}" does not exist!'.format(zip_path))
+            return 1
 
-    if r.status_code >= 200 and r.status_code < 300:
-        log.info('Uploaded successfully!')
-        return 0
+    tmp_dir = tempfile.mkdtemp(prefix='upload-symbols')
+    try:
+        if args.no_check:
+            zip_paths = [zip_path for zip_path, _ in zips]
+        else:
+            zip_paths = remove_existing(session, retry_policy, symbols_url, zips,
+                                        args.check_jobs, tmp_dir)
 
-    print_error(r)
-    return 1
+        # Each zip file is retried on its own, so a failure only costs its re-upload.
+        with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            results = list(executor.map(
+                lambda zip_path: upload(session, retry_policy, url, auth_token, zip_path),
+                zip_paths))
+    finally:
+        shutil.rmtree(tmp_dir, True)
+
+    if failed_manifests:
+        log.error('Failed to get {0} manifests: {1}'.format(
+            len(failed_manifests), ', '.join(failed_manifests)))
+    failed = [zip_path for zip_path, ok in zip(zip_paths, results) if not ok]
+    if failed:
+        log.error('Failed to upload {0} of {1} zip files: {2}'.format(
+            len(failed), len(zip_paths), ', '.join(failed)))
+        return 1
+
+    log.info('Uploaded {0} zip files successfully!'.format(len(zip_paths)))
+    return 1 if failed_manifests else 0
 
 
 if __name__ == '__main__':